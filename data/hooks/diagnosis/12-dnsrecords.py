@@ -8,7 +8,7 @@ from publicsuffix import PublicSuffixList
 
 from moulinette.utils.process import check_output
 
-from yunohost.utils.network import dig
+from yunohost.utils.network import dig, dig_many
 from yunohost.diagnosis import Diagnoser
 from yunohost.domain import domain_list, _build_dns_conf, _get_maindomain
 
@@ -18,20 +18,52 @@ YNH_DYNDNS_DOMAINS = ['nohost.me', 'noho.st', 'ynh.fr']
 class DNSRecordsDiagnoser(Diagnoser):
 
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
-    cache_duration = 600
+    cache_duration = 3600
     dependencies = ["ip"]
+    invalidated_by = ["domain"]
+    partial_runs_for = ["domain"]
+
+    # Current records, as { (qname, type): result of dig() }
+    current_records = {}
 
     def run(self):
 
         main_domain = _get_maindomain()
 
         all_domains = domain_list()["domains"]
-        for domain in all_domains:
-            self.logger_debug("Diagnosing DNS conf for %s" % domain)
+        domains_to_check = all_domains
+        if self.restrict_to:
+            domains_to_check = [d for d in all_domains if d in self.restrict_to["domain"]]
+
+        expected_configurations = {}
+        for domain in domains_to_check:
             is_subdomain = domain.split(".", 1)[1] in all_domains
-            for report in self.check_domain(domain, domain == main_domain, is_subdomain=is_subdomain):
+            expected_configuration = _build_dns_conf(domain, include_empty_AAAA_if_no_ipv6=True)
+            # For subdomains, we only diagnosis A and AAAA records
+            if is_subdomain:
+                expected_configuration = {"basic": expected_configuration["basic"]}
+            expected_configurations[domain] = expected_configuration
+
+        # Fetch the current records of all domains at once, instead of waiting
+        # for each of them in turn (and skip the cached answers when forced
+        # to, e.g. to check records which were just fixed)
+        queries = set((self.record_qname(domain, r["name"]), r["type"])
+                      for domain, expected_configuration in expected_configurations.items()
+                      for records in expected_configuration.values()
+                      for r in records)
+        queries = sorted(queries)
+        self.current_records = dict(zip(queries, dig_many(queries, resolvers="force_external",
+                                                          use_cache=not self.args.get("force", False))))
+
+        for domain in domains_to_check:
+            self.logger_debug("Diagnosing DNS conf for %s" % domain)
+            for report in self.check_domain(domain, domain == main_domain, expected_configurations[domain]):
                 yield report
 
+        # (the expiration dates are only checked along with all the domains)
+        if self.restrict_to:
+            return
+
         # Check if a domain buy by the user will expire soon
         psl = PublicSuffixList()
         domains_from_registrar = [psl.get_public_suffix(domain) for domain in all_domains]
@@ -40,16 +72,16 @@ class DNSRecordsDiagnoser(Diagnoser):
         for report in self.check_expiration_date(domains_from_registrar):
             yield report
 
-    def check_domain(self, domain, is_main_domain, is_subdomain):
+    def is_restricted_item(self, item):
+        # The items about expiration dates are kept in partial runs
+        return "test" not in item["meta"] and Diagnoser.is_restricted_item(self, item)
 
-        expected_configuration = _build_dns_conf(domain, include_empty_AAAA_if_no_ipv6=True)
+    def check_domain(self, domain, is_main_domain, expected_configuration):
 
-        categories = ["basic", "mail", "xmpp", "extra"]
-        # For subdomains, we only diagnosis A and AAAA records
-        if is_subdomain:
-            categories = ["basic"]
+        for category in ["basic", "mail", "xmpp", "extra"]:
 
-        for category in categories:
+            if category not in expected_configuration:
+                continue
 
             records = expected_configuration[category]
             discrepancies = []
@@ -108,10 +140,17 @@ class DNSRecordsDiagnoser(Diagnoser):
 
             yield output
 
+    def record_qname(self, domain, name):
+        return "%s.%s" % (name, domain) if name != "@" else domain
+
     def get_current_record(self, domain, name, type_):
 
-        query = "%s.%s" % (name, domain) if name != "@" else domain
-        success, answers = dig(query, type_, resolvers="force_external")
+        query = self.record_qname(domain, name)
+        if (query, type_) in self.current_records:
+            success, answers = self.current_records[(query, type_)]
+        else:
+            success, answers = dig(query, type_, resolvers="force_external",
+                                   use_cache=not self.args.get("force", False))
 
         if success != "ok":
             return None
@@ -161,8 +200,9 @@ class DNSRecordsDiagnoser(Diagnoser):
             expire_date = self.get_domain_expiration(domain)
 
             if isinstance(expire_date, str):
-                status_ns, _ = dig(domain, "NS", resolvers="force_external")
-                status_a, _ = dig(domain, "A", resolvers="force_external")
+                use_cache = not self.args.get("force", False)
+                status_ns, _ = dig(domain, "NS", resolvers="force_external", use_cache=use_cache)
+                status_a, _ = dig(domain, "A", resolvers="force_external", use_cache=use_cache)
                 if "ok" not in [status_ns, status_a]:
                     details["not_found"].append((
                         "diagnosis_domain_%s_details" % (expire_date),
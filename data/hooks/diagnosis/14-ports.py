@@ -9,8 +9,9 @@ from yunohost.service import _get_services
 class PortsDiagnoser(Diagnoser):
 
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
-    cache_duration = 600
+    cache_duration = 3600
     dependencies = ["ip"]
+    invalidated_by = ["firewall"]
 
     def run(self):
 
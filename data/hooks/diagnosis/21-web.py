@@ -16,12 +16,17 @@ DIAGNOSIS_SERVER = "diagnosis.yunohost.org"
 class WebDiagnoser(Diagnoser):
 
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
-    cache_duration = 600
+    cache_duration = 3600
     dependencies = ["ip"]
+    invalidated_by = ["domain"]
+    partial_runs_for = ["domain"]
 
     def run(self):
 
         all_domains = domain_list()["domains"]
+        if self.restrict_to:
+            all_domains = [d for d in all_domains if d in self.restrict_to["domain"]]
+
         domains_to_check = []
         for domain in all_domains:
 
@@ -12,16 +12,21 @@ from moulinette.utils.filesystem import read_yaml
 from yunohost.diagnosis import Diagnoser
 from yunohost.domain import _get_maindomain, domain_list
 from yunohost.settings import settings_get
-from yunohost.utils.network import dig
+from yunohost.utils.network import dig, dig_many
 
 DEFAULT_DNS_BLACKLIST = "/usr/share/yunohost/other/dnsbl_list.yml"
 
+# Max number of requests done at once to a same DNS blacklist server
+DNSBL_MAX_PARALLEL_REQUESTS = 2
+
 
 class MailDiagnoser(Diagnoser):
 
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
-    cache_duration = 600
+    cache_duration = 3600
     dependencies = ["ip"]
+    # (changes of domains go along with a regen-conf of postfix)
+    invalidated_by = ["configuration"]
 
     def run(self):
 
@@ -126,7 +131,8 @@ class MailDiagnoser(Diagnoser):
                 query += '.ip6.arpa'
 
             # Do the DNS Query
-            status, value = dig(query, 'PTR', resolvers="force_external")
+            status, value = dig(query, 'PTR', resolvers="force_external",
+                                use_cache=not self.args.get("force", False))
             if status == "nok":
                 yield dict(meta={"test": "mail_fcrdns", "ipversion": ipversion},
                            data={"ip": ip, "ehlo_domain": self.ehlo_domain},
@@ -156,6 +162,7 @@ class MailDiagnoser(Diagnoser):
         """
 
         dns_blacklists = read_yaml(DEFAULT_DNS_BLACKLIST)
+        to_check = []
         for item in self.ips + self.mail_domains:
             for blacklist in dns_blacklists:
                 item_type = "domain"
@@ -174,29 +181,36 @@ class MailDiagnoser(Diagnoser):
                     subdomain = str(rev.split(3)[0])
                 query = subdomain + '.' + blacklist['dns_server']
 
-                # Do the DNS Query
-                status, _ = dig(query, 'A')
-                if status != 'ok':
-                    continue
+                to_check.append((item, blacklist, query))
 
-                # Try to get the reason
-                details = []
-                status, answers = dig(query, 'TXT')
-                reason = "-"
-                if status == 'ok':
-                    reason = ', '.join(answers)
-                    details.append("diagnosis_mail_blacklist_reason")
-
-                details.append("diagnosis_mail_blacklist_website")
-
-                yield dict(meta={"test": "mail_blacklist", "item": item,
-                                 "blacklist": blacklist["dns_server"]},
-                           data={'blacklist_name': blacklist['name'],
-                                 'blacklist_website': blacklist['website'],
-                                 'reason': reason},
-                           status="ERROR",
-                           summary='diagnosis_mail_blacklist_listed_by',
-                           details=details)
+        # Do the DNS Queries all at once (but without hammering each DNSBL)
+        use_cache = not self.args.get("force", False)
+        statuses = dig_many([(q, 'A', bl['dns_server']) for _, bl, q in to_check],
+                            max_parallel_per_group=DNSBL_MAX_PARALLEL_REQUESTS, use_cache=use_cache)
+        listed = [check for check, (status, _) in zip(to_check, statuses) if status == 'ok']
+
+        # Try to get the reason, for the listed items only
+        reasons = dig_many([(q, 'TXT', bl['dns_server']) for _, bl, q in listed],
+                           max_parallel_per_group=DNSBL_MAX_PARALLEL_REQUESTS, use_cache=use_cache)
+
+        for (item, blacklist, query), (status, answers) in zip(listed, reasons):
+
+            details = []
+            reason = "-"
+            if status == 'ok':
+                reason = ', '.join(answers)
+                details.append("diagnosis_mail_blacklist_reason")
+
+            details.append("diagnosis_mail_blacklist_website")
+
+            yield dict(meta={"test": "mail_blacklist", "item": item,
+                             "blacklist": blacklist["dns_server"]},
+                       data={'blacklist_name': blacklist['name'],
+                             'blacklist_website': blacklist['website'],
+                             'reason': reason},
+                       status="ERROR",
+                       summary='diagnosis_mail_blacklist_listed_by',
+                       details=details)
 
     def check_queue(self):
         """
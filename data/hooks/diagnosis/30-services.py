@@ -10,6 +10,7 @@ class ServicesDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 300
     dependencies = []
+    invalidated_by = ["app", "configuration"]
 
     def run(self):
 
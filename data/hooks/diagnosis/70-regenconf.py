@@ -12,6 +12,7 @@ class RegenconfDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 300
     dependencies = []
+    invalidated_by = ["configuration"]
 
     def run(self):
 
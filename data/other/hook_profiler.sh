@@ -0,0 +1,15 @@
+# Sourced (through BASH_ENV) by the scripts run with profiling enabled :
+# prefix each traced command with the time at which it started and the stack
+# of functions it runs in (c.f. src/yunohost/utils/profiler.py), then turn
+# xtrace on (such that these lines aren't traced themselves)
+unset BASH_ENV
+if [ "${BASH_VERSINFO[0]}" -ge 5 ]
+then
+    PS4=$'+\x1f${EPOCHREALTIME}\x1f${FUNCNAME[*]:-}\x1f${BASH_LINENO[*]:-}\x1f${LINENO}\x1f '
+else
+    # No EPOCHREALTIME before bash 5 (e.g. on Stretch) and forking 'date' for
+    # each command would be way too slow : leave the time empty, the profiler
+    # then uses the time at which it receives the line
+    PS4=$'+\x1f\x1f${FUNCNAME[*]:-}\x1f${BASH_LINENO[*]:-}\x1f${LINENO}\x1f '
+fi
+set -o xtrace
@@ -24,27 +24,35 @@
     Manage apps
 """
 import os
+import copy
 import toml
 import json
+import hashlib
 import shutil
 import yaml
 import time
 import re
+import bisect
+import unicodedata
 import urlparse
 import subprocess
+import tempfile
+import threading
 import glob
 import urllib
+import requests
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from moulinette import msignals, m18n, msettings
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.network import download_json
 from moulinette.utils.filesystem import read_file, read_json, read_toml, read_yaml, write_to_file, write_to_json, write_to_yaml, chmod, chown, mkdir
 
 from yunohost.service import service_status, _run_service_command
-from yunohost.utils import packages
+from yunohost.utils import packages, apps_registry
 from yunohost.utils.error import YunohostError
-from yunohost.log import is_unit_operation, OperationLogger
+from yunohost.utils.filesystem import write_to_file_atomically
+from yunohost.log import is_unit_operation, OperationLogger, defer_to_end_of_operation
 
 logger = getActionLogger('yunohost.app')
 
@@ -52,12 +60,18 @@ APPS_PATH = '/usr/share/yunohost/apps'
 APPS_SETTING_PATH = '/etc/yunohost/apps/'
 INSTALL_TMP = '/var/cache/yunohost'
 APP_TMP_FOLDER = INSTALL_TMP + '/from_file'
+APP_PACKAGES_CACHE = INSTALL_TMP + '/app_packages'
+APP_PACKAGES_CACHE_MAX_SIZE = 200 * 1024 * 1024
+APP_PACKAGES_MAX_PARALLEL_DOWNLOADS = 4
 
 APPS_CATALOG_CACHE = '/var/cache/yunohost/repo'
 APPS_CATALOG_CONF = '/etc/yunohost/apps_catalog.yml'
 APPS_CATALOG_CRON_PATH = "/etc/cron.daily/yunohost-fetch-apps-catalog"
 APPS_CATALOG_API_VERSION = 2
 APPS_CATALOG_DEFAULT_URL = "https://app.yunohost.org/default"
+APPS_CATALOG_MAX_PARALLEL_DOWNLOADS = 4
+
+SSOWAT_CONF = '/etc/ssowat/conf.json'
 
 re_github_repo = re.compile(
     r'^(http[s]?://|git@)github.com[/:]'
@@ -70,44 +84,123 @@ re_app_instance_name = re.compile(
 )
 
 
-def app_catalog(full=False, with_categories=False):
+def app_catalog(full=False, with_categories=False, query=None, category=None, subtag=None,
+                level=None, offset=0, limit=None):
     """
     Return a dict of apps available to installation from Yunohost's app catalog
-    """
 
-    # Get app list from catalog cache
-    catalog = _load_apps_catalog()
-    installed_apps = set(_installed_apps())
+    Keyword arguments:
+        full -- Display all details, including the app manifest
+        with_categories -- Also return a list of app categories
+        query -- Only return apps matching these words (in their name,
+                 description, category or subtags)
+        category -- Only return apps from this category
+        subtag -- Only return apps having this subtag
+        level -- Only return apps having at least this level
+        offset -- Skip this number of apps (for pagination)
+        limit -- Maximum number of apps to return
+
+    """
+
+    # N.B. : the catalogs returned by _load_apps_catalog are shared between
+    # calls, so we build new dicts instead of altering them
+
+    # When searching / paginating, only the selected apps are returned (sorted
+    # by relevance), along with the total number of matching apps
+    for name, value in [("offset", offset), ("limit", limit)]:
+        if value is not None and value < 0:
+            raise YunohostError("apps_catalog_invalid_pagination", name=name, value=value)
+
+    searching = any(arg is not None for arg in [query, category, subtag, level, limit]) or offset
+    if searching:
+        selected = _search_apps_catalog(query=query, category=category, subtag=subtag, level=level)
+        total = len(selected)
+        offset = offset or 0
+        selected = selected[offset:offset + limit] if limit is not None else selected[offset:]
+
+    # Without --full, we only need the slim 'summary' projection of the catalog
+    if not full:
+        catalog = _load_apps_catalog(projection="summary")
 
-    # Trim info for apps if not using --full
-    for app, infos in catalog["apps"].items():
-        infos["installed"] = app in installed_apps
+        def _app_infos(app, infos):
+            return {"description": _value_for_locale(infos["description"]),
+                    "level": infos["level"]}
 
-        infos["manifest"]["description"] = _value_for_locale(infos['manifest']['description'])
+        categories = [{"id": c["id"],
+                       "description": _value_for_locale(c["description"])}
+                      for c in catalog["categories"]]
+    else:
+        catalog = _load_apps_catalog()
+        installed_apps = set(_installed_apps())
+
+        def _app_infos(app, infos):
+            infos = dict(infos)
+            infos["installed"] = app in installed_apps
+            infos["manifest"] = dict(infos["manifest"])
+            infos["manifest"]["description"] = _value_for_locale(infos['manifest']['description'])
+            return infos
+
+        categories = []
+        for category_infos in catalog["categories"]:
+            category_infos = dict(category_infos)
+            category_infos["title"] = _value_for_locale(category_infos["title"])
+            category_infos["description"] = _value_for_locale(category_infos["description"])
+            if "subtags" in category_infos:
+                category_infos["subtags"] = [dict(s, title=_value_for_locale(s["title"]))
+                                             for s in category_infos["subtags"]]
+            categories.append(category_infos)
+
+    if searching:
+        apps = OrderedDict((app, _app_infos(app, catalog["apps"][app])) for app in selected)
+    else:
+        apps = {app: _app_infos(app, infos) for app, infos in catalog["apps"].items()}
 
-        if not full:
-            catalog["apps"][app] = {
-                "description": infos['manifest']['description'],
-                "level": infos["level"],
-            }
+    output = {"apps": apps}
+    if with_categories:
+        output["categories"] = categories
+    if searching:
+        output["total"] = total
 
-    # Trim info for categories if not using --full
-    for category in catalog["categories"]:
-        category["title"] = _value_for_locale(category["title"])
-        category["description"] = _value_for_locale(category["description"])
-        for subtags in category.get("subtags", []):
-            subtags["title"] = _value_for_locale(subtags["title"])
+    return output
 
-    if not full:
-        catalog["categories"] = [{"id": c["id"],
-                                  "description": c["description"]}
-                                 for c in catalog["categories"]]
 
-    if not with_categories:
-        return {"apps": catalog["apps"]}
-    else:
-        return {"apps": catalog["apps"], "categories": catalog["categories"]}
+def _search_apps_catalog(query=None, category=None, subtag=None, level=None):
+    """
+    Return the ids of the apps of the catalog matching the given criterias,
+    using the search index built along with the merged catalog
+    (c.f. _build_apps_catalog_search_index)
+
+    Each word of the query has to match (as a prefix) a word of the app
+    id / name, description, category or subtags. Apps are sorted by relevance
+    (matches in the name weighting more than in the description), then by id.
+    """
+
+    search = _load_apps_catalog(projection="search")
+
+    scores = {}
+    for app, infos in search["apps"].items():
+        if category is not None and infos["category"] != category:
+            continue
+        if subtag is not None and subtag not in infos["subtags"]:
+            continue
+        if level is not None and not (isinstance(infos["level"], int) and infos["level"] >= level):
+            continue
+        scores[app] = 0
 
+    tokens = search["tokens"]
+    for word in _search_tokens(query or ""):
+
+        # Tokens are sorted, so the ones starting with this word are contiguous
+        word_scores = {}
+        i = bisect.bisect_left(tokens, word)
+        while i < len(tokens) and tokens[i].startswith(word):
+            for app, weight in search["postings"][i].items():
+                word_scores[app] = max(word_scores.get(app, 0), weight)
+            i += 1
+
+        scores = {app: score + word_scores[app] for app, score in scores.items() if app in word_scores}
+
+    return sorted(scores, key=lambda app: (-scores[app], app))
 
 
 # Old legacy function...
@@ -223,6 +316,40 @@ def app_map(app=None, raw=False, user=None):
     else:
         apps = os.listdir(APPS_SETTING_PATH)
 
+    for app_id, perm_name, perm_domain, perm_path, perm_label, allowed_users in _app_map_entries(apps, permissions, with_users=bool(user)):
+
+        # If we're building the map for a specific user, check the user
+        # actually is allowed for this specific perm
+        if user and user not in allowed_users:
+            continue
+
+        if raw:
+            if perm_domain not in result:
+                result[perm_domain] = {}
+            result[perm_domain][perm_path] = {
+                'label': perm_label,
+                'id': app_id
+            }
+        else:
+            result[perm_domain + perm_path] = perm_label
+
+    return result
+
+
+def _app_map_entries(apps, permissions, with_users=False):
+    """
+    Yield the entries of the app map, that is, for each url-based permission
+    of each (web)app, a tuple like :
+        (app_id, perm_name, perm_domain, perm_path, perm_label, allowed_users)
+
+    Keyword argument:
+        apps -- List of app ids to map
+        permissions -- Permissions as returned by user_permission_list(full=True)
+        with_users -- Also compute the set of users allowed on each entry
+                      (otherwise allowed_users is None)
+
+    """
+
     for app_id in apps:
         app_settings = _get_app_settings(app_id)
         if not app_settings:
@@ -237,13 +364,11 @@ def app_map(app=None, raw=False, user=None):
         if 'no_sso' in app_settings:  # I don't think we need to check for the value here
             continue
         # Users must at least have access to the main permission to have access to extra permissions
-        if user:
+        if with_users:
             if not app_id + ".main" in permissions:
                 logger.warning("Uhoh, no main permission was found for app %s ... sounds like an app was only partially removed due to another bug :/" % app_id)
                 continue
-            main_perm = permissions[app_id + ".main"]
-            if user not in main_perm["corresponding_users"]:
-                continue
+            main_perm_users = set(permissions[app_id + ".main"]["corresponding_users"])
 
         domain = app_settings['domain']
         path = app_settings['path'].rstrip('/')
@@ -268,10 +393,6 @@ def app_map(app=None, raw=False, user=None):
 
         this_app_perms = {p: i for p, i in permissions.items() if p.startswith(app_id + ".") and i["url"]}
         for perm_name, perm_info in this_app_perms.items():
-            # If we're building the map for a specific user, check the user
-            # actually is allowed for this specific perm
-            if user and user not in perm_info["corresponding_users"]:
-                continue
             if perm_info["url"].startswith("re:"):
                 # Here, we have an issue if the chosen url is a regex, because
                 # the url we want to add to the dict is going to be turned into
@@ -305,17 +426,12 @@ def app_map(app=None, raw=False, user=None):
                 # e.g. if perm_name is wordpress.admin, we want "Blog (Admin)" (where Blog is the label of this app)
                 perm_label = "%s (%s)" % (label, perm_name.rsplit(".")[-1].replace("_", " ").title())
 
-            if raw:
-                if domain not in result:
-                    result[perm_domain] = {}
-                result[perm_domain][perm_path] = {
-                    'label': perm_label,
-                    'id': app_id
-                }
+            if with_users:
+                allowed_users = main_perm_users.intersection(perm_info["corresponding_users"])
             else:
-                result[perm_domain + perm_path] = perm_label
+                allowed_users = None
 
-    return result
+            yield app_id, perm_name, perm_domain, perm_path, perm_label, allowed_users
 
 
 @is_unit_operation()
@@ -439,7 +555,7 @@ def app_change_url(operation_logger, app, domain, path):
     hook_callback('post_app_change_url', args=args_list, env=env_dict)
 
 
-def app_upgrade(app=[], url=None, file=None):
+def app_upgrade(app=[], url=None, file=None, profile=False):
     """
     Upgrade app
 
@@ -447,6 +563,7 @@ def app_upgrade(app=[], url=None, file=None):
         file -- Folder or tarball for upgrade
         app -- App(s) to upgrade (default all)
         url -- Git url to fetch for upgrade
+        profile -- Profile the upgrade scripts (results are saved next to the operation logs)
 
     """
     from yunohost.hook import hook_add, hook_remove, hook_exec, hook_callback
@@ -474,11 +591,23 @@ def app_upgrade(app=[], url=None, file=None):
     if len(apps) > 1:
         logger.info(m18n.n("app_upgrade_several_apps", apps=", ".join(apps)))
 
+    download_time = 0
+    script_time = 0
+
+    # Download the packages of the apps to upgrade from the catalog all at
+    # once, such that the upgrades below just pick them from the packages cache
+    if not file and not url:
+        download_start = time.time()
+        _prefetch_app_packages([app_ for app_ in apps
+                                if app_info(app_, full=True)["upgradable"] == "yes"])
+        download_time += time.time() - download_start
+
     for number, app_instance_name in enumerate(apps):
         logger.info(m18n.n('app_upgrade_app_name', app=app_instance_name))
 
         app_dict = app_info(app_instance_name, full=True)
 
+        download_start = time.time()
         if file and isinstance(file, dict):
             # We use this dirty hack to test chained upgrades in unit/functional tests
             manifest, extracted_app_folder = _extract_app_from_file(file[app_instance_name])
@@ -494,6 +623,7 @@ def app_upgrade(app=[], url=None, file=None):
         else:
             logger.success(m18n.n('app_already_up_to_date', app=app_instance_name))
             continue
+        download_time += time.time() - download_start
 
         # Check requirements
         _check_manifest_requirements(manifest, app_instance_name=app_instance_name)
@@ -533,9 +663,12 @@ def app_upgrade(app=[], url=None, file=None):
 
         # Execute the app upgrade script
         upgrade_failed = True
+        script_start = time.time()
         try:
             upgrade_retcode = hook_exec(extracted_app_folder + '/scripts/upgrade',
-                                        args=args_list, env=env_dict)[0]
+                                        args=args_list, env=env_dict,
+                                        profile=operation_logger.profile_path if profile else None)[0]
+            script_time += time.time() - script_start
 
             upgrade_failed = True if upgrade_retcode != 0 else False
             if upgrade_failed:
@@ -617,11 +750,15 @@ def app_upgrade(app=[], url=None, file=None):
 
     permission_sync_to_user()
 
+    logger.info(m18n.n('app_upgrade_time_spent',
+                       download_time="%.1f" % download_time,
+                       script_time="%.1f" % script_time))
     logger.success(m18n.n('upgrade_complete'))
 
 
 @is_unit_operation()
-def app_install(operation_logger, app, label=None, args=None, no_remove_on_failure=False, force=False):
+def app_install(operation_logger, app, label=None, args=None, no_remove_on_failure=False, force=False,
+                profile=False):
     """
     Install apps
 
@@ -631,6 +768,7 @@ def app_install(operation_logger, app, label=None, args=None, no_remove_on_failu
         args -- Serialize arguments for app installation
         no_remove_on_failure -- Debug option to avoid removing the app on a failed installation
         force -- Do not ask for confirmation when installing experimental / low-quality apps
+        profile -- Profile the install script (results are saved next to the operation log)
     """
 
     from yunohost.hook import hook_add, hook_remove, hook_exec, hook_callback
@@ -800,7 +938,8 @@ def app_install(operation_logger, app, label=None, args=None, no_remove_on_failu
     try:
         install_retcode = hook_exec(
             os.path.join(extracted_app_folder, 'scripts/install'),
-            args=args_list, env=env_dict
+            args=args_list, env=env_dict,
+            profile=operation_logger.profile_path if profile else None
         )[0]
         # "Common" app install failure : the script failed and returned exit code != 0
         install_failed = True if install_retcode != 0 else False
@@ -1281,14 +1420,47 @@ def app_ssowatconf():
 
 
     """
+
+    # This is called from many places (permission sync, domain add/remove,
+    # user update, ...) sometimes several times in the same operation, so
+    # we only actually regenerate the conf once at the end of the operation
+    defer_to_end_of_operation("app_ssowatconf", _regen_ssowatconf)
+
+
+def _regen_ssowatconf():
+
     from yunohost.domain import domain_list, _get_maindomain
     from yunohost.user import user_list
     from yunohost.permission import user_permission_list
+    from yunohost.settings import settings_get
 
     main_domain = _get_maindomain()
     domains = domain_list()['domains']
     all_permissions = user_permission_list(full=True)['permissions']
 
+    # In the legacy format, each user gets its full app map (url -> label)
+    # In the compact format, each user only gets the list of permissions ids
+    # for which a tile should be displayed, and the url/label of these tiles
+    # are stored only once in the 'permissions' section
+    compact_format = settings_get("ssowat.conf.format") == "compact"
+
+    # Build the app map of every user in a single pass over apps and
+    # permissions (instead of calling app_map(user=...) for each user, which
+    # re-fetches all permissions and re-reads all app settings every time)
+    # N.B. : this has to be done before the loop below which alters the
+    # permission urls in all_permissions...
+    users = {username: [] if compact_format else {} for username in user_list()['users'].keys()}
+    tiles = {}
+    for _, perm_name, perm_domain, perm_path, perm_label, allowed_users in _app_map_entries(_installed_apps(), all_permissions, with_users=True):
+        tiles[perm_name] = {"label": perm_label, "tile_url": perm_domain + perm_path}
+        for username in allowed_users:
+            if username not in users:
+                continue
+            if compact_format:
+                users[username].append(perm_name)
+            else:
+                users[username][perm_domain + perm_path] = perm_label
+
     skipped_urls = []
     skipped_regex = []
     unprotected_urls = []
@@ -1304,7 +1476,7 @@ def app_ssowatconf():
 
     for app in _installed_apps():
 
-        app_settings = read_yaml(APPS_SETTING_PATH + app + '/settings.yml')
+        app_settings = _get_app_settings(app)
 
         if 'domain' not in app_settings:
             continue
@@ -1380,12 +1552,19 @@ def app_ssowatconf():
     skipped_regex.append("^[^/]*/%.well%-known/autoconfig/mail/config%-v1%.1%.xml.*$")
 
 
-    permissions_per_url = {}
+    permissions = {}
     for perm_name, perm_info in all_permissions.items():
         # Ignore permissions for which there's no url defined
         if not perm_info["url"]:
             continue
-        permissions_per_url[perm_info["url"]] = perm_info['corresponding_users']
+        if compact_format:
+            permissions[perm_name] = {
+                "url": perm_info["url"],
+                "users": perm_info['corresponding_users'],
+            }
+            permissions[perm_name].update(tiles.get(perm_name, {}))
+        else:
+            permissions[perm_info["url"]] = perm_info['corresponding_users']
 
 
     conf_dict = {
@@ -1406,13 +1585,29 @@ def app_ssowatconf():
         'protected_regex': protected_regex,
         'redirected_urls': redirected_urls,
         'redirected_regex': redirected_regex,
-        'users': {username: app_map(user=username)
-                  for username in user_list()['users'].keys()},
-        'permissions': permissions_per_url,
+        'users': users,
+        'permissions': permissions,
     }
 
-    with open('/etc/ssowat/conf.json', 'w+') as f:
-        json.dump(conf_dict, f, sort_keys=True, indent=4)
+    if compact_format:
+        conf_dict['conf_format'] = "compact"
+
+    if compact_format:
+        conf = json.dumps(conf_dict, sort_keys=True, separators=(',', ':'))
+    else:
+        conf = json.dumps(conf_dict, sort_keys=True, indent=4)
+
+    # Don't rewrite the file (and trigger a reload of it on SSOwat's side)
+    # if nothing changed
+    if os.path.exists(SSOWAT_CONF):
+        with open(SSOWAT_CONF) as f:
+            current_conf_hash = hashlib.sha256(f.read()).hexdigest()
+        if current_conf_hash == hashlib.sha256(conf).hexdigest():
+            logger.debug("SSOwat configuration is already up to date")
+            return
+
+    # Write it atomically such that nginx never reads a half-written conf
+    write_to_file_atomically(SSOWAT_CONF, conf)
 
     logger.debug(m18n.n('ssowat_conf_generated'))
 
@@ -1448,7 +1643,6 @@ def app_action_run(operation_logger, app, action, args=None):
     logger.warning(m18n.n('experimental_feature'))
 
     from yunohost.hook import hook_exec
-    import tempfile
 
     # will raise if action doesn't exist
     actions = app_action_list(app)["actions"]
@@ -1882,12 +2076,8 @@ def _get_app_settings(app_id):
     if not _is_installed(app_id):
         raise YunohostError('app_not_installed', app=app_id, all_apps=_get_all_installed_apps_id())
     try:
-        with open(os.path.join(
-                APPS_SETTING_PATH, app_id, 'settings.yml')) as f:
-            settings = yaml.load(f)
-        # If label contains unicode char, this may later trigger issues when building strings...
-        # FIXME: this should be propagated to read_yaml so that this fix applies everywhere I think...
-        settings = {k:_encode_string(v) for k,v in settings.items()}
+        settings = apps_registry.get_parsed_file(os.path.join(APPS_SETTING_PATH, app_id, 'settings.yml'),
+                                                 _read_app_settings_file)
         if app_id == settings['id']:
             return settings
     except (IOError, TypeError, KeyError):
@@ -1896,6 +2086,15 @@ def _get_app_settings(app_id):
     return {}
 
 
+def _read_app_settings_file(path):
+
+    with open(path) as f:
+        settings = yaml.load(f)
+    # If label contains unicode char, this may later trigger issues when building strings...
+    # FIXME: this should be propagated to read_yaml so that this fix applies everywhere I think...
+    return {k:_encode_string(v) for k,v in settings.items()}
+
+
 def _set_app_settings(app_id, settings):
     """
     Set settings of an app
@@ -2074,30 +2273,43 @@ def _get_manifest_of_app(path):
     #     ¦   ¦   },
 
     if os.path.exists(os.path.join(path, "manifest.toml")):
-        manifest_toml = read_toml(os.path.join(path, "manifest.toml"))
+        manifest_path = os.path.join(path, "manifest.toml")
+        parser = _read_manifest_toml
+    elif os.path.exists(os.path.join(path, "manifest.json")):
+        manifest_path = os.path.join(path, "manifest.json")
+        parser = read_json
+    else:
+        raise YunohostError("There doesn't seem to be any manifest file in %s ... It looks like an app was not correctly installed/removed." % path, raw_msg=True)
 
-        manifest = manifest_toml.copy()
+    # Manifests of installed apps are indexed in the apps registry
+    if os.path.abspath(path).startswith(os.path.abspath(APPS_SETTING_PATH) + "/"):
+        return apps_registry.get_parsed_file(manifest_path, parser)
+    else:
+        return parser(manifest_path)
 
-        if "arguments" not in manifest:
-            return manifest
 
-        if "install" not in manifest["arguments"]:
-            return manifest
+def _read_manifest_toml(path):
 
-        install_arguments = []
-        for name, values in manifest_toml.get("arguments", {}).get("install", {}).items():
-            args = values.copy()
-            args["name"] = name
+    manifest_toml = read_toml(path)
 
-            install_arguments.append(args)
+    manifest = manifest_toml.copy()
 
-        manifest["arguments"]["install"] = install_arguments
+    if "arguments" not in manifest:
+        return manifest
 
+    if "install" not in manifest["arguments"]:
         return manifest
-    elif os.path.exists(os.path.join(path, "manifest.json")):
-        return read_json(os.path.join(path, "manifest.json"))
-    else:
-        raise YunohostError("There doesn't seem to be any manifest file in %s ... It looks like an app was not correctly installed/removed." % path, raw_msg=True)
+
+    install_arguments = []
+    for name, values in manifest_toml.get("arguments", {}).get("install", {}).items():
+        args = values.copy()
+        args["name"] = name
+
+        install_arguments.append(args)
+
+    manifest["arguments"]["install"] = install_arguments
+
+    return manifest
 
 
 def _get_git_last_commit_hash(repository, reference='HEAD'):
@@ -2124,6 +2336,10 @@ def _fetch_app_from_git(app):
     """
     Unzip or untar application tarball in APP_TMP_FOLDER
 
+    Packages are kept in a cache indexed by (repository url, commit), such that
+    installing / upgrading to the same version of an app (e.g. several
+    instances of the same app) doesn't download it again
+
     Keyword arguments:
         app -- App_id or git repo URL
 
@@ -2139,8 +2355,6 @@ def _fetch_app_from_git(app):
     if os.path.exists(app_tmp_archive):
         os.remove(app_tmp_archive)
 
-    logger.debug(m18n.n('downloading'))
-
     if ('@' in app) or ('http://' in app) or ('https://' in app):
         url = app
         branch = 'master'
@@ -2152,9 +2366,32 @@ def _fetch_app_from_git(app):
                 owner=github_repo.group('owner'),
                 repo=github_repo.group('repo'),
             )
+        else:
+            tree_index = url.rfind('/tree/')
+            if tree_index > 0:
+                url = url[:tree_index]
+                branch = app[tree_index + 6:]
+
+        # Store remote repository info into the returned manifest
+        remote = {'type': 'git', 'url': url, 'branch': branch}
+        try:
+            revision = _get_git_last_commit_hash(url, branch)
+        except Exception as e:
+            logger.debug("cannot get last commit hash because: %s ", e)
+            revision = None
+        else:
+            remote['revision'] = revision
+
+        cached_app_folder = _get_app_package_from_cache(url, revision)
+        if cached_app_folder:
+            manifest, extracted_app_folder = _get_manifest_of_fetched_app(cached_app_folder)
+        elif github_repo:
+            # (N.B. : we download the archive of the commit rather than of
+            # the branch, such that it really corresponds to this commit)
             tarball_url = "{url}/archive/{tree}.zip".format(
-                url=url, tree=branch
+                url=url, tree=revision if _is_git_commit_hash(revision) else branch
             )
+            logger.debug(m18n.n('downloading'))
             try:
                 subprocess.check_call([
                     'wget', '-qO', app_tmp_archive, tarball_url])
@@ -2164,11 +2401,9 @@ def _fetch_app_from_git(app):
             else:
                 manifest, extracted_app_folder = _extract_app_from_file(
                     app_tmp_archive, remove=True)
+            _add_app_package_to_cache(url, revision, extracted_app_folder)
         else:
-            tree_index = url.rfind('/tree/')
-            if tree_index > 0:
-                url = url[:tree_index]
-                branch = app[tree_index + 6:]
+            logger.debug(m18n.n('downloading'))
             try:
                 # We use currently git 2.1 so we can't use --shallow-submodules
                 # option. When git will be in 2.9 (with the new debian version)
@@ -2181,6 +2416,9 @@ def _fetch_app_from_git(app):
                     'git', 'reset', '--hard', branch
                 ], cwd=extracted_app_folder)
                 manifest = _get_manifest_of_app(extracted_app_folder)
+                cloned_revision = subprocess.check_output([
+                    'git', 'rev-parse', 'HEAD'
+                ], cwd=extracted_app_folder).strip()
             except subprocess.CalledProcessError:
                 raise YunohostError('app_sources_fetch_failed')
             except ValueError as e:
@@ -2188,14 +2426,11 @@ def _fetch_app_from_git(app):
             else:
                 logger.debug(m18n.n('done'))
 
-        # Store remote repository info into the returned manifest
-        manifest['remote'] = {'type': 'git', 'url': url, 'branch': branch}
-        try:
-            revision = _get_git_last_commit_hash(url, branch)
-        except Exception as e:
-            logger.debug("cannot get last commit hash because: %s ", e)
-        else:
-            manifest['remote']['revision'] = revision
+            # (The branch may have moved since we asked for its last commit)
+            if cloned_revision == revision:
+                _add_app_package_to_cache(url, revision, extracted_app_folder)
+
+        manifest['remote'] = remote
     else:
         app_dict = _load_apps_catalog()["apps"]
 
@@ -2206,15 +2441,21 @@ def _fetch_app_from_git(app):
         elif 'git' not in app_dict[app_id]:
             raise YunohostError('app_unsupported_remote_type')
 
-        app_info = app_dict[app_id]
+        # (N.B. : the loaded catalog is shared, so we work on a copy)
+        app_info = copy.deepcopy(app_dict[app_id])
         app_info['manifest']['lastUpdate'] = app_info['lastUpdate']
         manifest = app_info['manifest']
         url = app_info['git']['url']
+        revision = str(app_info['git']['revision'])
 
-        if 'github.com' in url:
+        cached_app_folder = _get_app_package_from_cache(url, revision)
+        if cached_app_folder:
+            manifest, extracted_app_folder = _get_manifest_of_fetched_app(cached_app_folder)
+        elif 'github.com' in url:
             tarball_url = "{url}/archive/{tree}.zip".format(
-                url=url, tree=app_info['git']['revision']
+                url=url, tree=revision
             )
+            logger.debug(m18n.n('downloading'))
             try:
                 subprocess.check_call([
                     'wget', '-qO', app_tmp_archive, tarball_url])
@@ -2224,14 +2465,15 @@ def _fetch_app_from_git(app):
             else:
                 manifest, extracted_app_folder = _extract_app_from_file(
                     app_tmp_archive, remove=True)
+            _add_app_package_to_cache(url, revision, extracted_app_folder)
         else:
+            logger.debug(m18n.n('downloading'))
             try:
                 subprocess.check_call([
                     'git', 'clone', app_info['git']['url'],
                     '-b', app_info['git']['branch'], extracted_app_folder])
                 subprocess.check_call([
-                    'git', 'reset', '--hard',
-                    str(app_info['git']['revision'])
+                    'git', 'reset', '--hard', revision
                 ], cwd=extracted_app_folder)
                 manifest = _get_manifest_of_app(extracted_app_folder)
             except subprocess.CalledProcessError:
@@ -2240,6 +2482,7 @@ def _fetch_app_from_git(app):
                 raise YunohostError('app_manifest_invalid', error=e)
             else:
                 logger.debug(m18n.n('done'))
+            _add_app_package_to_cache(url, revision, extracted_app_folder)
 
         # Store remote repository info into the returned manifest
         manifest['remote'] = {
@@ -2252,6 +2495,227 @@ def _fetch_app_from_git(app):
     return manifest, extracted_app_folder
 
 
+def _prefetch_app_packages(apps):
+    """
+    Concurrently download the packages of these apps (at the revision listed
+    in the catalog) into the packages cache, such that the subsequent
+    _fetch_app_from_git calls don't have to wait for the network
+
+    Failures are only logged : the package will then be downloaded again (and
+    the error properly reported) when actually fetching the app
+
+    Keyword arguments:
+        apps -- List of app instance names
+    """
+
+    catalog = _load_apps_catalog()["apps"]
+
+    remotes = []
+    for app in apps:
+        app_id, _ = _parse_app_instance_name(app)
+        if 'git' not in catalog.get(app_id, {}):
+            continue
+        remote = (catalog[app_id]['git']['url'],
+                  catalog[app_id]['git']['branch'],
+                  str(catalog[app_id]['git']['revision']))
+        # (Several instances of the same app only need one download)
+        if remote not in remotes and _is_git_commit_hash(remote[2]) \
+           and not os.path.exists(_app_package_cache_entry(remote[0], remote[2])):
+            remotes.append(remote)
+
+    if not remotes:
+        return
+
+    logger.info(m18n.n('app_upgrade_prefetching', apps=", ".join(apps)))
+
+    if not os.path.exists(INSTALL_TMP):
+        os.makedirs(INSTALL_TMP)
+
+    def _prefetch(remote):
+        try:
+            _prefetch_app_package(*remote)
+        except Exception as e:
+            logger.debug("Could not prefetch the package of %s@%s : %s" % (remote[0], remote[2], e))
+
+    pool = ThreadPool(min(len(remotes), APP_PACKAGES_MAX_PARALLEL_DOWNLOADS))
+    try:
+        pool.map(_prefetch, remotes)
+    finally:
+        pool.close()
+
+
+def _prefetch_app_package(url, branch, revision):
+    """
+    Download and validate the package of an app at this revision into the
+    packages cache, using a private working directory (as opposed to
+    APP_TMP_FOLDER) such that several packages can be downloaded at once
+    """
+
+    workdir = tempfile.mkdtemp(dir=INSTALL_TMP, prefix="prefetch-")
+    try:
+        extracted_app_folder = os.path.join(workdir, "package")
+        if 'github.com' in url:
+            archive = os.path.join(workdir, "package.zip")
+            subprocess.check_call(['wget', '-qO', archive,
+                                   "{url}/archive/{tree}.zip".format(url=url, tree=revision)])
+            subprocess.check_call(['unzip', '-q', archive, '-d', extracted_app_folder])
+            if len(os.listdir(extracted_app_folder)) == 1:
+                extracted_app_folder = os.path.join(extracted_app_folder, os.listdir(extracted_app_folder)[0])
+        else:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['git', 'clone', url, '-b', branch, extracted_app_folder],
+                                      stdout=devnull, stderr=devnull)
+                subprocess.check_call(['git', 'reset', '--hard', revision],
+                                      cwd=extracted_app_folder, stdout=devnull, stderr=devnull)
+
+        # Make sure the package looks sane before caching it
+        _get_manifest_of_app(extracted_app_folder)
+
+        _add_app_package_to_cache(url, revision, extracted_app_folder)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _is_git_commit_hash(revision):
+
+    return bool(revision) and re.match(r'^[0-9a-f]{40}$', revision) is not None
+
+
+def _app_package_cache_entry(url, revision):
+
+    key = hashlib.sha256(_encode_string("%s@%s" % (url, revision))).hexdigest()
+    return os.path.join(APP_PACKAGES_CACHE, key)
+
+
+def _get_app_package_from_cache(url, revision):
+    """
+    Copy the package of this app at this commit from the packages cache to
+    APP_TMP_FOLDER, if it's there
+
+    (N.B. : the package is copied rather than hardlinked, as the working copy
+    gets patched and chown'ed in place during the install / upgrade)
+
+    Returns:
+        The path of the copy, or None if the package is not in the cache
+    """
+
+    # Branches / tags may move, only commits identify a version of a package
+    if not _is_git_commit_hash(revision):
+        return None
+
+    entry = _app_package_cache_entry(url, revision)
+    if not os.path.isdir(entry):
+        return None
+
+    try:
+        # Only trust packages cached by ourselves
+        if os.stat(entry).st_uid != os.getuid():
+            raise Exception("unexpected owner for %s" % entry)
+        meta = read_json(os.path.join(entry, "meta.json"))
+        if meta.get("url") != url or meta.get("revision") != revision:
+            raise Exception("%s doesn't correspond to %s@%s" % (entry, url, revision))
+
+        if os.path.exists(APP_TMP_FOLDER):
+            shutil.rmtree(APP_TMP_FOLDER)
+        subprocess.check_call(['cp', '-a', os.path.join(entry, "package"), APP_TMP_FOLDER])
+    except Exception as e:
+        logger.debug("Discarding the cached package of %s@%s : %s" % (url, revision, e))
+        shutil.rmtree(entry, ignore_errors=True)
+        return None
+
+    # Keep track of when the package was last used, for the LRU eviction
+    os.utime(os.path.join(entry, "meta.json"), None)
+
+    logger.debug("Using the cached package of %s@%s" % (url, revision))
+
+    return APP_TMP_FOLDER
+
+
+def _get_manifest_of_fetched_app(extracted_app_folder):
+
+    try:
+        manifest = _get_manifest_of_app(extracted_app_folder)
+    except ValueError as e:
+        raise YunohostError('app_manifest_invalid', error=e)
+
+    manifest['lastUpdate'] = int(time.time())
+
+    return manifest, extracted_app_folder
+
+
+# Prefetches add packages to the cache from several threads at once
+_app_packages_cache_lock = threading.Lock()
+
+
+def _add_app_package_to_cache(url, revision, extracted_app_folder):
+    """
+    Save a copy of the freshly downloaded package of this app at this commit
+    in the packages cache, then evict the least recently used packages if the
+    cache grew too large
+    """
+
+    if not _is_git_commit_hash(revision):
+        return
+
+    entry = _app_package_cache_entry(url, revision)
+
+    with _app_packages_cache_lock:
+
+        if os.path.exists(entry):
+            return
+
+        tmp_entry = None
+        try:
+            if not os.path.exists(APP_PACKAGES_CACHE):
+                mkdir(APP_PACKAGES_CACHE, mode=0o700, parents=True)
+
+            # Build the entry aside then rename it, such that an entry is
+            # either complete or not there
+            tmp_entry = tempfile.mkdtemp(dir=APP_PACKAGES_CACHE, prefix=".tmp-")
+            subprocess.check_call(['cp', '-a', extracted_app_folder, os.path.join(tmp_entry, "package")])
+            size = sum(os.lstat(os.path.join(root, f)).st_size
+                       for root, dirs, files in os.walk(tmp_entry)
+                       for f in files)
+            write_to_json(os.path.join(tmp_entry, "meta.json"), {"url": url, "revision": revision, "size": size})
+            os.rename(tmp_entry, entry)
+        except Exception as e:
+            logger.debug("Could not add the package of %s@%s to the cache : %s" % (url, revision, e))
+            if tmp_entry:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+
+        _prune_app_packages_cache()
+
+
+def _prune_app_packages_cache(max_size=None):
+    """
+    Remove the least recently used packages from the cache until its total
+    size is below max_size (APP_PACKAGES_CACHE_MAX_SIZE by default)
+    """
+
+    if max_size is None:
+        max_size = APP_PACKAGES_CACHE_MAX_SIZE
+
+    entries = []
+    for name in os.listdir(APP_PACKAGES_CACHE):
+        entry = os.path.join(APP_PACKAGES_CACHE, name)
+        meta_file = os.path.join(entry, "meta.json")
+        try:
+            entries.append((os.path.getmtime(meta_file), read_json(meta_file)["size"], entry))
+        except Exception:
+            # Unreadable or incomplete entry (such as a leftover of an
+            # interrupted copy)
+            shutil.rmtree(entry, ignore_errors=True)
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_size <= max_size:
+            break
+        logger.debug("Removing %s from the packages cache" % entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
+
+
 def _installed_instance_number(app, last=False):
     """
     Check if application is installed and return instance number
@@ -2714,6 +3178,13 @@ def _update_apps_catalog():
 
     And store it in :
         /var/cache/yunohost/repo/default.json
+
+    The apps catalogs are fetched concurrently, and using the HTTP
+    validators (ETag / Last-Modified) saved during the previous fetch, such
+    that an apps catalog which didn't change is not re-downloaded.
+
+    Then all the apps catalogs are merged into a single snapshot (and its
+    projections) c.f. _build_merged_apps_catalog
     """
 
     apps_catalog_list = _read_apps_catalog_list()
@@ -2725,15 +3196,33 @@ def _update_apps_catalog():
         logger.debug("Initialize folder for apps catalog cache")
         mkdir(APPS_CATALOG_CACHE, mode=0o750, parents=True, uid='root')
 
-    for apps_catalog in apps_catalog_list:
-        apps_catalog_id = apps_catalog["id"]
-        actual_api_url = _actual_apps_catalog_api_url(apps_catalog["url"])
-
-        # Fetch the json
+    def _fetch(apps_catalog):
         try:
-            apps_catalog_content = download_json(actual_api_url)
+            return _fetch_apps_catalog(apps_catalog)
         except Exception as e:
-            raise YunohostError("apps_catalog_failed_to_download", apps_catalog=apps_catalog_id, error=str(e))
+            return e
+
+    if apps_catalog_list:
+        pool = ThreadPool(min(len(apps_catalog_list), APPS_CATALOG_MAX_PARALLEL_DOWNLOADS))
+        try:
+            results = pool.map(_fetch, apps_catalog_list)
+        finally:
+            pool.close()
+    else:
+        results = []
+
+    something_changed = False
+    for apps_catalog, result in zip(apps_catalog_list, results):
+        apps_catalog_id = apps_catalog["id"]
+
+        if isinstance(result, Exception):
+            raise YunohostError("apps_catalog_failed_to_download", apps_catalog=apps_catalog_id, error=str(result))
+
+        apps_catalog_content, validators = result
+
+        if apps_catalog_content is None:
+            logger.debug("Apps catalog %s didn't change since the last update" % apps_catalog_id)
+            continue
 
         # Remember the apps_catalog api version for later
         apps_catalog_content["from_api_version"] = APPS_CATALOG_API_VERSION
@@ -2745,21 +3234,95 @@ def _update_apps_catalog():
         except Exception as e:
             raise YunohostError("Unable to write cache data for %s apps_catalog : %s" % (apps_catalog_id, str(e)))
 
+        # Save the HTTP validators for the next update, along with what
+        # they correspond to
+        validators["url"] = _actual_apps_catalog_api_url(apps_catalog["url"])
+        validators["from_api_version"] = APPS_CATALOG_API_VERSION
+        validators["cache_stamp"] = _apps_catalog_cache_stamps([apps_catalog_id]).get(apps_catalog_id)
+        write_to_json(_apps_catalog_validators_path(apps_catalog_id), validators)
+
+        something_changed = True
+
+    if something_changed or not os.path.exists(_merged_apps_catalog_path()):
+        _build_merged_apps_catalog()
+
     logger.success(m18n.n("apps_catalog_update_success"))
 
 
-def _load_apps_catalog():
+def _fetch_apps_catalog(apps_catalog):
+    """
+    Download the json of an apps catalog
+
+    If the HTTP validators (ETag / Last-Modified) saved during the previous
+    download still correspond to the current cache, a conditional request is
+    made, such that the server can answer 304 if nothing changed.
+
+    Returns:
+        (content, validators) with content being None if the apps catalog
+        didn't change since the previous download
+    """
+
+    url = _actual_apps_catalog_api_url(apps_catalog["url"])
+    validators_file = _apps_catalog_validators_path(apps_catalog["id"])
+
+    headers = {}
+    if os.path.exists(validators_file):
+        try:
+            validators = read_json(validators_file)
+        except Exception as e:
+            logger.debug("Ignoring unreadable validators file %s : %s" % (validators_file, e))
+        else:
+            # Only make a conditional request if the cache is still the one
+            # corresponding to these validators (otherwise we need the content anyway)
+            cache_stamps = _apps_catalog_cache_stamps([apps_catalog["id"]])
+            if validators.get("url") == url \
+               and validators.get("from_api_version") == APPS_CATALOG_API_VERSION \
+               and validators.get("cache_stamp") == cache_stamps.get(apps_catalog["id"]):
+                if validators.get("etag"):
+                    headers["If-None-Match"] = validators["etag"]
+                if validators.get("last_modified"):
+                    headers["If-Modified-Since"] = validators["last_modified"]
+
+    r = requests.get(url, headers=headers, timeout=30)
+
+    if r.status_code == 304 and headers:
+        return None, None
+    if r.status_code != 200:
+        raise Exception("%s %s" % (r.status_code, r.reason))
+
+    validators = {"etag": r.headers.get("ETag"),
+                  "last_modified": r.headers.get("Last-Modified")}
+
+    return json.loads(r.text), validators
+
+
+def _apps_catalog_validators_path(apps_catalog_id):
+
+    # N.B. : hidden file to not be mistaken for the cache file of an apps catalog
+    return "{cache_folder}/.{list}.validators.json".format(cache_folder=APPS_CATALOG_CACHE, list=apps_catalog_id)
+
+
+def _build_merged_apps_catalog():
     """
     Read all the apps catalog cache files and build a single dict (merged_catalog)
-    corresponding to all known apps and categories
+    corresponding to all known apps and categories.
+
+    The merged catalog is saved in a snapshot, along with some slim projections
+    of it which are enough for most usages (c.f. _load_apps_catalog)
     """
 
+    apps_catalog_ids = [L["id"] for L in _read_apps_catalog_list()]
+
+    # Create cache folder if needed
+    if not os.path.exists(APPS_CATALOG_CACHE):
+        mkdir(APPS_CATALOG_CACHE, mode=0o750, parents=True, uid='root')
+
     merged_catalog = {
         "apps": {},
         "categories": []
     }
 
-    for apps_catalog_id in [L["id"] for L in _read_apps_catalog_list()]:
+    for apps_catalog_id in apps_catalog_ids:
 
         # Let's load the json from cache for this catalog
         cache_file = "{cache_folder}/{list}.json".format(cache_folder=APPS_CATALOG_CACHE, list=apps_catalog_id)
@@ -2767,17 +3330,16 @@ def _load_apps_catalog():
         try:
             apps_catalog_content = read_json(cache_file) if os.path.exists(cache_file) else None
         except Exception as e:
-            raise ("Unable to read cache for apps_catalog %s : %s" % (apps_catalog_id, str(e)))
+            raise YunohostError("Unable to read cache for apps_catalog %s : %s" % (apps_catalog_id, str(e)), raw_msg=True)
 
         # Check that the version of the data matches version ....
         # ... otherwise it means we updated yunohost in the meantime
         # and need to update the cache for everything to be consistent
+        # (which will in turn build the merged catalog)
         if not apps_catalog_content or apps_catalog_content.get("from_api_version") != APPS_CATALOG_API_VERSION:
             logger.info(m18n.n("apps_catalog_obsolete_cache"))
             _update_apps_catalog()
-            apps_catalog_content = read_json(cache_file)
-
-        del apps_catalog_content["from_api_version"]
+            return
 
         # Add apps from this catalog to the output
         for app, info in apps_catalog_content["apps"].items():
@@ -2795,7 +3357,169 @@ def _load_apps_catalog():
         # Annnnd categories
         merged_catalog["categories"] += apps_catalog_content["categories"]
 
-    return merged_catalog
+    projections = {
+        None: merged_catalog,
+        # What's needed to display the catalog without --full
+        "summary": {
+            "apps": {app: {"description": infos["manifest"]["description"],
+                           "level": infos["level"]}
+                     for app, infos in merged_catalog["apps"].items()},
+            "categories": [{"id": c["id"], "description": c["description"]}
+                           for c in merged_catalog["categories"]],
+        },
+        # What's needed to check the upgradability of installed apps
+        "versions": {
+            "apps": {app: dict({k: infos[k] for k in ["lastUpdate", "git", "state"] if k in infos},
+                               manifest={k: infos["manifest"][k] for k in ["version"] if k in infos["manifest"]})
+                     for app, infos in merged_catalog["apps"].items()},
+        },
+    }
+
+    # And the inverted index used to search the catalog
+    projections["search"] = _build_apps_catalog_search_index(merged_catalog["apps"])
+
+    # Keep track of what the snapshot was built from, such that we can later
+    # check that it's still up to date
+    sources = {"from_api_version": APPS_CATALOG_API_VERSION,
+               "apps_catalog_ids": apps_catalog_ids,
+               "apps_catalog_stamps": _apps_catalog_cache_stamps(apps_catalog_ids)}
+
+    for projection, content in projections.items():
+        content.update(sources)
+        try:
+            write_to_file_atomically(_merged_apps_catalog_path(projection), json.dumps(content))
+        except Exception as e:
+            raise YunohostError("Unable to write the merged apps catalog : %s" % str(e), raw_msg=True)
+
+
+def _build_apps_catalog_search_index(apps):
+    """
+    Build an inverted index of the catalog, mapping each word found in the
+    id / name, description (in every language), category and subtags of apps
+    to the apps it appears in, with a weight depending on where it was found
+
+    Words are stored sorted (along with their postings) such that prefix
+    searches boil down to a bisection, c.f. _search_apps_catalog
+    """
+
+    index = {}
+
+    def _index(app, text, weight):
+        for token in _search_tokens(text):
+            postings = index.setdefault(token, {})
+            postings[app] = max(postings.get(app, 0), weight)
+
+    for app, infos in apps.items():
+        manifest = infos.get("manifest", {})
+        description = manifest.get("description") or ""
+
+        _index(app, app, 3)
+        _index(app, manifest.get("name") or "", 3)
+        _index(app, infos.get("category") or "", 2)
+        for subtag in infos.get("subtags") or []:
+            _index(app, subtag, 2)
+        for text in (description.values() if isinstance(description, dict) else [description]):
+            _index(app, text, 1)
+
+    tokens = sorted(index)
+
+    return {
+        "tokens": tokens,
+        "postings": [index[token] for token in tokens],
+        # What's needed to filter apps by category / subtag / level
+        "apps": {app: {"category": infos.get("category"),
+                       "subtags": infos.get("subtags") or [],
+                       "level": infos.get("level")}
+                 for app, infos in apps.items()},
+    }
+
+
+def _search_tokens(text):
+    """
+    Split a text into lowercased, accent-free words (such that searching for
+    'edition' also finds 'Édition')
+    """
+
+    if isinstance(text, str):
+        text = text.decode("utf-8", "ignore")
+
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+
+    # N.B. : underscores are separators too, such that 'webapp' finds 'my_webapp'
+    return set(re.findall(r"[^\W_]+", text, re.UNICODE))
+
+
+def _merged_apps_catalog_path(projection=None):
+
+    # N.B. : those are hidden files to not conflict with the cache files of the
+    # apps catalogs themselves
+    return "{cache_folder}/.merged{suffix}.json".format(cache_folder=APPS_CATALOG_CACHE,
+                                                      suffix="." + projection if projection else "")
+
+
+def _apps_catalog_cache_stamps(apps_catalog_ids):
+
+    stamps = {}
+    for apps_catalog_id in apps_catalog_ids:
+        cache_file = "{cache_folder}/{list}.json".format(cache_folder=APPS_CATALOG_CACHE, list=apps_catalog_id)
+        if os.path.exists(cache_file):
+            stat = os.stat(cache_file)
+            stamps[apps_catalog_id] = [stat.st_mtime, stat.st_size]
+    return stamps
+
+
+# Per-process memoization of the merged apps catalog and its projections,
+# as { projection: (stamp of the snapshot file, content) }
+_apps_catalog_memo = {}
+
+
+def _load_apps_catalog(projection=None):
+    """
+    Return the merged apps catalog, corresponding to all known apps and categories
+
+    Keyword arguments:
+        projection -- None to get the full catalog, or :
+                      - 'summary' : only the description and level of apps,
+                        and the id and description of categories
+                      - 'versions' : only the lastUpdate, git, state and
+                        manifest version of apps (which is what's needed to
+                        check the upgradability of installed apps)
+                      - 'search' : the search index of the catalog
+
+    N.B. : the returned dict is memoized and shared between calls, it should
+    *not* be altered
+    """
+
+    apps_catalog_ids = [L["id"] for L in _read_apps_catalog_list()]
+    snapshot = _merged_apps_catalog_path(projection)
+
+    def _is_up_to_date(content):
+        return content.get("from_api_version") == APPS_CATALOG_API_VERSION \
+            and content.get("apps_catalog_ids") == apps_catalog_ids \
+            and content.get("apps_catalog_stamps") == _apps_catalog_cache_stamps(apps_catalog_ids)
+
+    def _snapshot_stamp():
+        stat = os.stat(snapshot)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    # Reuse the catalog already loaded if the snapshot didn't change since then
+    if projection in _apps_catalog_memo and os.path.exists(snapshot):
+        stamp, content = _apps_catalog_memo[projection]
+        if stamp == _snapshot_stamp() and _is_up_to_date(content):
+            return content
+
+    content = read_json(snapshot) if os.path.exists(snapshot) else None
+
+    # (Re)build the snapshot if it doesn't exist yet or isn't up to date
+    # with the cache of each apps catalog
+    if not content or not _is_up_to_date(content):
+        _build_merged_apps_catalog()
+        content = read_json(snapshot)
+
+    _apps_catalog_memo[projection] = (_snapshot_stamp(), content)
+
+    return content
 
 #
 # ############################### #
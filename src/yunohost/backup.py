@@ -601,7 +601,8 @@ class BackupManager():
                             system_targets,
                             args=[self.work_dir],
                             env=env_dict,
-                            chdir=self.work_dir)
+                            chdir=self.work_dir,
+                            parallel=True)
 
         ret_succeed = {hook: [path for path, result in infos.items() if result["state"] == "succeed"]
                        for hook, infos in ret.items()
@@ -1216,7 +1217,8 @@ class RestoreManager():
                             system_targets,
                             args=[self.work_dir],
                             env=env_dict,
-                            chdir=self.work_dir)
+                            chdir=self.work_dir,
+                            parallel=True)
 
         ret_succeed = [hook for hook, infos in ret.items()
                        if any(result["state"] == "succeed" for result in infos.values())]
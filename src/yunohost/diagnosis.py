@@ -26,8 +26,13 @@
 
 import re
 import os
+import ast
 import time
+import Queue
+import logging
 import smtplib
+import threading
+from multiprocessing.pool import ThreadPool
 
 from moulinette import m18n, msettings
 from moulinette.utils import log
@@ -35,6 +40,7 @@ from moulinette.utils.filesystem import read_json, write_to_json, read_yaml, wri
 
 from yunohost.utils.error import YunohostError
 from yunohost.hook import hook_list, hook_exec
+from yunohost.log import run_deferred_tasks
 
 logger = log.getActionLogger('yunohost.diagnosis')
 
@@ -42,6 +48,12 @@ DIAGNOSIS_CACHE = "/var/cache/yunohost/diagnosis/"
 DIAGNOSIS_CONFIG_FILE = '/etc/yunohost/diagnosis.yml'
 DIAGNOSIS_SERVER = "diagnosis.yunohost.org"
 
+# IP version to which the requests of remote_diagnosis() are restricted, per
+# thread (as categories are diagnosed concurrently)
+_remote_diagnosis_ipversion = threading.local()
+_remote_diagnosis_lock = threading.Lock()
+_original_getaddrinfo = None
+
 
 def diagnosis_list():
     all_categories_names = [h for h, _ in _list_diagnosis_categories()]
@@ -167,21 +179,12 @@ def diagnosis_run(categories=[], force=False, except_if_never_ran_yet=False, ema
             raise YunohostError('diagnosis_unknown_categories', categories=", ".join(unknown_categories))
 
     issues = []
-    # Call the hook ...
-    diagnosed_categories = []
+    # Call the hooks ...
+    reports = _run_diagnosis_categories(categories, dict(all_categories), force)
     for category in categories:
-        logger.debug("Running diagnosis for %s ..." % category)
-        path = [p for n, p in all_categories if n == category][0]
-
-        try:
-            code, report = hook_exec(path, args={"force": force}, env=None)
-        except Exception:
-            import traceback
-            logger.error(m18n.n("diagnosis_failed_for_category", category=category, error='\n'+traceback.format_exc()))
-        else:
-            diagnosed_categories.append(category)
-            if report != {}:
-                issues.extend([item for item in report["items"] if item["status"] in ["WARNING", "ERROR"]])
+        report = reports[category]
+        if report:
+            issues.extend([item for item in report["items"] if item["status"] in ["WARNING", "ERROR"]])
 
     if email:
         _email_diagnosis_issues()
@@ -296,6 +299,199 @@ def diagnosis_ignore(add_filter=None, remove_filter=None, list=False):
         return
 
 
+def _run_diagnosis_categories(categories, paths, force):
+    """
+    Run the diagnosis hooks of the categories, each one as soon as the
+    categories it depends on are diagnosed, concurrently with the others
+    (such that the whole diagnosis lasts as long as the slowest chain of
+    categories)
+
+    The logs of each category are kept until it is done, and displayed in
+    the order of the categories, as if they were diagnosed one after the
+    other.
+
+    Keyword arguments:
+        categories -- Ordered list of the categories to diagnose
+        paths -- Path of the hook of each category, as { category: path }
+        force -- Ignore the cached reports
+
+    Returns:
+        The (new) report of each category, as { category: report } (None if
+        the diagnosis of the category failed)
+    """
+
+    # Dependencies which are not diagnosed here are read from the cache, as
+    # usual (c.f. Diagnoser.diagnose)
+    dependencies = {c: [d for d in _get_diagnoser_attribute(paths[c], "dependencies") if d in categories and d != c]
+                    for c in categories}
+
+    logs = _LogsByThreadCategory()
+    done = Queue.Queue()
+
+    def _run(category):
+        logs.category = category
+        report = None
+        try:
+            logger.debug("Running diagnosis for %s ..." % category)
+            code, report = hook_exec(paths[category], args={"force": force}, env=None)
+        except Exception:
+            import traceback
+            logger.error(m18n.n("diagnosis_failed_for_category", category=category, error='\n' + traceback.format_exc()))
+        finally:
+            logs.category = None
+            done.put((category, report))
+
+    # Make sure deferred tasks are run from this thread beforehand (c.f.
+    # hook_exec)
+    run_deferred_tasks()
+
+    reports = {}
+    started = []
+    displayed = 0
+    pool = ThreadPool(len(categories)) if categories else None
+    logs.start()
+    try:
+        while displayed < len(categories):
+
+            ready = [c for c in categories if c not in started
+                     and all(d in reports for d in dependencies[c])]
+            # (if categories depend on each other, just run them in order)
+            if not ready and len(started) == len(reports) and len(started) < len(categories):
+                ready = [c for c in categories if c not in started][:1]
+            for category in ready:
+                started.append(category)
+                pool.apply_async(_run, (category,))
+
+            category, report = done.get()
+            reports[category] = report
+
+            # Display the logs of the categories done, in order
+            while displayed < len(categories) and categories[displayed] in reports:
+                logs.flush(categories[displayed])
+                displayed += 1
+    finally:
+        logs.stop()
+        if pool:
+            pool.close()
+
+    return reports
+
+
+def _get_diagnoser_attribute(path, attribute, default=[]):
+    """
+    Value of an attribute of the Diagnoser of a diagnosis hook, such as the
+    categories it depends on or the kinds of entities it is invalidated by
+    (read without importing the hook)
+    """
+
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+    except (IOError, SyntaxError):
+        return default
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+           and isinstance(node.targets[0], ast.Name) and node.targets[0].id == attribute:
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError:
+                return default
+    return default
+
+
+def _invalidate_diagnosis_cache(entities):
+    """
+    Record that some entities changed (typically the ones an operation is
+    related to), such that the categories depending on them get diagnosed
+    again on their next run, even if their cached report didn't expire yet.
+
+    Keyword arguments:
+        entities -- List of (kind, name) such as ('domain', 'domain.tld'), a
+                    name of None meaning any entity of this kind
+    """
+
+    if not entities or not os.path.exists(DIAGNOSIS_CACHE):
+        return
+
+    try:
+        for category, path in _list_diagnosis_categories():
+            kinds = _get_diagnoser_attribute(path, "invalidated_by")
+            changes = [(kind, name) for kind, name in entities if kind in kinds]
+            # (no need to invalidate what was never diagnosed)
+            if not changes or not os.path.exists(Diagnoser.cache_file(category)):
+                continue
+
+            invalidations = Diagnoser.get_invalidations(category)
+            invalidations += [c for c in changes if c not in invalidations]
+            write_to_json(Diagnoser.invalidations_file(category), invalidations)
+    except Exception as e:
+        logger.debug("Failed to invalidate the diagnosis cache : %s" % e)
+
+
+class _LogsByThreadCategory(object):
+    """
+    Keep the log records emitted while diagnosing a category (from the thread
+    diagnosing it, as told by self.category) instead of displaying them
+    right away, until flush() is called for this category
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.records = {}
+        self.filters = []
+
+    @property
+    def category(self):
+        return getattr(self.local, "category", None)
+
+    @category.setter
+    def category(self, category):
+        self.local.category = category
+
+    def start(self):
+
+        # Records are kept per handler (and let through later), as they may
+        # be handled by several of them
+        loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                           if isinstance(l, logging.Logger)]
+        handlers = set(h for l in loggers for h in l.handlers)
+
+        for handler in handlers:
+            filter_ = _KeepRecordsOfCategory(self, handler)
+            handler.addFilter(filter_)
+            self.filters.append((handler, filter_))
+
+    def keep(self, handler, record):
+        self.records.setdefault(self.category, []).append((handler, record))
+
+    def flush(self, category):
+        for handler, record in self.records.pop(category, []):
+            handler.handle(record)
+
+    def stop(self):
+        for handler, filter_ in self.filters:
+            handler.removeFilter(filter_)
+        self.filters = []
+        # (the categories which didn't finish are flushed too)
+        for category in list(self.records):
+            self.flush(category)
+
+
+class _KeepRecordsOfCategory(logging.Filter):
+
+    def __init__(self, logs, handler):
+        logging.Filter.__init__(self)
+        self.logs = logs
+        self.handler = handler
+
+    def filter(self, record):
+        if self.logs.category is None:
+            return True
+        self.logs.keep(self.handler, record)
+        return False
+
+
 def _diagnosis_read_configuration():
     if not os.path.exists(DIAGNOSIS_CONFIG_FILE):
         return {}
@@ -350,6 +546,16 @@ def add_ignore_flag_to_issues(report):
 
 class Diagnoser():
 
+    # Kinds of entities (as in the related_to of operations, e.g. "domain")
+    # whose changes make the cached report outdated
+    invalidated_by = []
+    # Kinds of entities for which the diagnoser is able to only diagnose the
+    # ones which changed (c.f. restrict_to), the corresponding items having
+    # the name of the entity in their meta (e.g. {"domain": "domain.tld"})
+    partial_runs_for = []
+    # Entities to diagnose, as { kind: set(names) }, or None for all of them
+    restrict_to = None
+
     def __init__(self, args, env, loggers):
 
         # FIXME ? That stuff with custom loggers is weird ... (mainly inherited from the bash hooks, idk)
@@ -365,6 +571,13 @@ class Diagnoser():
             return 99999999
         return time.time() - os.path.getmtime(self.cache_file)
 
+    def is_restricted_item(self, item):
+        """
+        Whether an item of the report is about one of the entities the run is
+        restricted to (and thus gets diagnosed again)
+        """
+        return any(item["meta"].get(kind) in names for kind, names in self.restrict_to.items())
+
     def write_cache(self, report):
         if not os.path.exists(DIAGNOSIS_CACHE):
             os.makedirs(DIAGNOSIS_CACHE)
@@ -372,11 +585,26 @@ class Diagnoser():
 
     def diagnose(self):
 
-        if not self.args.get("force", False) and self.cached_time_ago() < self.cache_duration:
+        force = self.args.get("force", False)
+        invalidations = Diagnoser.get_invalidations(self.id_)
+        cache_still_valid = self.cached_time_ago() < self.cache_duration
+
+        if not force and cache_still_valid and not invalidations:
             self.logger_debug("Cache still valid : %s" % self.cache_file)
             logger.info(m18n.n("diagnosis_cache_still_valid", category=self.description))
             return 0, {}
 
+        # If only some entities changed since the last run (c.f.
+        # invalidated_by), and the diagnoser is able to only diagnose them,
+        # just refresh the corresponding items of the cached report
+        self.restrict_to = None
+        if not force and cache_still_valid and invalidations \
+           and all(kind in self.partial_runs_for and name is not None for kind, name in invalidations):
+            self.restrict_to = {}
+            for kind, name in invalidations:
+                self.restrict_to.setdefault(kind, set()).add(name)
+            self.logger_debug("Only diagnosing %s" % ", ".join("%s %s" % (kind, name) for kind, name in invalidations))
+
         for dependency in self.dependencies:
             dep_report = Diagnoser.get_cached_report(dependency)
 
@@ -395,12 +623,26 @@ class Diagnoser():
             if "details" in item and not item["details"]:
                 del item["details"]
 
+        cached_at = None
+        if self.restrict_to:
+            # Keep the other items, unless they were diagnosed again anyway
+            new_metas = [item["meta"] for item in items]
+            cached_items = read_json(self.cache_file).get("items", [])
+            items = [item for item in cached_items
+                     if item["meta"] not in new_metas and not self.is_restricted_item(item)] + items
+            cached_at = os.path.getmtime(self.cache_file)
+
         new_report = {"id": self.id_,
                       "cached_for": self.cache_duration,
                       "items": items}
 
         self.logger_debug("Updating cache %s" % self.cache_file)
         self.write_cache(new_report)
+        # (the other items are as old as before, and the whole report has to
+        # be refreshed when they expire)
+        if cached_at is not None:
+            os.utime(self.cache_file, (cached_at, cached_at))
+        Diagnoser.clear_invalidations(self.id_, invalidations)
         Diagnoser.i18n(new_report)
         add_ignore_flag_to_issues(new_report)
 
@@ -425,6 +667,38 @@ class Diagnoser():
     def cache_file(id_):
         return os.path.join(DIAGNOSIS_CACHE, "%s.json" % id_)
 
+    @staticmethod
+    def invalidations_file(id_):
+        return os.path.join(DIAGNOSIS_CACHE, "%s.invalidated.json" % id_)
+
+    @staticmethod
+    def get_invalidations(id_):
+        """
+        Entities which changed since the last diagnosis of a category, as a
+        list of (kind, name) (c.f. _invalidate_diagnosis_cache)
+        """
+        invalidations_file = Diagnoser.invalidations_file(id_)
+        if not os.path.exists(invalidations_file):
+            return []
+        try:
+            return [tuple(i) for i in read_json(invalidations_file)]
+        except Exception:
+            # Whatever changed, diagnose everything again
+            return [(None, None)]
+
+    @staticmethod
+    def clear_invalidations(id_, invalidations):
+        """
+        Forget about the given invalidations, once they are taken into account
+        (but not about the ones recorded in the meantime)
+        """
+        invalidations_file = Diagnoser.invalidations_file(id_)
+        remaining = [i for i in Diagnoser.get_invalidations(id_) if i not in invalidations]
+        if remaining:
+            write_to_json(invalidations_file, remaining)
+        elif os.path.exists(invalidations_file):
+            os.remove(invalidations_file)
+
     @staticmethod
     def get_cached_report(id_, item=None, warn_if_no_cache=True):
         cache_file = Diagnoser.cache_file(id_)
@@ -505,33 +779,33 @@ class Diagnoser():
         import requests
         import socket
 
+        global _original_getaddrinfo
+
         # Monkey patch socket.getaddrinfo to force request() to happen in ipv4
-        # or 6 ...
+        # or 6 ... (once and for all, with the ip version being per thread,
+        # as several diagnosers may do this concurrently)
         # Inspired by https://stackoverflow.com/a/50044152
-        old_getaddrinfo = socket.getaddrinfo
-
-        def getaddrinfo_ipv4_only(*args, **kwargs):
-            responses = old_getaddrinfo(*args, **kwargs)
-            return [response
-                    for response in responses
-                    if response[0] == socket.AF_INET]
+        with _remote_diagnosis_lock:
+            if _original_getaddrinfo is None:
+                _original_getaddrinfo = socket.getaddrinfo
 
-        def getaddrinfo_ipv6_only(*args, **kwargs):
-            responses = old_getaddrinfo(*args, **kwargs)
-            return [response
-                    for response in responses
-                    if response[0] == socket.AF_INET6]
+                def getaddrinfo_for_ipversion(*args, **kwargs):
+                    responses = _original_getaddrinfo(*args, **kwargs)
+                    ipversion = getattr(_remote_diagnosis_ipversion, "value", None)
+                    if ipversion == 4:
+                        return [response for response in responses if response[0] == socket.AF_INET]
+                    elif ipversion == 6:
+                        return [response for response in responses if response[0] == socket.AF_INET6]
+                    return responses
 
-        if ipversion == 4:
-            socket.getaddrinfo = getaddrinfo_ipv4_only
-        elif ipversion == 6:
-            socket.getaddrinfo = getaddrinfo_ipv6_only
+                socket.getaddrinfo = getaddrinfo_for_ipversion
 
         url = 'https://%s/%s' % (DIAGNOSIS_SERVER, uri)
+        _remote_diagnosis_ipversion.value = ipversion
         try:
             r = requests.post(url, json=data, timeout=timeout)
         finally:
-            socket.getaddrinfo = old_getaddrinfo
+            _remote_diagnosis_ipversion.value = None
 
         if r.status_code not in [200, 400]:
             raise Exception("The remote diagnosis server failed miserably while trying to diagnose your server. This is most likely an error on Yunohost's infrastructure and not on your side. Please contact the YunoHost team an provide them with the following information.<br>URL: <code>%s</code><br>Status code: <code>%s</code>" % (url, r.status_code))
@@ -279,6 +279,11 @@ def firewall_reload(skip_upnp=False):
 
     _run_service_command("reload", "fail2ban")
 
+    # The firewall is not managed through operations, so tell the diagnosis
+    # about its changes ourselves
+    from yunohost.diagnosis import _invalidate_diagnosis_cache
+    _invalidate_diagnosis_cache([("firewall", None)])
+
     if errors:
         logger.warning(m18n.n('firewall_rules_cmd_failed'))
     else:
@@ -25,20 +25,43 @@
 """
 import os
 import re
+import pwd
 import sys
+import json
+import time
+import errno
+import fcntl
+import atexit
+import select
 import tempfile
-import mimetypes
+import threading
+import subprocess
+import multiprocessing
 from glob import iglob
 from importlib import import_module
+from multiprocessing.pool import ThreadPool
 
 from moulinette import m18n, msettings
 from yunohost.utils.error import YunohostError
 from moulinette.utils import log
-from moulinette.utils.filesystem import read_json
+from yunohost.log import run_deferred_tasks
+from yunohost.utils.profiler import HookProfiler, HOOK_PROFILER_INIT
 
 HOOK_FOLDER = '/usr/share/yunohost/hooks/'
 CUSTOM_HOOK_FOLDER = '/etc/yunohost/hooks.d/'
 
+# Line by which a bash hook declares that it can run concurrently with the
+# other parallel-safe hooks of the same action and priority (c.f. hook_callback)
+HOOK_PARALLEL_SAFE_MARKER = '# yunohost: parallel-safe'
+
+HELPERS = '/usr/share/yunohost/helpers'
+HELPERS_DIR = '/usr/share/yunohost/helpers.d'
+
+# fds on which bash hooks get the stdinfo / stdreturn channels (exported as
+# YNH_STDINFO / YNH_STDRETURN=/dev/fd/N), out of the range used by scripts
+HOOK_STDINFO_FD = 61
+HOOK_STDRETURN_FD = 62
+
 logger = log.getActionLogger('yunohost.hook')
 
 
@@ -181,11 +204,7 @@ def hook_list(action, list_by='name', show_info=False):
 
     def _append_folder(d, folder):
         # Iterate over and add hook from a folder
-        for f in os.listdir(folder + action):
-            if f[0] == '.' or f[-1] == '~' or f.endswith(".pyc"):
-                continue
-            path = '%s%s/%s' % (folder, action, f)
-            priority, name = _extract_filename_parts(f)
+        for priority, name, path, _ in _get_hooks_of_folder(folder, action):
             _append_hook(d, priority, name, path)
 
     try:
@@ -214,7 +233,7 @@ def hook_list(action, list_by='name', show_info=False):
 
 
 def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
-                  env=None, pre_callback=None, post_callback=None):
+                  env=None, pre_callback=None, post_callback=None, parallel=False):
     """
     Execute all scripts binded to an action
 
@@ -230,6 +249,9 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
             the arguments to pass to the script
         post_callback -- An object to call after each script execution with
             (name, priority, path, succeed) as arguments
+        parallel -- Run the parallel-safe hooks (c.f.
+            HOOK_PARALLEL_SAFE_MARKER) of a same priority concurrently, the
+            other hooks still being run one at a time, in order
 
     """
     result = {}
@@ -274,25 +296,66 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
     if not callable(post_callback):
         post_callback = lambda name, priority, path, succeed: None
 
-    # Iterate over hooks and execute them
+    # List the hooks to run, in order, grouped in batches of hooks which can
+    # run concurrently (each hook being its own batch unless in parallel mode,
+    # and hooks of different priorities never being in the same batch)
+    batches = []
     for priority in sorted(hooks_dict):
         for name, info in iter(hooks_dict[priority].items()):
-            state = 'succeed'
-            path = info['path']
+            hook = (name, priority, info['path'])
+            parallel_safe = parallel and _is_hook_parallel_safe(info['path'])
+            if parallel_safe and batches and batches[-1][0] and batches[-1][1][0][1] == priority:
+                batches[-1][1].append(hook)
+            else:
+                batches.append((parallel_safe, [hook]))
+
+    def _exec(hook_args, name, path, concurrently):
+        try:
+            hook_return = hook_exec(path, args=hook_args, chdir=chdir,
+                                    # (hooks mustn't share the env dict as it gets altered)
+                                    env=dict(env) if concurrently and env else env,
+                                    no_trace=no_trace, raise_on_error=True,
+                                    log_prefix=name if concurrently else None,
+                                    forkserver=True)[1]
+        except YunohostError as e:
+            logger.error(e.strerror, exc_info=1)
+            return 'failed', {}
+        return 'succeed', hook_return
+
+    # Iterate over hooks and execute them
+    for _, batch in batches:
+        concurrently = len(batch) > 1
+
+        # Callbacks are always called from this thread, in order
+        to_run = []
+        outcomes = {}
+        for name, priority, path in batch:
             try:
                 hook_args = pre_callback(name=name, priority=priority,
                                          path=path, args=args)
-                hook_return = hook_exec(path, args=hook_args, chdir=chdir, env=env,
-                          no_trace=no_trace, raise_on_error=True)[1]
             except YunohostError as e:
-                state = 'failed'
-                hook_return = {}
                 logger.error(e.strerror, exc_info=1)
-                post_callback(name=name, priority=priority, path=path,
-                              succeed=False)
+                outcomes[path] = ('failed', {})
             else:
-                post_callback(name=name, priority=priority, path=path,
-                              succeed=True)
+                to_run.append((hook_args, name, path, concurrently))
+
+        if concurrently and to_run:
+            # Make sure deferred tasks are run from this thread beforehand
+            run_deferred_tasks()
+            pool = ThreadPool(min(len(to_run), multiprocessing.cpu_count()))
+            try:
+                for (_, _, path, _), outcome in zip(to_run, pool.map(lambda h: _exec(*h), to_run)):
+                    outcomes[path] = outcome
+            finally:
+                pool.close()
+        else:
+            for hook in to_run:
+                outcomes[hook[2]] = _exec(*hook)
+
+        for name, priority, path in batch:
+            state, hook_return = outcomes[path]
+            post_callback(name=name, priority=priority, path=path,
+                          succeed=state == 'succeed')
             if not name in result:
                 result[name] = {}
             result[name][path] = {'state' : state, 'stdreturn' : hook_return }
@@ -300,7 +363,8 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
 
 
 def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
-              chdir=None, env=None, user="root", return_format="json"):
+              chdir=None, env=None, user="root", return_format="json",
+              log_prefix=None, forkserver=False, profile=None):
     """
     Execute hook from a file with arguments
 
@@ -312,6 +376,12 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
         chdir -- The directory from where the script will be executed
         env -- Dictionnary of environment variables to export
         user -- User with which to run the command
+        log_prefix -- Prefix to add to each logged line of the output (to
+            tell hooks running concurrently apart)
+        forkserver -- Run the script (if it's a bash one, run as root) from
+            the hook forkserver, where the helpers are already loaded
+        profile -- Profile the (bash) script and save the results next to
+            this path (c.f. yunohost.utils.profiler)
 
     """
 
@@ -321,20 +391,27 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
     if not os.path.isfile(path):
         raise YunohostError('file_does_not_exist', path=path)
 
+    # Make sure the system is in a consistent state before running the hook
+    # (e.g. that the SSOwat conf is up to date if its regeneration has been
+    # deferred to the end of the current operation), as it may rely on it
+    run_deferred_tasks()
+
     # Define output loggers and call command
+    prefix = "[%s] " % log_prefix if log_prefix else ""
     loggers = (
-        lambda l: logger.debug(l.rstrip() + "\r"),
-        lambda l: logger.warning(l.rstrip()) if "invalid value for trace file descriptor" not in l.rstrip() else logger.debug(l.rstrip()),
-        lambda l: logger.info(l.rstrip())
+        lambda l: logger.debug(prefix + l.rstrip() + "\r"),
+        lambda l: logger.warning(prefix + l.rstrip()) if "invalid value for trace file descriptor" not in l.rstrip() else logger.debug(prefix + l.rstrip()),
+        lambda l: logger.info(prefix + l.rstrip())
     )
 
     # Check the type of the hook (bash by default)
     # For now we support only python and bash hooks.
-    hook_type = mimetypes.MimeTypes().guess_type(path)[0]
-    if hook_type == 'text/x-python':
+    hook_type = _get_hook_type(path)
+    if hook_type == 'python':
         returncode, returndata = _hook_exec_python(path, args, env, loggers)
     else:
-        returncode, returndata = _hook_exec_bash(path, args, no_trace, chdir, env, user, return_format, loggers)
+        returncode, returndata = _hook_exec_bash(path, args, no_trace, chdir, env, user, return_format, loggers,
+                                                 forkserver=forkserver, profile=profile)
 
     # Check and return process' return code
     if returncode is None:
@@ -349,9 +426,11 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
     return returncode, returndata
 
 
-def _hook_exec_bash(path, args, no_trace, chdir, env, user, return_format, loggers):
+def _hook_exec_bash(path, args, no_trace, chdir, env, user, return_format, loggers, forkserver=False,
+                    profile=None):
 
-    from moulinette.utils.process import call_async_output
+    if return_format not in ["json", "plain_dict"]:
+        raise YunohostError("Expected value for return_format is either 'json' or 'plain_dict', got '%s'" % return_format)
 
     # Construct command variables
     cmd_args = ''
@@ -372,73 +451,270 @@ def _hook_exec_bash(path, args, no_trace, chdir, env, user, return_format, logge
 
     env['YNH_INTERFACE'] = msettings.get('interface')
 
-    stdinfo = os.path.join(tempfile.mkdtemp(), "stdinfo")
-    env['YNH_STDINFO'] = stdinfo
+    # Data sent back by the script through YNH_STDRETURN, parsed as it arrives
+    # for plain_dict (json can only be parsed once complete)
+    raw_content = []
+    returncontent = {}
+
+    def _on_return(line):
+        raw_content.append(line)
+        if return_format == "plain_dict" and "=" in line:
+            key, value = line.strip().split("=", 1)
+            returncontent[key] = value
+
+    # Run the script from the hook forkserver if possible, which saves the
+    # cost of starting bash and loading the helpers
+    from_forkserver = False
+    if forkserver and not profile and user == "root" and _can_run_from_forkserver(path):
+        logger.debug(m18n.n('executing_script', script=path))
+        try:
+            returncode = _hook_forkserver.run(cmd_script,
+                                              [str(s) for s in args] if args and isinstance(args, list) else [],
+                                              chdir, env, no_trace, loggers, _on_return)
+            from_forkserver = True
+        except HookForkserverUnavailable as e:
+            logger.debug("Running %s without the hook forkserver : %s" % (path, e))
+
+    if not from_forkserver:
+        fifos_dir = None
+        pass_fds = {}
+        if user == "root":
+            # The stdinfo / stdreturn channels are pipes inherited by the
+            # script, whose /dev/fd/N paths are exported such that scripts
+            # keep writing to them as if they were files
+            stdinfo, pass_fd = _cloexec_pipe()
+            pass_fds[pass_fd] = HOOK_STDINFO_FD
+            stdreturn, pass_fd = _cloexec_pipe()
+            pass_fds[pass_fd] = HOOK_STDRETURN_FD
+            env['YNH_STDINFO'] = '/dev/fd/%d' % HOOK_STDINFO_FD
+            env['YNH_STDRETURN'] = '/dev/fd/%d' % HOOK_STDRETURN_FD
+        else:
+            # sudo closes the fds it inherits, so use FIFOs instead (owned by
+            # the user, such that the script can open them)
+            fifos_dir = tempfile.mkdtemp(prefix="ynh-hook-")
+            env['YNH_STDINFO'] = os.path.join(fifos_dir, "stdinfo")
+            env['YNH_STDRETURN'] = os.path.join(fifos_dir, "stdreturn")
+            stdinfo = _open_fifo(env['YNH_STDINFO'])
+            stdreturn = _open_fifo(env['YNH_STDRETURN'])
+            uid = pwd.getpwnam(user).pw_uid
+            for path in [fifos_dir, env['YNH_STDINFO'], env['YNH_STDRETURN']]:
+                os.chown(path, uid, -1)
+
+        try:
+            # Construct command to execute
+            if user == "root":
+                command = ['sh', '-c']
+            else:
+                command = ['sudo', '-n', '-u', user, '-H', 'sh', '-c']
+
+            if profile:
+                # xtrace with timestamped lines (c.f. HOOK_PROFILER_INIT),
+                # accounted and turned back into regular ones by the profiler
+                profiler = HookProfiler(path)
+                stdout_logger = loggers[0]
+                loggers = (lambda l: stdout_logger(profiler.feed(l)),) + tuple(loggers[1:])
+                cmd = 'BASH_ENV=%s BASH_XTRACEFD=7 /bin/bash "{script}" {args} 7>&1' % HOOK_PROFILER_INIT
+            elif no_trace:
+                cmd = '/bin/bash "{script}" {args}'
+            else:
+                # use xtrace on fd 7 which is redirected to stdout
+                cmd = 'BASH_XTRACEFD=7 /bin/bash -x "{script}" {args} 7>&1'
 
-    stdreturn = os.path.join(tempfile.mkdtemp(), "stdreturn")
-    with open(stdreturn, 'w') as f:
-        f.write('')
-    env['YNH_STDRETURN'] = stdreturn
+            # prepend environment variables
+            cmd = '{0} {1}'.format(
+                ' '.join(['{0}={1}'.format(k, shell_quote(v))
+                          for k, v in env.items()]), cmd)
+            command.append(cmd.format(script=cmd_script, args=cmd_args))
 
-    # Construct command to execute
-    if user == "root":
-        command = ['sh', '-c']
-    else:
-        command = ['sudo', '-n', '-u', user, '-H', 'sh', '-c']
+            if logger.isEnabledFor(log.DEBUG):
+                logger.debug(m18n.n('executing_command', command=' '.join(command)))
+            else:
+                logger.debug(m18n.n('executing_script', script=path))
 
-    if no_trace:
-        cmd = '/bin/bash "{script}" {args}'
-    else:
-        # use xtrace on fd 7 which is redirected to stdout
-        cmd = 'BASH_XTRACEFD=7 /bin/bash -x "{script}" {args} 7>&1'
+            logger.debug("About to run the command '%s'" % command)
 
-    # prepend environment variables
-    cmd = '{0} {1}'.format(
-        ' '.join(['{0}={1}'.format(k, shell_quote(v))
-                  for k, v in env.items()]), cmd)
-    command.append(cmd.format(script=cmd_script, args=cmd_args))
+            returncode = _run_hook_command(command, chdir, loggers,
+                                           {stdinfo: loggers[2], stdreturn: _on_return},
+                                           pass_fds)
 
-    if logger.isEnabledFor(log.DEBUG):
-        logger.debug(m18n.n('executing_command', command=' '.join(command)))
-    else:
-        logger.debug(m18n.n('executing_script', script=path))
+            if profile:
+                profiler.save(profile)
+                logger.info(m18n.n('hook_profile_saved', path=path, profile=profile))
+        finally:
+            for fd in pass_fds.keys() + [stdinfo, stdreturn]:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            if fifos_dir:
+                os.remove(env['YNH_STDINFO'])
+                os.remove(env['YNH_STDRETURN'])
+                os.rmdir(fifos_dir)
+
+    if return_format == "json":
+        raw_content = ''.join(raw_content)
+        if raw_content != '':
+            try:
+                returncontent = json.loads(raw_content)
+            except Exception as e:
+                raise YunohostError('hook_json_return_error',
+                                    path=path, msg=str(e),
+                                    raw_content=raw_content)
 
-    logger.debug("About to run the command '%s'" % command)
+    return returncode, returncontent
 
-    returncode = call_async_output(
-        command, loggers, shell=False, cwd=chdir,
-        stdinfo=stdinfo
-    )
 
-    raw_content = None
-    try:
-        with open(stdreturn, 'r') as f:
-            raw_content = f.read()
-        returncontent = {}
+# Number of seconds between two checks that a command run by
+# _run_hook_command is still running
+HOOK_COMMAND_CHECK_INTERVAL = 1
 
-        if return_format == "json":
-            if raw_content != '':
-                try:
-                    returncontent = read_json(stdreturn)
-                except Exception as e:
-                    raise YunohostError('hook_json_return_error',
-                                        path=path, msg=str(e),
-                                        raw_content=raw_content)
-
-        elif return_format == "plain_dict":
-            for line in raw_content.split("\n"):
-                if "=" in line:
-                    key, value = line.strip().split("=", 1)
-                    returncontent[key] = value
 
-        else:
-            raise YunohostError("Expected value for return_format is either 'json' or 'plain_dict', got '%s'" % return_format)
+def _run_hook_command(command, chdir, loggers, channels, pass_fds):
+    """
+    Run a command and stream its output to the loggers, like
+    call_async_output would, as well as the lines of other channels
+
+    Keyword arguments:
+        command -- The command to run
+        chdir -- The directory from where the command will be run
+        loggers -- The stdout / stderr loggers
+        channels -- The other channels to read from, as { fd: callback }
+        pass_fds -- fds to pass to the command, as { fd: fd in the command }
+            (the write ends of the channels ; they are closed here once the
+            command got them)
+
+    Returns:
+        The return code of the command
+    """
+
+    def _pass_fds():
+        # (move the fds out of the way first, such that they can't be
+        # overwritten by each other's dup2)
+        moved = [(fcntl.fcntl(fd, fcntl.F_DUPFD, 256), target)
+                 for fd, target in pass_fds.items()]
+        for fd, target in moved:
+            os.dup2(fd, target)
+            os.close(fd)
+
+    try:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=chdir, preexec_fn=_pass_fds, close_fds=False)
     finally:
-        stdreturndir = os.path.split(stdreturn)[0]
-        os.remove(stdreturn)
-        os.rmdir(stdreturndir)
+        # Only the command holds the write ends from now on, such that the
+        # pipes reach EOF once it exits
+        for fd in pass_fds:
+            os.close(fd)
+        pass_fds.clear()
+
+    stdout, stderr = p.stdout.fileno(), p.stderr.fileno()
+    for fd in [stdout, stderr] + list(channels):
+        _set_nonblocking(fd)
+
+    # (the command may exit while a background child of it still holds its
+    # stdout / stderr, hence checking that it's still running now and then)
+    all_channels = {stdout: loggers[0], stderr: loggers[1]}
+    all_channels.update(channels)
+    _stream_hook_channels(all_channels,
+                          lambda open_fds: (stdout not in open_fds and stderr not in open_fds)
+                          or p.poll() is not None,
+                          timeout=HOOK_COMMAND_CHECK_INTERVAL)
+
+    p.stdout.close()
+    p.stderr.close()
+    return p.wait()
+
+
+def _stream_hook_channels(channels, is_done, timeout=None):
+    """
+    Read lines from the channels of a running hook (output, stdinfo,
+    stdreturn, ...) and pass each of them to the callback of its channel as
+    soon as it arrives
+
+    Keyword arguments:
+        channels -- The channels to read from, as { fd: callback } (fds have
+            to be non-blocking)
+        is_done -- Function called with the set of channels which didn't
+            reach EOF yet, telling whether the hook exited (what's left in
+            the channels is read then)
+        timeout -- Number of seconds after which is_done is called again
+            even if nothing was written in the channels
 
-    return returncode, returncontent
+    """
+
+    buffers = {fd: '' for fd in channels}
+    open_fds = set(channels)
+
+    def _read(fd):
+        data = ''
+        while fd in open_fds:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                open_fds.discard(fd)
+            data += chunk
+        return data
+
+    def _dispatch(fd, data, flush=False):
+        lines = (buffers[fd] + data).split('\n')
+        buffers[fd] = lines.pop()
+        if flush and buffers[fd]:
+            lines.append(buffers[fd])
+            buffers[fd] = ''
+        for line in lines:
+            channels[fd](line + '\n')
+
+    while open_fds and not is_done(open_fds):
+        for fd in select.select(list(open_fds), [], [], timeout)[0]:
+            _dispatch(fd, _read(fd))
+
+    # The hook exited : flush what's left of its channels
+    for fd in channels:
+        _dispatch(fd, _read(fd), flush=True)
+
+
+def _cloexec_pipe():
+    """
+    Create a pipe whose fds are not inherited by the commands we run (unless
+    explicitly passed to them), as hooks may be run concurrently
+    """
+
+    fds = os.pipe()
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fds
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def _open_fifo(path):
+    # (FIFOs are opened read-write, such that opening them never blocks, and
+    # that they never reach EOF : the end of the hook is told otherwise)
+    os.mkfifo(path, 0o600)
+    return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+
+def _read_fifo(fd):
+    # (what is available in a non-blocking FIFO opened by _open_fifo)
+    try:
+        return os.read(fd, 65536)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return ''
+        raise
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
 
 
 def _hook_exec_python(path, args, env, loggers):
@@ -460,6 +736,349 @@ def _hook_exec_python(path, args, env, loggers):
     return ret
 
 
+# Hooks found in each hook folder, as
+# { folder: (mtime of the folder, [(priority, name, path, type), ...]) }
+_hook_folders_cache = {}
+HOOK_FOLDERS_CACHE_RACY_DELAY = 1
+
+
+def _get_hooks_of_folder(folder, action):
+    """
+    List the hooks for an action in a hook folder (HOOK_FOLDER or
+    CUSTOM_HOOK_FOLDER), as (priority, name, path, type) tuples
+
+    The listing is only done again if the folder changed since the previous
+    call (adding, removing or renaming a hook changes the mtime of the folder)
+    or if it changed within the last HOOK_FOLDERS_CACHE_RACY_DELAY seconds
+    (the mtime not telling apart several changes within that time on some
+    filesystems)
+
+    Raises OSError if there's no folder for this action
+    """
+
+    folder = folder + action
+    mtime = os.stat(folder).st_mtime
+
+    if folder in _hook_folders_cache and _hook_folders_cache[folder][0] == mtime:
+        return _hook_folders_cache[folder][1]
+
+    hooks = []
+    for f in os.listdir(folder):
+        if f[0] == '.' or f[-1] == '~' or f.endswith(".pyc"):
+            continue
+        path = '%s/%s' % (folder, f)
+        priority, name = _extract_filename_parts(f)
+        hooks.append((priority, name, path, _get_hook_type(path)))
+
+    if time.time() - mtime > HOOK_FOLDERS_CACHE_RACY_DELAY:
+        _hook_folders_cache[folder] = (mtime, hooks)
+
+    return hooks
+
+
+def _get_hook_type(path):
+    """
+    Return the type of a hook ('python' or 'bash')
+
+    N.B. : python hooks are modules providing a main() function, recognized by
+    their extension (bash hooks are run with /bin/bash whatever their shebang)
+    """
+
+    return 'python' if os.path.splitext(path)[1].lower() == '.py' else 'bash'
+
+
+# Hook forkserver ------------------------------------------------------------
+
+# Bash code of the forkserver : load the helpers once, then for each request
+# (sent as NUL-separated fields on stdin), fork a subshell which sets up the
+# environment, arguments, current directory and xtrace like
+# `K=V ... /bin/bash [-x] script args` would, and sources the script. The
+# output and return code go to FIFOs of the request directory, as well as the
+# pid of the subshell (such that we can tell if it got killed). Its xtrace
+# lines start with HOOK_FORKSERVER_XTRACE_MARKER instead of '+', such that
+# they can be turned back into what /bin/bash would trace.
+HOOK_FORKSERVER_SCRIPT = r"""
+source "$1"
+YNH_HELPERS_PRELOADED=1
+while IFS= read -r -d '' __ynh_request
+do
+    IFS= read -r -d '' __ynh_chdir
+    IFS= read -r -d '' __ynh_script
+    IFS= read -r -d '' __ynh_trace
+    __ynh_env=()
+    IFS= read -r -d '' __ynh_nb
+    for ((__ynh_i = 0; __ynh_i < __ynh_nb; __ynh_i++)); do
+        IFS= read -r -d '' __ynh_var && __ynh_env+=("$__ynh_var")
+    done
+    __ynh_args=()
+    IFS= read -r -d '' __ynh_nb
+    for ((__ynh_i = 0; __ynh_i < __ynh_nb; __ynh_i++)); do
+        IFS= read -r -d '' __ynh_var && __ynh_args+=("$__ynh_var")
+    done
+    (
+        (
+            for __ynh_var in "${__ynh_env[@]}"; do
+                export "$__ynh_var"
+            done
+            set -- "${__ynh_args[@]}"
+            cd "$__ynh_chdir" || exit 1
+            __ynh_source=$__ynh_script
+            if [[ "$__ynh_trace" == 1 ]]; then
+                unset __ynh_request __ynh_chdir __ynh_script __ynh_trace __ynh_env __ynh_args __ynh_nb __ynh_i __ynh_var
+                exec 7>&1
+                export BASH_XTRACEFD=7
+                PS4=$'\x1e '
+                set -x
+            else
+                unset __ynh_request __ynh_chdir __ynh_script __ynh_trace __ynh_env __ynh_args __ynh_nb __ynh_i __ynh_var
+            fi
+            source "$__ynh_source"
+        ) </dev/null >"$__ynh_request/stdout" 2>"$__ynh_request/stderr"
+        echo "$?" >"$__ynh_request/returncode"
+    ) &
+    echo "$!" >"$__ynh_request/pid"
+done
+"""
+
+# First character of PS4 in scripts run by the forkserver, repeated as many
+# times as the level of indirection (c.f. _forkserver_xtrace_line)
+HOOK_FORKSERVER_XTRACE_MARKER = '\x1e'
+
+# Variables which can be exported by the forkserver
+_re_env_variable_name = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+# Number of seconds between two checks that a script run from the forkserver
+# is still running (as it may get killed before telling its return code)
+HOOK_FORKSERVER_CHECK_INTERVAL = 1
+
+
+class HookForkserverUnavailable(Exception):
+    pass
+
+
+class HookForkserver(object):
+    """
+    A bash process with the helpers already loaded, which forks a subshell to
+    run each (bash) hook, such that hooks don't each pay for starting bash and
+    loading the ~5k lines of helpers
+
+    The forkserver is started on first use, and restarted if the helpers
+    changed in the meantime.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.helpers_stamp = None
+        self.lock = threading.Lock()
+
+    def _get_helpers_stamp(self):
+        # (helpers may be edited in place, which doesn't change the mtime of
+        # their folder)
+        paths = [HELPERS] + sorted(os.path.join(HELPERS_DIR, f) for f in os.listdir(HELPERS_DIR))
+        stamp = []
+        for path in paths:
+            stat = os.stat(path)
+            stamp.append((path, stat.st_mtime, stat.st_size, stat.st_ino))
+        return stamp
+
+    def _start(self):
+
+        helpers_stamp = self._get_helpers_stamp()
+        if self.process is not None and self.process.poll() is None \
+           and self.helpers_stamp == helpers_stamp:
+            return
+
+        self.stop()
+
+        with open(os.devnull, 'w') as devnull:
+            # N.B. : the environment is left (almost) empty, such that hooks
+            # get only the one they would get with /bin/bash
+            self.process = subprocess.Popen(
+                ['/bin/bash', '--noprofile', '--norc', '-c', HOOK_FORKSERVER_SCRIPT,
+                 'yunohost-hook-forkserver', HELPERS],
+                stdin=subprocess.PIPE, stdout=devnull, stderr=devnull, cwd='/',
+                env={'PATH': os.environ.get('PATH', '/usr/sbin:/usr/bin:/sbin:/bin')},
+                close_fds=True)
+        self.helpers_stamp = helpers_stamp
+
+    def stop(self):
+
+        if self.process is not None and self.process.poll() is None:
+            # The forkserver exits once its stdin is closed (hooks still
+            # running are left alone)
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    def run(self, script, args, chdir, env, no_trace, loggers, on_return):
+        """
+        Run a bash script from the forkserver, like call_async_output would
+        with `K=V ... /bin/bash [-x] script args`
+
+        The stdinfo / stdreturn channels are FIFOs of the request directory
+        (the scripts being children of the forkserver, they can't inherit fds
+        from us), whose paths are exported as YNH_STDINFO / YNH_STDRETURN
+
+        Raises HookForkserverUnavailable if the script couldn't be sent to the
+        forkserver (in which case it wasn't run at all)
+
+        Returns:
+            The return code of the script, or None if it (or the forkserver,
+            before running it) got killed
+        """
+
+        request = tempfile.mkdtemp(prefix="ynh-hook-")
+        env['YNH_STDINFO'] = os.path.join(request, 'stdinfo')
+        env['YNH_STDRETURN'] = os.path.join(request, 'stdreturn')
+
+        # Exported variables are the ones /bin/bash would have inherited
+        full_env = dict(os.environ)
+        full_env.update(env)
+        env_fields = ['%s=%s' % (k, v) for k, v in full_env.items()
+                      if _re_env_variable_name.match(k)]
+
+        fds = {}
+        try:
+            for channel in ['stdout', 'stderr', 'stdinfo', 'stdreturn', 'returncode', 'pid']:
+                fds[channel] = _open_fifo(os.path.join(request, channel))
+
+            fields = [request, chdir, script, '0' if no_trace else '1',
+                      str(len(env_fields))] + env_fields + [str(len(args))] + list(args)
+
+            with self.lock:
+                try:
+                    self._start()
+                    process = self.process
+                    process.stdin.write(''.join(str(f) + '\0' for f in fields))
+                    process.stdin.flush()
+                except (OSError, IOError) as e:
+                    self.stop()
+                    raise HookForkserverUnavailable(str(e))
+
+            returncode = []
+            pid = []
+
+            def _is_done(open_fds):
+                if returncode:
+                    return True
+                if not pid:
+                    # (if the forkserver exited, the pid is there already)
+                    forkserver_exited = process.poll() is not None
+                    pid.extend(int(p) for p in _read_fifo(fds['pid']).split())
+                    if not pid:
+                        return forkserver_exited
+                # Killed before telling its return code ?
+                return not _pid_exists(pid[0])
+
+            def _on_stdout(line):
+                line = _forkserver_xtrace_line(line)
+                if line is not None:
+                    loggers[0](line)
+
+            _stream_hook_channels({fds['stdout']: _on_stdout,
+                                   fds['stderr']: loggers[1],
+                                   fds['stdinfo']: loggers[2],
+                                   fds['stdreturn']: on_return,
+                                   fds['returncode']: returncode.append},
+                                  _is_done, timeout=HOOK_FORKSERVER_CHECK_INTERVAL)
+
+            if not returncode:
+                return None
+            return int(returncode[0].strip())
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+            for channel in fds:
+                os.remove(os.path.join(request, channel))
+            os.rmdir(request)
+
+
+_hook_forkserver = HookForkserver()
+atexit.register(_hook_forkserver.stop)
+
+
+def _forkserver_xtrace_line(line):
+    """
+    Turn a line of output of a script run from the forkserver into what it
+    would be with /bin/bash : xtrace lines are one level of indirection
+    deeper as the script is sourced, and the first level only traces the
+    'source' itself (None is returned for it)
+    """
+
+    depth = len(line) - len(line.lstrip(HOOK_FORKSERVER_XTRACE_MARKER))
+    if depth == 0:
+        return line
+    if depth == 1:
+        return None
+    return '+' * (depth - 1) + line[depth:]
+
+
+# Whether each hook can be run from the forkserver, as
+# { path: ((mtime, size, inode) of the hook, can_run_from_forkserver) }
+_forkserver_hooks_cache = {}
+
+
+def _can_run_from_forkserver(path):
+    """
+    Tell if a bash hook can be run from the forkserver, i.e. that it doesn't
+    rely on $0 or $$ (which are the ones of the forkserver), including through
+    ynh_script_progression
+    """
+
+    try:
+        stat_ = os.stat(path)
+    except OSError:
+        return False
+    stamp = (stat_.st_mtime, stat_.st_size, stat_.st_ino)
+
+    if path in _forkserver_hooks_cache and _forkserver_hooks_cache[path][0] == stamp:
+        return _forkserver_hooks_cache[path][1]
+
+    with open(path) as f:
+        content = f.read()
+    can_run = not any(pattern in content for pattern in ['$0', '${0', '$$', '${$}', 'ynh_script_progression'])
+
+    _forkserver_hooks_cache[path] = (stamp, can_run)
+
+    return can_run
+
+
+# Whether each hook is parallel-safe, as
+# { path: ((mtime, size, inode) of the hook, parallel_safe) }
+_parallel_safe_hooks_cache = {}
+
+
+def _is_hook_parallel_safe(path):
+    """
+    Tell if a hook declared (with HOOK_PARALLEL_SAFE_MARKER among its first
+    lines) that it can run concurrently with the other parallel-safe hooks of
+    the same action and priority
+
+    N.B. : python hooks are run in-process, and thus never concurrently
+    """
+
+    if _get_hook_type(path) != 'bash':
+        return False
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    if path in _parallel_safe_hooks_cache and _parallel_safe_hooks_cache[path][0] == stamp:
+        return _parallel_safe_hooks_cache[path][1]
+
+    with open(path) as f:
+        head = [f.readline() for _ in range(20)]
+    parallel_safe = any(line.strip() == HOOK_PARALLEL_SAFE_MARKER for line in head)
+
+    _parallel_safe_hooks_cache[path] = (stamp, parallel_safe)
+
+    return parallel_safe
+
+
 def _extract_filename_parts(filename):
     """Extract hook parts from filename"""
     if '-' in filename:
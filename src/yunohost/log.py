@@ -27,6 +27,8 @@
 import os
 import re
 import yaml
+import itertools
+import threading
 import collections
 
 from datetime import datetime
@@ -48,6 +50,16 @@ RELATED_CATEGORIES = ['app', 'domain', 'group', 'service', 'user']
 
 logger = getActionLogger('yunohost.log')
 
+# Unit operations can be nested (e.g. user_create calls user_group_update)
+# This keeps track of how many of them are currently running, and of the
+# tasks deferred until the outermost one ends (c.f. defer_to_end_of_operation)
+# Only the thread running the outermost operation runs the deferred tasks
+# (other threads may run hooks meanwhile, c.f. hook_callback)
+_operations_depth = 0
+_operations_thread = None
+_deferred_tasks = collections.OrderedDict()
+_operations_lock = threading.RLock()
+
 
 def log_list(category=[], limit=None, with_details=False):
     """
@@ -122,7 +134,7 @@ def log_list(category=[], limit=None, with_details=False):
     return result
 
 
-def log_display(path, number=None, share=False, filter_irrelevant=False):
+def log_display(path, number=None, share=False, filter_irrelevant=False, follow=False):
     """
     Display a log file enriched with metadata if any.
 
@@ -133,6 +145,8 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
         file_name
         number
         share
+        follow -- Only display the log, then its new lines until the operation
+                  is over
     """
 
     # Normalize log/metadata paths and filenames
@@ -218,17 +232,68 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
         else:
             filters = []
 
-        from yunohost.service import _tail
-        if number:
-            logs = _tail(log_path, int(number), filters=filters)
-        else:
-            logs = read_file(log_path)
         infos['log_path'] = log_path
-        infos['logs'] = logs
+        if follow:
+            _follow_log(log_path, number, filters, md_path)
+        else:
+            from yunohost.service import _tail
+            if number:
+                logs = _tail(log_path, int(number), filters=filters)
+            else:
+                logs = read_file(log_path)
+            infos['logs'] = logs
 
     return infos
 
 
+def _follow_log(log_path, number, filters, md_path):
+    """
+    Display the last lines of a log, then the new ones as they are written,
+    until the operation is over (c.f. the 'ended_at' of its metadata)
+    """
+    from yunohost.service import _tail, _filter_lines
+    from yunohost.utils.follow import follow_logs, print_logs
+
+    filters = [re.compile(f) for f in filters]
+
+    def _last_lines():
+        # (and the position from which the log can be followed, c.f. _tail)
+        if number:
+            return _tail(log_path, int(number), filters=filters, with_position=True)
+        with open(log_path) as f:
+            lines = f.read().splitlines()
+            return _filter_lines(lines, filters), (os.fstat(f.fileno()).st_ino, f.tell())
+
+    # (the metadata are only parsed again when they change)
+    metadata = {"mtime": None, "ended": False}
+
+    def _operation_ended():
+        try:
+            mtime = os.path.getmtime(md_path)
+        except OSError:
+            # Not an operation, follow until interrupted
+            return False
+        if mtime != metadata["mtime"]:
+            metadata["mtime"] = mtime
+            metadata["ended"] = "ended_at" in (read_yaml(md_path) or {})
+        return metadata["ended"]
+
+    if _operation_ended():
+        print_logs((log_path, line) for line in _last_lines()[0])
+        return
+
+    # Follow the log from where its last lines were read, such that nothing
+    # written in the meantime gets lost or displayed twice
+    lines, position = _last_lines()
+    followed = follow_logs({log_path: position}, until=_operation_ended)
+    try:
+        print_logs(itertools.chain(((log_path, line) for line in lines),
+                                   ((source, line) for source, line in followed
+                                    if _filter_lines([line], filters))))
+    finally:
+        followed.close()
+
+
 def is_unit_operation(entities=['app', 'domain', 'group', 'service', 'user'],
                       exclude=['password'], operation_key=None):
     """
@@ -296,21 +361,79 @@ def is_unit_operation(entities=['app', 'domain', 'group', 'service', 'user'],
                     context.pop(field, None)
             operation_logger = OperationLogger(op_key, related_to, args=context)
 
+            global _operations_depth, _operations_thread
+            with _operations_lock:
+                _operations_depth += 1
+                outermost = _operations_depth == 1
+                if outermost:
+                    _operations_thread = threading.current_thread()
             try:
                 # Start the actual function, and give the unit operation
                 # in argument to let the developper start the record itself
                 args = (operation_logger,) + args
                 result = func(*args, **kwargs)
+                if outermost:
+                    run_deferred_tasks()
             except Exception as e:
+                # Even if the operation failed, it may have changed some
+                # stuff already, so we still want to run the deferred tasks
+                if outermost:
+                    try:
+                        run_deferred_tasks()
+                    except Exception as e_:
+                        logger.error("Failed to run the tasks deferred to the end of the operation : %s" % e_)
                 operation_logger.error(e)
                 raise
             else:
                 operation_logger.success()
+            finally:
+                with _operations_lock:
+                    _operations_depth -= 1
+                    if outermost:
+                        _operations_thread = None
             return result
         return func_wrapper
     return decorate
 
 
+def defer_to_end_of_operation(key, func):
+    """
+    Run func at the end of the outermost unit operation currently running,
+    or right away if there's no unit operation running.
+
+    Tasks deferred several times with the same key are only ran once, such
+    that e.g. a configuration regenerated several times during the same
+    operation is only regenerated once at the end.
+
+    Returns True if the task was deferred, False if it was ran right away
+    """
+
+    with _operations_lock:
+        if _operations_depth > 0:
+            _deferred_tasks.pop(key, None)
+            _deferred_tasks[key] = func
+            return True
+
+    func()
+    return False
+
+
+def run_deferred_tasks():
+    """
+    Run right away (and forget about) the tasks deferred so far
+
+    Only the thread running the outermost operation (if any) runs them, the
+    other ones leave them to it
+    """
+
+    while True:
+        with _operations_lock:
+            if _operations_thread not in (None, threading.current_thread()) or not _deferred_tasks:
+                return
+            _, func = _deferred_tasks.popitem(last=False)
+        func()
+
+
 class RedactingFormatter(Formatter):
 
     def __init__(self, format_string, data_to_redact):
@@ -395,6 +518,13 @@ class OperationLogger(object):
         """
         return os.path.join(self.path, self.name + LOG_FILE_EXT)
 
+    @property
+    def profile_path(self):
+        """
+        Profiling results path (without extension, c.f. utils/profiler.py)
+        """
+        return os.path.join(self.path, self.name)
+
     def _register_log(self):
         """
         Register log with a handler connected on log system
@@ -511,6 +641,13 @@ class OperationLogger(object):
                              desc=desc)
             logger.info(msg)
         self.flush()
+
+        # Whether it succeeded or not, the operation may have changed the
+        # entities it is related to, so the diagnosis of those is outdated
+        if self.related_to:
+            from yunohost.diagnosis import _invalidate_diagnosis_cache
+            _invalidate_diagnosis_cache(self.related_to)
+
         return msg
 
     def __del__(self):
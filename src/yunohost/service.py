@@ -26,19 +26,50 @@
 
 import re
 import os
+import copy
 import time
+import fcntl
+import zlib
 import yaml
+import signal
+import threading
+import itertools
 import subprocess
+import collections
 
 from glob import glob
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from moulinette import m18n
 from yunohost.utils.error import YunohostError
+from yunohost.utils.filesystem import write_to_file_atomically
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.filesystem import read_file, append_to_file, write_to_file
+from moulinette.utils.filesystem import read_file
 
 MOULINETTE_LOCK = "/var/run/moulinette_yunohost.lock"
+# Locked (with flock) while updating the list of PIDs in MOULINETTE_LOCK
+MOULINETTE_LOCK_GUARD = MOULINETTE_LOCK + ".guard"
+SERVICES_CONF = "/etc/yunohost/services.yml"
+SSHD_CONFIG = "/etc/ssh/sshd_config"
+
+# Number of seconds after which the test_status / test_conf commands of
+# services are considered as failed
+SERVICE_TEST_COMMANDS_TIMEOUT = 30
+
+# Number of seconds between two checks of the PID of a service being
+# (re)started, c.f. _give_lock
+GIVE_LOCK_POLL_INTERVAL = 0.05
+
+# Size of the blocks in which log files are read, c.f. _tail
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Connection to systemd, c.f. _get_systemd
+_systemd = None
+
+# Managed services, as returned by _get_services, along with the stamps of
+# the files they come from
+_services_cache = None
 
 logger = getActionLogger('yunohost.service')
 
@@ -299,42 +330,149 @@ def service_status(names=[]):
     # the hack was to add fake services...
     services = {k: v for k, v in services.items() if v.get("status", "") is not None}
 
-    output = {s: _get_and_format_service_status(s, infos) for s, infos in services.items()}
+    # Query systemd about all the services at once, and run all their
+    # test_status / test_conf commands concurrently
+    systemd_services = {s: infos.get("actual_systemd_service", s) for s, infos in services.items()}
+    systemd_infos = _get_services_information_from_systemd(list(set(systemd_services.values())))
+    # (no need to test services which don't exist)
+    test_commands = {(s, test): infos[test]
+                     for s, infos in services.items() for test in ["test_status", "test_conf"]
+                     if test in infos and systemd_infos[systemd_services[s]][0] is not None}
+    test_results = _run_service_test_commands(test_commands)
+
+    output = {}
+    for s, infos in services.items():
+        results = {test: result for (s_, test), result in test_results.items() if s_ == s}
+        output[s] = _get_and_format_service_status(s, infos, systemd_infos[systemd_services[s]], results)
 
     if len(names) == 1:
         return output[names[0]]
     return output
 
 
+def _get_systemd():
+    """
+    Connection to systemd's D-Bus API, shared by the whole process, as
+    (bus, manager interface)
+    """
+    global _systemd
+
+    if _systemd is None:
+        import dbus
+
+        bus = dbus.SystemBus()
+        systemd = bus.get_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1', introspect=False)
+        _systemd = (bus, dbus.Interface(systemd, 'org.freedesktop.systemd1.Manager'))
+
+    return _systemd
+
+
 def _get_service_information_from_systemd(service):
     "this is the equivalent of 'systemctl status $service'"
-    import dbus
 
-    d = dbus.SystemBus()
+    return _get_services_information_from_systemd([service])[service]
+
+
+def _get_services_information_from_systemd(services):
+    """
+    Equivalent of 'systemctl status' for several services at once
+
+    Returns:
+        The properties of each service, as { service: (unit, service) }, or
+        (None, None) if the service doesn't really exist
+    """
+    import dbus
 
-    systemd = d.get_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1')
-    manager = dbus.Interface(systemd, 'org.freedesktop.systemd1.Manager')
+    bus, manager = _get_systemd()
+    units = [service + '.service' for service in services]
 
     # c.f. https://zignar.net/2014/09/08/getting-started-with-dbus-python-systemd/
     # Very interface, much intuitive, wow
-    service_unit = manager.LoadUnit(service + '.service')
-    service_proxy = d.get_object('org.freedesktop.systemd1', str(service_unit))
-    properties_interface = dbus.Interface(service_proxy, 'org.freedesktop.DBus.Properties')
+    # (ListUnitsByNames loads all the units in a single call, and returns
+    # them in the same order, but it only exists since systemd 230)
+    try:
+        unit_paths = [str(u[6]) for u in manager.ListUnitsByNames(units)]
+    except dbus.exceptions.DBusException as e:
+        if e.get_dbus_name() != 'org.freedesktop.DBus.Error.UnknownMethod':
+            raise
+        unit_paths = [str(manager.LoadUnit(unit)) for unit in units]
+
+    infos = {}
+    for service, unit_path in zip(services, unit_paths):
+        service_proxy = bus.get_object('org.freedesktop.systemd1', unit_path, introspect=False)
+        # (an empty interface name gets the properties of all the interfaces
+        # of the unit at once, i.e. the ones of org.freedesktop.systemd1.Unit
+        # and org.freedesktop.systemd1.Service)
+        properties = service_proxy.GetAll('', dbus_interface='org.freedesktop.DBus.Properties')
+
+        if properties.get("LoadState", "not-found") == "not-found":
+            # Service doesn't really exist
+            infos[service] = (None, None)
+        else:
+            infos[service] = (properties, properties)
 
-    unit = properties_interface.GetAll('org.freedesktop.systemd1.Unit')
-    service = properties_interface.GetAll('org.freedesktop.systemd1.Service')
+    return infos
 
-    if unit.get("LoadState", "not-found") == "not-found":
-        # Service doesn't really exist
-        return (None, None)
-    else:
-        return (unit, service)
 
+def _run_service_test_commands(commands, timeout=SERVICE_TEST_COMMANDS_TIMEOUT):
+    """
+    Run the test_status / test_conf commands of services concurrently
+
+    Keyword arguments:
+        commands -- The commands to run, as { key: command }
+        timeout -- Number of seconds after which the commands still running
+            are killed
 
-def _get_and_format_service_status(service, infos):
+    Returns:
+        The result of each command, as { key: (returncode, output) }, the
+        returncode being None if the command timed out
+    """
+    if not commands:
+        return {}
+
+    # (each command gets its own process group, such that it can be killed
+    # along with its children)
+    processes = {key: subprocess.Popen(command,
+                                       shell=True,
+                                       executable='/bin/bash',
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       preexec_fn=os.setsid)
+                 for key, command in commands.items()}
+    timed_out = set()
+
+    def _kill_commands_still_running():
+        for key, p in processes.items():
+            if p.poll() is None:
+                timed_out.add(key)
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    timer = threading.Timer(timeout, _kill_commands_still_running)
+    timer.start()
+    pool = ThreadPool(len(processes))
+    try:
+        keys = processes.keys()
+        outputs = pool.map(lambda key: processes[key].communicate()[0], keys)
+    finally:
+        timer.cancel()
+        pool.close()
+
+    results = {}
+    for key, out in zip(keys, outputs):
+        if key in timed_out:
+            results[key] = (None, out + "\n" + m18n.n("service_test_command_timed_out", timeout=timeout))
+        else:
+            results[key] = (processes[key].returncode, out)
+    return results
+
+
+def _get_and_format_service_status(service, infos, systemd_infos, test_results):
 
     systemd_service = infos.get("actual_systemd_service", service)
-    raw_status, raw_service = _get_service_information_from_systemd(systemd_service)
+    raw_status, raw_service = systemd_infos
 
     if raw_status is None:
         logger.error("Failed to get status information via dbus for service %s, systemctl didn't recognize this service ('NoSuchUnit')." % systemd_service)
@@ -377,15 +515,8 @@ def _get_and_format_service_status(service, infos):
 
     # 'test_status' is an optional field to test the status of the service using a custom command
     if "test_status" in infos:
-        p = subprocess.Popen(infos["test_status"],
-                             shell=True,
-                             executable='/bin/bash',
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-
-        p.communicate()
-
-        output["status"] = "running" if p.returncode == 0 else "failed"
+        returncode, _ = test_results["test_status"]
+        output["status"] = "running" if returncode == 0 else "failed"
     elif raw_service.get("Type", "").lower() == "oneshot" and output["status"] == "exited":
         # These are services like yunohost-firewall, hotspot, vpnclient,
         # ... they will be "exited" why doesn't provide any info about
@@ -395,14 +526,8 @@ def _get_and_format_service_status(service, infos):
 
     # 'test_status' is an optional field to test the status of the service using a custom command
     if "test_conf" in infos:
-        p = subprocess.Popen(infos["test_conf"],
-                             shell=True,
-                             executable='/bin/bash',
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-
-        out, _ = p.communicate()
-        if p.returncode == 0:
+        returncode, out = test_results["test_conf"]
+        if returncode == 0:
             output["configuration"] = "valid"
         else:
             output["configuration"] = "broken"
@@ -411,13 +536,14 @@ def _get_and_format_service_status(service, infos):
     return output
 
 
-def service_log(name, number=50):
+def service_log(name, number=50, follow=False):
     """
     Log every log files of a service
 
     Keyword argument:
         name -- Service name to log
         number -- Number of lines to display
+        follow -- Then keep displaying the new lines of the logs
 
     """
     services = _get_services()
@@ -440,8 +566,13 @@ def service_log(name, number=50):
     result = {}
 
     # First we always add the logs from journalctl / systemd
-    result["journalctl"] = _get_journalctl_logs(name, number).splitlines()
+    if follow:
+        journal, cursor = _get_journalctl_logs(name, number, with_cursor=True)
+    else:
+        journal = _get_journalctl_logs(name, number)
+    result["journalctl"] = journal.splitlines()
 
+    log_files = []
     for log_path in log_list:
 
         if not os.path.exists(log_path):
@@ -452,7 +583,7 @@ def service_log(name, number=50):
 
         # log is a file, read it
         if os.path.isfile(log_path):
-            result[log_path] = _tail(log_path, number)
+            log_files.append(log_path)
             continue
         elif not os.path.isdir(log_path):
             result[log_path] = []
@@ -467,9 +598,31 @@ def service_log(name, number=50):
             if not log_file.endswith(".log"):
                 continue
 
-            result[log_file_path] = _tail(log_file_path, number) if os.path.exists(log_file_path) else []
+            log_files.append(log_file_path)
+
+    positions = {}
+    for log_file in log_files:
+        if os.path.exists(log_file):
+            result[log_file], positions[log_file] = _tail(log_file, number, with_position=True)
+        else:
+            result[log_file], positions[log_file] = [], None
+
+    if not follow:
+        return result
 
-    return result
+    from yunohost.utils.follow import follow_logs, print_logs
+
+    # The files are followed from where their last lines were read (and the
+    # journal from the cursor of its last entry), such that nothing written
+    # in the meantime gets lost or displayed twice
+    systemd_service = services[name].get("actual_systemd_service", name)
+    followed = follow_logs(positions, journal=(systemd_service, cursor))
+    try:
+        sources = ["journalctl"] + sorted(path for path in result if path != "journalctl")
+        print_logs(itertools.chain(((source, line) for source in sources for line in result[source]),
+                                   followed))
+    finally:
+        followed.close()
 
 
 def service_regen_conf(names=[], with_diff=False, force=False, dry_run=False,
@@ -553,42 +706,87 @@ def _give_lock(action, service, p):
     else:
         systemctl_PID_name = "ControlPID"
 
-    cmd_get_son_PID = "systemctl show %s -p %s" % (service, systemctl_PID_name)
+    # The PID is read through the connection to systemd rather than by
+    # calling 'systemctl show' each time, such that we can check it often
+    bus, manager = _get_systemd()
+    unit_path = str(manager.LoadUnit(service + '.service'))
+    unit = bus.get_object('org.freedesktop.systemd1', unit_path, introspect=False)
+
     son_PID = 0
     # As long as we did not found the PID and that the command is still running
     while son_PID == 0 and p.poll() is None:
-        # Call systemctl to get the PID
-        # Output of the command is e.g. ControlPID=1234
-        son_PID = subprocess.check_output(cmd_get_son_PID.split()) \
-                            .strip().split("=")[1]
-        son_PID = int(son_PID)
-        time.sleep(1)
+        son_PID = int(unit.Get('org.freedesktop.systemd1.Service', systemctl_PID_name,
+                               dbus_interface='org.freedesktop.DBus.Properties'))
+        if son_PID == 0:
+            time.sleep(GIVE_LOCK_POLL_INTERVAL)
 
     # If we found a PID
     if son_PID != 0:
         # Append the PID to the lock file
         logger.debug("Giving a lock to PID %s for service %s !"
                      % (str(son_PID), service))
-        append_to_file(MOULINETTE_LOCK, "\n%s" % str(son_PID))
+        _update_lock(lambda PIDs: PIDs + [str(son_PID)])
 
     return son_PID
 
 
 def _remove_lock(PID_to_remove):
-    # FIXME ironically not concurrency safe because it's not atomic...
 
-    PIDs = read_file(MOULINETTE_LOCK).split("\n")
-    PIDs_to_keep = [PID for PID in PIDs if int(PID) != PID_to_remove]
-    write_to_file(MOULINETTE_LOCK, '\n'.join(PIDs_to_keep))
+    _update_lock(lambda PIDs: [PID for PID in PIDs if int(PID) != PID_to_remove])
+
+
+def _update_lock(update):
+    """
+    Update the list of PIDs in the lock file, atomically (such that moulinette
+    never reads a half-written lock) and under flock (such that concurrent
+    updates don't overwrite each other)
+
+    Keyword argument:
+        update -- Function returning the new list of PIDs from the current one
+    """
+
+    with open(MOULINETTE_LOCK_GUARD, 'a') as guard:
+        fcntl.flock(guard, fcntl.LOCK_EX)
+        try:
+            # (if the lock was released in the meantime, don't re-create it)
+            if not os.path.exists(MOULINETTE_LOCK):
+                return
+            PIDs = [PID for PID in read_file(MOULINETTE_LOCK).split("\n") if PID.strip()]
+            write_to_file_atomically(MOULINETTE_LOCK, '\n'.join(update(PIDs)))
+        finally:
+            fcntl.flock(guard, fcntl.LOCK_UN)
 
 
 def _get_services():
     """
     Get a dict of managed services with their parameters
 
+    The result is kept until services.yml or sshd_config change, such that
+    the many calls during a single command don't re-parse them each time
     """
+    global _services_cache
+
+    stamps = tuple(_file_stamp(path) for path in [SERVICES_CONF, SSHD_CONFIG])
+    if _services_cache is None or _services_cache[0] != stamps:
+        _services_cache = (stamps, _load_services())
+
+    # (callers are free to alter it)
+    return copy.deepcopy(_services_cache[1])
+
+
+def _file_stamp(path):
+
     try:
-        with open('/etc/yunohost/services.yml', 'r') as f:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+def _load_services():
+
+    try:
+        with open(SERVICES_CONF, 'r') as f:
             services = yaml.load(f) or {}
     except:
         return {}
@@ -600,7 +798,7 @@ def _get_services():
             del services[key]
 
     # Dirty hack to automatically find custom SSH port ...
-    ssh_port_line = re.findall(r"\bPort *([0-9]{2,5})\b", read_file("/etc/ssh/sshd_config"))
+    ssh_port_line = re.findall(r"\bPort *([0-9]{2,5})\b", read_file(SSHD_CONFIG))
     if len(ssh_port_line) == 1:
         services["ssh"]["needs_exposed_ports"] = [int(ssh_port_line[0])]
 
@@ -631,67 +829,126 @@ def _save_services(services):
         services -- A dict of managed services with their parameters
 
     """
+    global _services_cache
+
     try:
-        with open('/etc/yunohost/services.yml', 'w') as f:
-            yaml.safe_dump(services, f, default_flow_style=False)
+        write_to_file_atomically(SERVICES_CONF, yaml.safe_dump(services, default_flow_style=False))
     except Exception as e:
         logger.warning('Error while saving services, exception: %s', e, exc_info=1)
         raise
+    finally:
+        _services_cache = None
 
 
-def _tail(file, n, filters=[]):
+def _tail(file, n, filters=[], with_position=False):
     """
-    Reads a n lines from f with an offset of offset lines.  The return
-    value is a tuple in the form ``(lines, has_more)`` where `has_more` is
-    an indicator that is `True` if there are more lines in the file.
+    Return the last n lines of a log file, skipping the lines matching one of
+    the filters (regexes).
 
     This function works even with splitted logs (gz compression, log rotate...)
+    : if the file doesn't have enough lines, the previous ones (file.1,
+    file.2.gz, ...) are read too, until there are n lines.
+
+    With with_position, (lines, position) is returned, position being the
+    (inode, offset) of the end of the file when it was read, from which it
+    can be followed (c.f. follow_logs), or None if it wasn't read.
     """
-    avg_line_length = 74
-    to_read = n
 
     if filters:
         filters = [re.compile(f) for f in filters]
 
-    try:
-        if file.endswith(".gz"):
-            import gzip
-            f = gzip.open(file)
-            lines = f.read().splitlines()
-        else:
-            f = open(file)
-            pos = 1
-            lines = []
-            while len(lines) < to_read and pos > 0:
-                try:
-                    f.seek(-(avg_line_length * to_read), 2)
-                except IOError:
-                    # woops.  apparently file is smaller than what we want
-                    # to step back, go to the beginning instead
-                    f.seek(0)
+    lines = []
+    position = None
+    first_file = True
+    while file is not None and len(lines) < n:
+        try:
+            if file.endswith(".gz"):
+                lines = _tail_gzip_file(file, n - len(lines), filters) + lines
+            else:
+                file_lines, file_position = _tail_file(file, n - len(lines), filters)
+                lines = file_lines + lines
+                if first_file:
+                    position = file_position
+        except (IOError, zlib.error) as e:
+            logger.warning("Error while tailing file '%s': %s", file, e, exc_info=1)
+            break
+
+        file = _find_previous_log_file(file)
+        first_file = False
+
+    return (lines, position) if with_position else lines
+
+
+def _tail_file(file, n, filters):
+    """
+    Last n lines of a (plain) file, read by blocks from the end of the file,
+    and the (inode, offset) of that end
+    """
+
+    lines = []
+    with open(file) as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        position = (os.fstat(f.fileno()).st_ino, pos)
+
+        if pos == 0:
+            return [], position
+
+        # (the last line ends with a newline, which doesn't start a new line)
+        f.seek(pos - 1)
+        if f.read(1) == "\n":
+            pos -= 1
+
+        # First line of the blocks read so far, which is incomplete until we
+        # read the previous block
+        first_line = ""
+        while pos > 0 and len(lines) < n:
+            size = min(TAIL_BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            block_lines = (f.read(size) + first_line).split("\n")
+            first_line = block_lines.pop(0)
+            lines = _filter_lines(block_lines, filters) + lines
+
+        if pos == 0:
+            lines = _filter_lines([first_line], filters) + lines
+
+    return lines[-n:], position
+
+
+def _tail_gzip_file(file, n, filters):
+    """
+    Last n lines of a gzip'ed file, decompressed on the fly such that only
+    those are kept in memory
+    """
 
-                pos = f.tell()
-                lines = f.read().splitlines()
+    lines = collections.deque(maxlen=n)
+    last_line = ""
+    # (16 + MAX_WBITS to handle the gzip header)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(file, "rb") as f:
+        for data in iter(lambda: f.read(TAIL_BLOCK_SIZE), ""):
+            while data:
+                block_lines = (last_line + decompressor.decompress(data)).split("\n")
+                last_line = block_lines.pop()
+                lines.extend(_filter_lines(block_lines, filters))
 
-                for filter_ in filters:
-                    lines = [l for l in lines if not filter_.search(l)]
+                # Gzip files may be made of several members
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
-                if len(lines) >= to_read:
-                    return lines[-to_read:]
+    if last_line:
+        lines.extend(_filter_lines([last_line], filters))
 
-                avg_line_length *= 1.3
-        f.close()
+    return list(lines)
 
-    except IOError as e:
-        logger.warning("Error while tailing file '%s': %s", file, e, exc_info=1)
-        return []
 
-    if len(lines) < to_read:
-        previous_log_file = _find_previous_log_file(file)
-        if previous_log_file is not None:
-            lines = _tail(previous_log_file, to_read - len(lines)) + lines
+def _filter_lines(lines, filters):
 
-    return lines
+    if not filters:
+        return lines
+    return [l for l in lines if not any(filter_.search(l) for filter_ in filters)]
 
 
 def _find_previous_log_file(file):
@@ -718,11 +975,24 @@ def _find_previous_log_file(file):
     return None
 
 
-def _get_journalctl_logs(service, number="all"):
+def _get_journalctl_logs(service, number="all", with_cursor=False):
     services = _get_services()
     systemd_service = services.get(service, {}).get("actual_systemd_service", service)
     try:
-        return subprocess.check_output("journalctl --no-hostname -xn -u {0} -n{1}".format(systemd_service, number), shell=True)
+        logs = subprocess.check_output("journalctl --no-hostname -xn -u {0} -n{1}{2}".format(systemd_service, number, " --show-cursor" if with_cursor else ""), shell=True)
     except:
         import traceback
-        return "error while get services logs from journalctl:\n%s" % traceback.format_exc()
+        logs = "error while get services logs from journalctl:\n%s" % traceback.format_exc()
+        return (logs, None) if with_cursor else logs
+
+    if not with_cursor:
+        return logs
+
+    # The last line is then the cursor of the last entry, from which the
+    # journal can be followed (c.f. follow_logs)
+    cursor = None
+    lines = logs.rstrip("\n").split("\n")
+    if lines[-1].startswith("-- cursor: "):
+        cursor = lines.pop()[len("-- cursor: "):]
+        logs = "\n".join(lines) + "\n"
+    return logs, cursor
@@ -71,6 +71,8 @@ DEFAULTS = OrderedDict([
         "choices": ["intermediate", "modern"]}),
     ("pop3.enabled", {"type": "bool", "default": False}),
     ("smtp.allow_ipv6", {"type": "bool", "default": True}),
+    ("ssowat.conf.format", {"type": "enum", "default": "legacy",
+        "choices": ["legacy", "compact"]}),
 ])
 
 
@@ -327,6 +329,12 @@ def reconfigure_postfix(setting_name, old_value, new_value):
     if old_value != new_value:
         service_regen_conf(names=['postfix'])
 
+@post_change_hook("ssowat.conf.format")
+def reconfigure_ssowat(setting_name, old_value, new_value):
+    if old_value != new_value:
+        from yunohost.app import app_ssowatconf
+        app_ssowatconf()
+
 @post_change_hook("pop3.enabled")
 def reconfigure_dovecot(setting_name, old_value, new_value):
     dovecot_package = 'dovecot-pop3d'
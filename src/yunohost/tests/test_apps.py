@@ -1,8 +1,10 @@
 import glob
 import os
+import re
 import pytest
 import shutil
 import requests
+import subprocess
 
 from conftest import message, raiseYunohostError, get_test_apps_dir
 
@@ -15,7 +17,16 @@ from yunohost.app import (
     _is_installed,
     app_upgrade,
     app_map,
+    app_setting,
+    app_info,
+    _extract_app_from_file,
+    _fetch_app_from_git,
+    _add_app_package_to_cache,
+    _prefetch_app_packages,
+    _prune_app_packages_cache,
+    APP_PACKAGES_CACHE,
 )
+from yunohost.log import OPERATIONS_PATH
 from yunohost.domain import _get_maindomain, domain_add, domain_remove, domain_list
 from yunohost.utils.error import YunohostError
 from yunohost.tests.test_permission import (
@@ -192,6 +203,27 @@ def test_legacy_app_install_main_domain():
     assert app_is_not_installed(main_domain, "legacy_app")
 
 
+def test_legacy_app_settings_and_manifest_through_apps_registry():
+
+    main_domain = _get_maindomain()
+
+    install_legacy_app(main_domain, "/legacy")
+
+    assert "name" in app_info("legacy_app")
+    assert app_setting("legacy_app", "foo") is None
+
+    # Values with the same length, set right after one another, to make sure
+    # changes are not hidden by the registry
+    for value in ["bar", "baz", "bar"]:
+        app_setting("legacy_app", "foo", value=value)
+        assert app_setting("legacy_app", "foo") == value
+        assert app_info("legacy_app", full=True)["settings"]["foo"] == value
+
+    app_remove("legacy_app")
+
+    assert app_is_not_installed(main_domain, "legacy_app")
+
+
 def test_legacy_app_install_secondary_domain(secondary_domain):
 
     install_legacy_app(secondary_domain, "/legacy")
@@ -204,6 +236,29 @@ def test_legacy_app_install_secondary_domain(secondary_domain):
     assert app_is_not_installed(secondary_domain, "legacy_app")
 
 
+def test_legacy_app_install_with_profile(secondary_domain):
+
+    app_install(
+        os.path.join(get_test_apps_dir(), "legacy_app_ynh"),
+        args="domain=%s&path=/legacy&is_public=1" % secondary_domain,
+        force=True,
+        profile=True,
+    )
+
+    assert app_is_installed(secondary_domain, "legacy_app")
+
+    profile_path = max(glob.glob(OPERATIONS_PATH + "*.profile"), key=os.path.getmtime)
+    profile = open(profile_path).read()
+    assert "/scripts/install" in profile
+    assert "Helpers" in profile and "Script lines" in profile
+
+    folded = open(profile_path[:-len(".profile")] + ".folded").read().strip().split("\n")
+    assert folded
+    assert all(re.match(r"^install;install:\d+(;\S+)* \d+$", line) for line in folded)
+
+    app_remove("legacy_app")
+
+
 def test_legacy_app_install_secondary_domain_on_root(secondary_domain):
 
     install_legacy_app(secondary_domain, "/")
@@ -393,3 +448,58 @@ def test_failed_multiple_app_upgrade(mocker, secondary_domain):
                     "legacy": os.path.join(get_test_apps_dir(), "legacy_app_ynh"),
                 },
             )
+
+
+def test_app_packages_cache(mocker):
+
+    shutil.rmtree(APP_PACKAGES_CACHE, ignore_errors=True)
+
+    url = "https://example.com/legacy_app_ynh"
+    revision = "c0ffee" + "0" * 34
+    catalog = {"apps": {"legacy_app": {"lastUpdate": 0,
+                                       "git": {"url": url, "branch": "master", "revision": revision},
+                                       "manifest": {"id": "legacy_app"}}}}
+    mocker.patch("yunohost.app._load_apps_catalog", return_value=catalog)
+
+    # Put the package in the cache as if it was just downloaded
+    _, extracted_app_folder = _extract_app_from_file(os.path.join(get_test_apps_dir(), "legacy_app_ynh"))
+    _add_app_package_to_cache(url, revision, extracted_app_folder)
+    assert len(os.listdir(APP_PACKAGES_CACHE)) == 1
+
+    # Fetching the app doesn't download it again
+    check_call = mocker.spy(subprocess, "check_call")
+    manifest, extracted_app_folder = _fetch_app_from_git("legacy_app")
+    assert not any(call[0][0][0] in ["wget", "git"] for call in check_call.call_args_list)
+    assert manifest["id"] == "legacy_app"
+    assert manifest["remote"]["revision"] == revision
+    assert os.path.exists(os.path.join(extracted_app_folder, "scripts/install"))
+
+    # The least recently used packages get evicted
+    _prune_app_packages_cache(max_size=0)
+    assert os.listdir(APP_PACKAGES_CACHE) == []
+
+
+def test_app_packages_prefetch(mocker):
+
+    shutil.rmtree(APP_PACKAGES_CACHE, ignore_errors=True)
+
+    url = "https://example.com/legacy_app_ynh"
+    revision = "c0ffee" + "0" * 34
+    catalog = {"apps": {"legacy_app": {"lastUpdate": 0,
+                                       "git": {"url": url, "branch": "master", "revision": revision},
+                                       "manifest": {"id": "legacy_app"}}}}
+    mocker.patch("yunohost.app._load_apps_catalog", return_value=catalog)
+
+    def fake_prefetch(url, branch, revision):
+        _add_app_package_to_cache(url, revision, os.path.join(get_test_apps_dir(), "legacy_app_ynh"))
+
+    prefetch = mocker.patch("yunohost.app._prefetch_app_package", side_effect=fake_prefetch)
+
+    # Several instances of the same app only need a single download
+    _prefetch_app_packages(["legacy_app", "legacy_app__2"])
+    prefetch.assert_called_once_with(url, "master", revision)
+
+    # ... and nothing needs to be downloaded anymore afterwards
+    _prefetch_app_packages(["legacy_app"])
+    assert prefetch.call_count == 1
+    assert _fetch_app_from_git("legacy_app")[0]["remote"]["revision"] == revision
@@ -4,6 +4,8 @@ import requests
 import requests_mock
 import glob
 import shutil
+import threading
+import BaseHTTPServer
 
 from moulinette import m18n
 from moulinette.utils.filesystem import read_json, write_to_json, write_to_yaml, mkdir
@@ -37,6 +39,43 @@ DUMMY_APP_CATALOG = """{
 }
 """
 
+
+class DummyAppsCatalogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # The If-None-Match header received for each request
+    received_if_none_match = []
+
+    def do_GET(self):
+        if_none_match = self.headers.get("If-None-Match")
+        DummyAppsCatalogHandler.received_if_none_match.append(if_none_match)
+        if if_none_match == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(DUMMY_APP_CATALOG)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_apps_catalog_server(request):
+
+    DummyAppsCatalogHandler.received_if_none_match = []
+
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), DummyAppsCatalogHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    request.addfinalizer(server.shutdown)
+
+    return "http://127.0.0.1:%s" % server.server_port
+
+
 class AnyStringWith(str):
     def __eq__(self, other):
         return self in other
@@ -216,6 +255,42 @@ def test_apps_catalog_update_corrupted(mocker):
             m18n.n.assert_any_call("apps_catalog_failed_to_download")
 
 
+def test_apps_catalog_update_not_modified(local_apps_catalog_server):
+
+    # Initialize ...
+    _initialize_apps_catalog_system()
+
+    conf = [{"id": "default", "url": local_apps_catalog_server},
+            {"id": "default2", "url": local_apps_catalog_server + "/other"}]
+
+    write_to_yaml(APPS_CATALOG_CONF, conf)
+
+    # First update : everything is downloaded
+    _update_apps_catalog()
+    assert DummyAppsCatalogHandler.received_if_none_match == [None, None]
+
+    cache_file = APPS_CATALOG_CACHE + "/default.json"
+    cache_mtime = os.path.getmtime(cache_file)
+
+    # Second update : nothing changed, so the cache is not rewritten
+    _update_apps_catalog()
+    assert DummyAppsCatalogHandler.received_if_none_match[2:] == ['"v1"', '"v1"']
+    assert os.path.getmtime(cache_file) == cache_mtime
+
+    # If the cache got tweaked in the meantime, the catalog gets downloaded again
+    cache_json = read_json(cache_file)
+    cache_json["from_api_version"] = 0
+    write_to_json(cache_file, cache_json)
+
+    _update_apps_catalog()
+    assert sorted(DummyAppsCatalogHandler.received_if_none_match[4:]) == [None, '"v1"']
+    assert read_json(cache_file)["from_api_version"] == APPS_CATALOG_API_VERSION
+
+    app_dict = _load_apps_catalog()["apps"]
+    assert "foo" in app_dict.keys()
+    assert "bar" in app_dict.keys()
+
+
 def test_apps_catalog_load_with_empty_cache(mocker):
 
     # Initialize ...
@@ -370,3 +445,70 @@ def test_apps_catalog_migrate_legacy_implicitly():
     assert "/bin/bash" in open(APPS_CATALOG_CRON_PATH, "r").read()
     assert cron_job_is_there()
 
+
+
+def test_apps_catalog_load_projections_and_memoization():
+
+    # Initialize ...
+    _initialize_apps_catalog_system()
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("GET", APPS_CATALOG_DEFAULT_URL_FULL, text=DUMMY_APP_CATALOG)
+        _update_apps_catalog()
+
+    summary = _load_apps_catalog(projection="summary")
+    assert summary["apps"]["foo"] == {"description": "Foo", "level": 4}
+    assert [c["id"] for c in summary["categories"]] == ["yolo", "swag"]
+
+    versions = _load_apps_catalog(projection="versions")
+    assert versions["apps"]["bar"] == {"manifest": {}}
+
+    # Loading the catalog again reuses what was already loaded
+    assert _load_apps_catalog() is _load_apps_catalog()
+
+    catalog = app_catalog(with_categories=True)
+    assert catalog["apps"]["bar"] == {"description": "Bar", "level": 7}
+    assert catalog["categories"][0] == {"id": "yolo", "description": "YoLo"}
+
+    # Updating the catalog invalidates the memoized catalog
+    with requests_mock.Mocker() as m:
+        m.register_uri("GET", APPS_CATALOG_DEFAULT_URL_FULL, text=DUMMY_APP_CATALOG.replace('"level": 4', '"level": 8'))
+        _update_apps_catalog()
+
+    assert _load_apps_catalog()["apps"]["foo"]["level"] == 8
+    assert _load_apps_catalog(projection="summary")["apps"]["foo"]["level"] == 8
+
+
+def test_apps_catalog_search():
+
+    # Initialize ...
+    _initialize_apps_catalog_system()
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("GET", APPS_CATALOG_DEFAULT_URL_FULL, text=DUMMY_APP_CATALOG)
+        _update_apps_catalog()
+
+    catalog = app_catalog(query="fo")
+    assert catalog["apps"].keys() == ["foo"]
+    assert catalog["apps"]["foo"] == {"description": "Foo", "level": 4}
+    assert catalog["total"] == 1
+
+    assert app_catalog(query="swag")["apps"].keys() == ["bar"]
+    assert app_catalog(query="foo bar")["apps"].keys() == []
+    assert app_catalog(category="yolo")["apps"].keys() == ["foo"]
+    assert app_catalog(level=5, full=True)["apps"]["bar"]["manifest"]["description"] == "Bar"
+    assert app_catalog(level=8)["apps"].keys() == []
+
+    # Pagination
+    assert app_catalog(limit=1)["apps"].keys() == ["bar"]
+    catalog = app_catalog(offset=1, limit=1)
+    assert catalog["apps"].keys() == ["foo"]
+    assert catalog["total"] == 2
+
+    with pytest.raises(YunohostError):
+        app_catalog(offset=-1)
+    with pytest.raises(YunohostError):
+        app_catalog(limit=-1)
+
+    # Without search arguments, the output is unchanged
+    assert "total" not in app_catalog()
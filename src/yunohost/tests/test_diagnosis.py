@@ -0,0 +1,290 @@
+import os
+import imp
+import time
+import shutil
+import logging
+
+from moulinette.utils.filesystem import read_json, write_to_json
+
+from yunohost.diagnosis import Diagnoser, DIAGNOSIS_CACHE, _invalidate_diagnosis_cache, _list_diagnosis_categories, \
+    _run_diagnosis_categories
+from yunohost.log import OperationLogger
+
+DIAGNOSIS_CACHE_BACKUP = "/tmp/yunohost_test_diagnosis_cache"
+
+
+def setup_function(function):
+
+    # Start from reports of all the categories diagnosed without issues (the
+    # actual cache is restored afterwards)
+    if os.path.exists(DIAGNOSIS_CACHE_BACKUP):
+        shutil.rmtree(DIAGNOSIS_CACHE_BACKUP)
+    if os.path.exists(DIAGNOSIS_CACHE):
+        shutil.move(DIAGNOSIS_CACHE, DIAGNOSIS_CACHE_BACKUP)
+    os.makedirs(DIAGNOSIS_CACHE)
+
+    for category, _ in _list_diagnosis_categories():
+        write_to_json(Diagnoser.cache_file(category),
+                      {"id": category, "cached_for": 3600, "items": []})
+
+
+def teardown_function(function):
+
+    if os.path.exists(DIAGNOSIS_CACHE):
+        shutil.rmtree(DIAGNOSIS_CACHE)
+    if os.path.exists(DIAGNOSIS_CACHE_BACKUP):
+        shutil.move(DIAGNOSIS_CACHE_BACKUP, DIAGNOSIS_CACHE)
+
+
+def get_diagnoser(category, class_name, args=None):
+
+    path = dict(_list_diagnosis_categories())[category]
+    module = imp.load_source("test_diagnosis_%s" % category, path)
+    loggers = (lambda m: None,) * 3
+    return getattr(module, class_name)(args, None, loggers)
+
+
+def write_cached_report(category, items, cached_at):
+
+    cache_file = Diagnoser.cache_file(category)
+    write_to_json(cache_file, {"id": category, "cached_for": 3600, "items": items})
+    os.utime(cache_file, (cached_at, cached_at))
+
+
+def domain_item(domain, status="SUCCESS"):
+
+    return {"meta": {"domain": domain, "category": "basic"},
+            "data": {},
+            "status": status,
+            "summary": "diagnosis_dns_good_conf" if status == "SUCCESS" else "diagnosis_dns_bad_conf"}
+
+
+def test_domain_operation_invalidates_dnsrecords_and_web():
+
+    operation_logger = OperationLogger("domain_add", [("domain", "domain.tld")])
+    operation_logger.start()
+    operation_logger.success()
+
+    for category, _ in _list_diagnosis_categories():
+        if category in ["dnsrecords", "web"]:
+            assert Diagnoser.get_invalidations(category) == [("domain", "domain.tld")]
+        else:
+            assert Diagnoser.get_invalidations(category) == []
+
+
+def test_partial_run_keeps_the_items_of_other_domains_and_expiration(mocker):
+
+    expiration_item = {"meta": {"test": "domain_expiration"},
+                       "data": {},
+                       "status": "SUCCESS",
+                       "summary": "diagnosis_domain_expiration_success"}
+    cached_at = time.time() - 600
+    write_cached_report("dnsrecords", [domain_item("domain.tld"), domain_item("other.tld"), expiration_item],
+                        cached_at)
+
+    _invalidate_diagnosis_cache([("domain", "domain.tld")])
+
+    diagnoser = get_diagnoser("dnsrecords", "DNSRecordsDiagnoser")
+
+    def run():
+        assert diagnoser.restrict_to == {"domain": set(["domain.tld"])}
+        yield domain_item("domain.tld", status="ERROR")
+
+    mocker.patch.object(diagnoser, "run", side_effect=run)
+    diagnoser.diagnose()
+
+    items = read_json(Diagnoser.cache_file("dnsrecords"))["items"]
+    assert len(items) == 3
+    assert domain_item("domain.tld", status="ERROR") in items
+    assert domain_item("other.tld") in items
+    assert expiration_item in items
+
+    # The report still expires when the other items do
+    assert abs(os.path.getmtime(Diagnoser.cache_file("dnsrecords")) - cached_at) < 1
+    assert Diagnoser.get_invalidations("dnsrecords") == []
+
+
+def test_partial_run_keeps_the_hairpinning_item(mocker):
+
+    hairpinning_item = {"meta": {"test": "hairpinning"},
+                        "data": {},
+                        "status": "WARNING",
+                        "summary": "diagnosis_http_hairpinning_issue"}
+    write_cached_report("web", [{"meta": {"domain": "domain.tld"},
+                                 "data": {},
+                                 "status": "SUCCESS",
+                                 "summary": "diagnosis_http_ok"},
+                                hairpinning_item],
+                        time.time() - 600)
+
+    _invalidate_diagnosis_cache([("domain", "domain.tld")])
+
+    diagnoser = get_diagnoser("web", "WebDiagnoser")
+
+    def run():
+        assert diagnoser.restrict_to == {"domain": set(["domain.tld"])}
+        # (e.g. the domain isn't reachable anymore)
+        return []
+
+    mocker.patch.object(diagnoser, "run", side_effect=run)
+    diagnoser.diagnose()
+
+    assert read_json(Diagnoser.cache_file("web"))["items"] == [hairpinning_item]
+
+
+def test_invalidations_recorded_during_a_run_are_kept(mocker):
+
+    _invalidate_diagnosis_cache([("domain", "domain.tld")])
+
+    diagnoser = get_diagnoser("dnsrecords", "DNSRecordsDiagnoser")
+
+    def run():
+        # e.g. another domain gets added meanwhile
+        _invalidate_diagnosis_cache([("domain", "other.tld")])
+        yield domain_item("domain.tld")
+
+    mocker.patch.object(diagnoser, "run", side_effect=run)
+    diagnoser.diagnose()
+
+    assert Diagnoser.get_invalidations("dnsrecords") == [("domain", "other.tld")]
+
+
+def run_categories(mocker, categories, hooks, force=False):
+    """
+    Run the diagnosis of the categories, the hook of each one being replaced
+    by hooks[category], called with the args given to the hook
+    """
+
+    def hook_exec(path, args=None, env=None):
+        category = os.path.splitext(os.path.basename(path))[0].split("-")[1]
+        return hooks[category](args)
+
+    mocker.patch("yunohost.diagnosis.hook_exec", side_effect=hook_exec)
+    return _run_diagnosis_categories(categories, dict(_list_diagnosis_categories()), force)
+
+
+def test_run_categories_dependents_wait_for_ip(mocker):
+
+    events = []
+
+    def hook(category, duration=0):
+        def _hook(args):
+            events.append("start %s" % category)
+            time.sleep(duration)
+            events.append("end %s" % category)
+            return 0, {"id": category}
+        return _hook
+
+    reports = run_categories(mocker, ["ip", "dnsrecords", "web", "services"],
+                             {"ip": hook("ip", 0.5),
+                              "dnsrecords": hook("dnsrecords"),
+                              "web": hook("web"),
+                              "services": hook("services")})
+
+    assert sorted(reports) == ["dnsrecords", "ip", "services", "web"]
+    assert events.index("end ip") < events.index("start dnsrecords")
+    assert events.index("end ip") < events.index("start web")
+    # (services doesn't depend on ip)
+    assert events.index("end services") < events.index("end ip")
+
+
+def test_run_categories_failed_dependency_skips_dependents(mocker):
+
+    error_item = {"meta": {"test": "ipv4"},
+                  "data": {},
+                  "status": "ERROR",
+                  "summary": "diagnosis_ip_no_ipv4"}
+
+    def ip(args):
+        # (the dependents would run if they read the cache written by the
+        # setup)
+        time.sleep(0.5)
+        write_cached_report("ip", [error_item], time.time())
+        return 0, {"id": "ip"}
+
+    def dnsrecords(args):
+        diagnoser = get_diagnoser("dnsrecords", "DNSRecordsDiagnoser", args)
+        mocker.patch.object(diagnoser, "run", side_effect=AssertionError("shouldn't run"))
+        return diagnoser.diagnose()
+
+    from moulinette import m18n
+    mocker.spy(m18n, "n")
+
+    reports = run_categories(mocker, ["ip", "dnsrecords"], {"ip": ip, "dnsrecords": dnsrecords}, force=True)
+
+    assert reports["dnsrecords"] == {}
+    m18n.n.assert_any_call("diagnosis_cant_run_because_of_dep",
+                           category=Diagnoser.get_description("dnsrecords"),
+                           dep=Diagnoser.get_description("ip"))
+
+
+def test_run_categories_logs_displayed_in_order(mocker):
+
+    from yunohost.diagnosis import logger
+
+    class Handler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    handler = Handler()
+    logging.getLogger("yunohost").addHandler(handler)
+
+    events = []
+
+    def ip(args):
+        time.sleep(0.5)
+        logger.warning("from ip")
+        events.append("end ip")
+        return 0, {"id": "ip"}
+
+    def services(args):
+        logger.warning("from services")
+        events.append("end services")
+        return 0, {"id": "services"}
+
+    try:
+        run_categories(mocker, ["ip", "services"], {"ip": ip, "services": services})
+    finally:
+        logging.getLogger("yunohost").removeHandler(handler)
+
+    # services is done first, but its logs are displayed after the ones of ip
+    assert events == ["end services", "end ip"]
+    assert [m for m in handler.messages if m.startswith("from ")] == ["from ip", "from services"]
+
+
+def test_run_categories_cache_and_force(mocker):
+
+    ran = []
+
+    def hook(category, class_name, item):
+        def _hook(args):
+            diagnoser = get_diagnoser(category, class_name, args)
+
+            def run():
+                ran.append(category)
+                yield item
+
+            mocker.patch.object(diagnoser, "run", side_effect=run)
+            return diagnoser.diagnose()
+        return _hook
+
+    ok_item = {"meta": {"test": "ipv4"},
+               "data": {},
+               "status": "SUCCESS",
+               "summary": "diagnosis_ip_connected_ipv4"}
+    hooks = {"ip": hook("ip", "IPDiagnoser", ok_item),
+             "dnsrecords": hook("dnsrecords", "DNSRecordsDiagnoser", domain_item("domain.tld"))}
+
+    # The reports cached by the setup are still valid
+    reports = run_categories(mocker, ["ip", "dnsrecords"], hooks)
+    assert reports == {"ip": {}, "dnsrecords": {}}
+    assert ran == []
+
+    reports = run_categories(mocker, ["ip", "dnsrecords"], hooks, force=True)
+    assert ran == ["ip", "dnsrecords"]
+    assert reports["ip"]["items"][0]["meta"] == ok_item["meta"]
+    assert read_json(Diagnoser.cache_file("dnsrecords"))["items"] == [domain_item("domain.tld")]
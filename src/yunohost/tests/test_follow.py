@@ -0,0 +1,116 @@
+import os
+
+from yunohost.service import _tail
+from yunohost.utils.follow import follow_logs, _FollowedFile, _inotify_init, _inotify_add_watch, \
+    _inotify_read_paths, IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE
+
+
+def test_followed_file_appended(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("old line\n")
+    followed = _FollowedFile(str(log))
+
+    assert followed.read_new_lines() == []
+
+    log.write("line1\nline", mode="a")
+    assert followed.read_new_lines() == ["line1"]
+
+    # (partial lines are completed first)
+    log.write("2\nline3\n", mode="a")
+    assert followed.read_new_lines() == ["line2", "line3"]
+
+    followed.close()
+
+
+def test_followed_file_rotated(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("old line\n")
+    followed = _FollowedFile(str(log))
+
+    # The rest of the old file is read, then the new one from its beginning
+    log.write("last line of the old file\n", mode="a")
+    log.rename(tmpdir.join("test.log.1"))
+    assert followed.read_new_lines() == ["last line of the old file"]
+
+    log.write("first line of the new file\n")
+    assert followed.read_new_lines() == ["first line of the new file"]
+
+    followed.close()
+
+
+def test_followed_file_copytruncate(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("some old lines\nmore old lines\n")
+    followed = _FollowedFile(str(log))
+
+    log.write("new line\n")
+    assert followed.read_new_lines() == ["new line"]
+
+    followed.close()
+
+
+def test_followed_file_from_tail_position(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("line1\nline2\n")
+    lines, position = _tail(str(log), 1, with_position=True)
+    assert lines == ["line2"]
+
+    # Written after the tail was read, but before following
+    log.write("line3\n", mode="a")
+    followed = _FollowedFile(str(log), position)
+    log.write("line4\n", mode="a")
+
+    assert followed.read_new_lines() == ["line3", "line4"]
+    followed.close()
+
+
+def test_followed_file_rotated_since_tail_position(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("line1\nline2\n")
+    _, position = _tail(str(log), 1, with_position=True)
+
+    log.rename(tmpdir.join("test.log.1"))
+    log.write("new line\n")
+    followed = _FollowedFile(str(log), position)
+
+    assert followed.read_new_lines() == ["new line"]
+    followed.close()
+
+
+def test_inotify_read_paths(tmpdir):
+
+    fd = _inotify_init()
+    try:
+        other = tmpdir.mkdir("other")
+        watches = {_inotify_add_watch(fd, str(tmpdir), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+                   str(tmpdir)}
+        assert _inotify_read_paths(fd, watches) == set()
+
+        tmpdir.join("a.log").write("line\n")
+        tmpdir.join("b.log").write("line\n")
+        tmpdir.join("b.log").rename(tmpdir.join("c.log"))
+        # (not watched)
+        other.join("d.log").write("line\n")
+
+        assert _inotify_read_paths(fd, watches) == set(str(tmpdir.join(name)) for name in ["a.log", "b.log", "c.log"])
+        assert _inotify_read_paths(fd, watches) == set()
+    finally:
+        os.close(fd)
+
+
+def test_follow_logs_until(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("line1\n")
+    _, position = _tail(str(log), 1, with_position=True)
+    log.write("line2\n", mode="a")
+
+    followed = follow_logs({str(log): position}, until=lambda: True)
+    log.write("line3\n", mode="a")
+
+    assert list(followed) == [(str(log), "line2"), (str(log), "line3")]
@@ -0,0 +1,54 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+APP_SETTINGS_DIR = "/etc/yunohost/apps/helpers_test_app"
+
+
+@pytest.fixture
+def app_settings():
+
+    os.makedirs(APP_SETTINGS_DIR)
+    yield os.path.join(APP_SETTINGS_DIR, "settings.yml")
+    shutil.rmtree(APP_SETTINGS_DIR)
+
+
+def run_helpers(script):
+
+    p = subprocess.Popen(["/bin/bash", "-c", "source /usr/share/yunohost/helpers\n" + script],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    return p.returncode, stdout, stderr
+
+
+def test_ynh_app_setting_load(app_settings):
+
+    with open(app_settings, "w") as f:
+        f.write("domain: domain.tld\n"
+                "path_url: /app\n"
+                "port: 8080\n"
+                "empty:\n"
+                "label: \"Caf\\xE9 with spaces\"\n"
+                "Not-A-Variable: foo\n")
+
+    returncode, stdout, _ = run_helpers("set -eu\n"
+                                        "ynh_app_setting_load --app=helpers_test_app\n"
+                                        "echo \"$domain|$path_url|$port|$empty|$label\"\n")
+
+    assert returncode == 0
+    assert stdout == "domain.tld|/app|8080||Caf\xc3\xa9 with spaces\n"
+
+
+def test_ynh_app_setting_load_failure(app_settings):
+
+    with open(app_settings, "w") as f:
+        f.write("domain: [domain.tld\n")
+
+    returncode, stdout, stderr = run_helpers("ynh_app_setting_load --app=helpers_test_app\n"
+                                             "echo 'still running'\n")
+
+    assert returncode != 0
+    assert "still running" not in stdout
+    assert "Failed to load the settings of helpers_test_app" in stderr
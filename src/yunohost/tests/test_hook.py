@@ -0,0 +1,322 @@
+import os
+import time
+
+import pytest
+
+from conftest import raiseYunohostError
+
+from yunohost.hook import hook_callback, hook_exec, HOOK_PARALLEL_SAFE_MARKER
+
+
+@pytest.fixture
+def hooks_dir(tmpdir, monkeypatch):
+
+    # Run the hooks of a dummy action from a temporary folder (the custom hook
+    # folder being empty)
+    monkeypatch.setattr("yunohost.hook.HOOK_FOLDER", str(tmpdir.mkdir("hooks")) + "/")
+    monkeypatch.setattr("yunohost.hook.CUSTOM_HOOK_FOLDER", str(tmpdir.mkdir("hooks.d")) + "/")
+    tmpdir.join("hooks").mkdir("dummy")
+    # (parallel-safe hooks are run by as many threads as there are cores)
+    monkeypatch.setattr("multiprocessing.cpu_count", lambda: 4)
+    return tmpdir
+
+
+def add_hook(hooks_dir, filename, content, parallel_safe=True):
+
+    hook = hooks_dir.join("hooks", "dummy", filename)
+    hook.write("#!/bin/bash\n%s\n%s\n" % (HOOK_PARALLEL_SAFE_MARKER if parallel_safe else "", content))
+    return str(hook)
+
+
+def test_hook_callback_parallel_same_priority(hooks_dir):
+
+    # Each hook waits for the other one to start, which only happens if they
+    # run concurrently
+    for name, other in [("a", "b"), ("b", "a")]:
+        add_hook(hooks_dir, "10-%s" % name,
+                 "touch %s/%s_started\n"
+                 "for i in $(seq 50); do [ -e %s/%s_started ] && exit 0; sleep 0.1; done\n"
+                 "exit 1" % (hooks_dir, name, hooks_dir, other))
+
+    result = hook_callback("dummy", parallel=True)
+
+    assert result["a"].values()[0]["state"] == "succeed"
+    assert result["b"].values()[0]["state"] == "succeed"
+
+
+def test_hook_callback_parallel_different_priorities(hooks_dir):
+
+    events = hooks_dir.join("events")
+    for name in ["10-a", "20-b", "30-c"]:
+        add_hook(hooks_dir, name,
+                 "echo 'start %s' >> %s\nsleep 0.2\necho 'end %s' >> %s" % (name, events, name, events))
+
+    hook_callback("dummy", parallel=True)
+
+    assert events.read().split("\n") == ["start 10-a", "end 10-a",
+                                         "start 20-b", "end 20-b",
+                                         "start 30-c", "end 30-c", ""]
+
+
+def test_hook_callback_parallel_log_prefix(hooks_dir, mocker):
+
+    add_hook(hooks_dir, "10-a", "echo 'hello from a'")
+    add_hook(hooks_dir, "10-b", "echo 'hello from b'")
+
+    import yunohost.hook
+    mocker.spy(yunohost.hook.logger, "debug")
+
+    hook_callback("dummy", parallel=True)
+
+    logged = [call[0][0] for call in yunohost.hook.logger.debug.call_args_list]
+    assert any(l.startswith("[a] ") and "hello from a" in l for l in logged)
+    assert any(l.startswith("[b] ") and "hello from b" in l for l in logged)
+
+
+def test_hook_callback_parallel_failure_same_as_sequential(hooks_dir):
+
+    add_hook(hooks_dir, "10-a", "echo '{\"a\": 1}' > $YNH_STDRETURN")
+    add_hook(hooks_dir, "10-b", "exit 1")
+    add_hook(hooks_dir, "10-c", "echo '{\"c\": 1}' > $YNH_STDRETURN")
+    add_hook(hooks_dir, "20-d", "exit 0", parallel_safe=False)
+
+    def run(parallel):
+        calls = []
+
+        def post_callback(name, priority, path, succeed):
+            calls.append((name, priority, os.path.basename(path), succeed))
+
+        result = hook_callback("dummy", parallel=parallel, post_callback=post_callback)
+        return result, calls
+
+    sequential_result, sequential_calls = run(parallel=False)
+    parallel_result, parallel_calls = run(parallel=True)
+
+    assert parallel_result == sequential_result
+    assert parallel_calls == sequential_calls
+    assert dict((name, succeed) for name, _, _, succeed in parallel_calls) == \
+        {"a": True, "b": False, "c": True, "d": True}
+    assert parallel_calls[-1][0] == "d"
+    assert parallel_result["a"].values()[0]["stdreturn"] == {"a": 1}
+
+
+def run_hook(path, forkserver, mocker, **kwargs):
+
+    import yunohost.hook
+
+    mocker.spy(yunohost.hook.logger, "debug")
+    mocker.spy(yunohost.hook.logger, "info")
+    mocker.spy(yunohost.hook._hook_forkserver, "run")
+
+    returncode, returndata = hook_exec(path, forkserver=forkserver, **kwargs)
+
+    assert yunohost.hook._hook_forkserver.run.called == forkserver
+
+    # (the lines of the output of the hook end with \r, c.f. hook_exec)
+    output = [call[0][0] for call in yunohost.hook.logger.debug.call_args_list
+              if call[0][0].endswith("\r")]
+    info = [call[0][0] for call in yunohost.hook.logger.info.call_args_list]
+    mocker.stopall()
+    return returncode, returndata, output, info
+
+
+def test_hook_exec_forkserver_same_as_bash(tmpdir, mocker):
+
+    hook = tmpdir.join("10-dummy")
+    # (the helpers are already loaded in the forkserver, so their sourcing
+    # isn't traced)
+    hook.write("#!/bin/bash\n"
+               "set +x\n"
+               "source /usr/share/yunohost/helpers\n"
+               "set -x\n"
+               "echo \"args: $# $*\"\n"
+               "echo \"cwd: $(pwd)\"\n"
+               "env | grep -v '^\\(_\\|SHLVL\\|OLDPWD\\|YNH_STDINFO\\|YNH_STDRETURN\\)=' | sort\n"
+               "f() { echo \"in f\"; }\n"
+               "f\n"
+               "echo 'some info' > $YNH_STDINFO\n"
+               "echo '{\"foo\": \"bar\"}' > $YNH_STDRETURN\n"
+               "exit 3\n")
+
+    kwargs = {"args": ["a b", "it's"], "chdir": str(tmpdir), "env": {"FOO": "foo value"}}
+    from_bash = run_hook(str(hook), False, mocker, **kwargs)
+    from_forkserver = run_hook(str(hook), True, mocker, **kwargs)
+
+    assert from_forkserver == from_bash
+
+    returncode, returndata, output, info = from_forkserver
+    assert returncode == 3
+    assert returndata == {"foo": "bar"}
+    assert "args: 2 a b it's\r" in output
+    assert "cwd: %s\r" % tmpdir in output
+    assert "FOO=foo value\r" in output
+    assert "+ f\r" in output and "+ echo 'in f'\r" in output
+    assert info == ["some info"]
+
+
+def test_hook_exec_forkserver_killed_hook(tmpdir, mocker):
+
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo before\n"
+               "kill -9 $BASHPID\n"
+               "echo after\n")
+
+    from_bash = run_hook(str(hook), False, mocker, no_trace=True)
+    from_forkserver = run_hook(str(hook), True, mocker, no_trace=True)
+
+    assert from_forkserver == from_bash
+    assert from_forkserver[0] != 0
+    assert from_forkserver[2] == ["before\r"]
+
+
+def test_hook_exec_forkserver_reloads_helpers_edited_in_place(tmpdir, mocker, monkeypatch):
+
+    import yunohost.hook
+    from yunohost.hook import HookForkserver
+
+    helpers_dir = tmpdir.mkdir("helpers.d")
+    helper = helpers_dir.join("dummy")
+    helper.write("ynh_dummy() { echo 'dummy v1'; }\n")
+    helpers = tmpdir.join("helpers")
+    helpers.write("for helper in %s/*; do . $helper; done\n" % helpers_dir)
+    monkeypatch.setattr("yunohost.hook.HELPERS", str(helpers))
+    monkeypatch.setattr("yunohost.hook.HELPERS_DIR", str(helpers_dir))
+    monkeypatch.setattr("yunohost.hook._hook_forkserver", HookForkserver())
+
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\nynh_dummy\n")
+
+    os.utime(str(helpers_dir), (1000000000, 1000000000))
+
+    try:
+        assert run_hook(str(hook), True, mocker, no_trace=True)[2] == ["dummy v1\r"]
+
+        # Edit the helper without changing the mtime of its folder
+        with open(str(helper), "r+") as f:
+            f.write("ynh_dummy() { echo 'dummy v2'; }\n")
+        os.utime(str(helpers_dir), (1000000000, 1000000000))
+
+        assert run_hook(str(hook), True, mocker, no_trace=True)[2] == ["dummy v2\r"]
+    finally:
+        yunohost.hook._hook_forkserver.stop()
+
+
+def test_hook_exec_stdreturn_json(tmpdir):
+
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo '{\"foo\":' > $YNH_STDRETURN\n"
+               "echo '[1, 2]}' >> $YNH_STDRETURN\n")
+
+    assert hook_exec(str(hook)) == (0, {"foo": [1, 2]})
+
+
+def test_hook_exec_stdreturn_plain_dict(tmpdir):
+
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo 'foo=bar' > $YNH_STDRETURN\n"
+               "echo 'not a key value' >> $YNH_STDRETURN\n"
+               "echo 'url=https://domain.tld/?a=b' >> $YNH_STDRETURN\n")
+
+    assert hook_exec(str(hook), return_format="plain_dict") == \
+        (0, {"foo": "bar", "url": "https://domain.tld/?a=b"})
+
+
+def test_hook_exec_stdreturn_bad_json(tmpdir, mocker):
+
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo '{\"foo\": ' > $YNH_STDRETURN\n")
+
+    with raiseYunohostError(mocker, "hook_json_return_error"):
+        hook_exec(str(hook))
+
+
+def test_hook_exec_stdinfo(tmpdir, mocker):
+
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo 'first info' > $YNH_STDINFO\n"
+               "echo 'some output'\n"
+               "echo 'second info' >> $YNH_STDINFO\n")
+
+    import yunohost.hook
+    mocker.spy(yunohost.hook.logger, "info")
+
+    hook_exec(str(hook), log_prefix="dummy")
+
+    assert [call[0][0] for call in yunohost.hook.logger.info.call_args_list] == \
+        ["[dummy] first info", "[dummy] second info"]
+
+
+def test_hook_exec_as_another_user(tmpdir, mocker):
+
+    # (sudo closes the fds it inherits, so stdinfo and stdreturn are FIFOs the
+    # user has to be able to open)
+    hook_dir = tmpdir.mkdir("hook")
+    hook_dir.chmod(0o755)
+    hook = hook_dir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo \"user: $(id -un)\"\n"
+               "echo 'some info' > $YNH_STDINFO\n"
+               "echo '{\"foo\": \"bar\"}' > $YNH_STDRETURN\n")
+    hook.chmod(0o755)
+
+    import yunohost.hook
+    mocker.spy(yunohost.hook.logger, "debug")
+    mocker.spy(yunohost.hook.logger, "info")
+
+    assert hook_exec(str(hook), user="nobody", no_trace=True) == (0, {"foo": "bar"})
+
+    output = [call[0][0] for call in yunohost.hook.logger.debug.call_args_list]
+    assert "user: nobody\r" in output
+    assert [call[0][0] for call in yunohost.hook.logger.info.call_args_list] == ["some info"]
+    assert not [path for path in os.listdir("/tmp") if path.startswith("ynh-hook-")]
+
+
+@pytest.mark.parametrize("forkserver", [False, True])
+def test_hook_exec_background_child_keeps_channels_open(tmpdir, forkserver):
+
+    # The child inherits stdinfo and stdreturn, but the hook is done once
+    # the script exits
+    hook = tmpdir.join("10-dummy")
+    hook.write("#!/bin/bash\n"
+               "echo '{\"foo\": \"bar\"}' > $YNH_STDRETURN\n"
+               "sleep 10 >/dev/null 2>&1 &\n")
+
+    start = time.time()
+    assert hook_exec(str(hook), forkserver=forkserver) == (0, {"foo": "bar"})
+    assert time.time() - start < 5
+
+
+def test_hook_list_picks_up_changes_of_the_folder(hooks_dir):
+
+    from yunohost.hook import hook_list
+
+    folder = str(hooks_dir.join("hooks", "dummy"))
+    now = int(time.time())
+
+    def hooks():
+        # (as if the filesystem had a resolution of one second, the changes
+        # below being done within the same one)
+        os.utime(folder, (now, now))
+        return hook_list("dummy", list_by="priority", show_info=True)["hooks"]
+
+    assert hooks() == {}
+
+    path = add_hook(hooks_dir, "10-a", "true")
+    assert hooks() == {"10": {"a": {"path": path}}}
+
+    os.rename(path, path.replace("10-a", "20-b"))
+    assert hooks() == {"20": {"b": {"path": path.replace("10-a", "20-b")}}}
+
+    os.remove(path.replace("10-a", "20-b"))
+    assert hooks() == {}
+
+    # Once the folder didn't change for a while, its listing is cached
+    os.utime(folder, (now - 10, now - 10))
+    assert hook_list("dummy")["hooks"] == set()
+    add_hook(hooks_dir, "10-c", "true")
+    assert hook_list("dummy")["hooks"] == set(["c"])
@@ -0,0 +1,38 @@
+import threading
+
+from yunohost.log import is_unit_operation, defer_to_end_of_operation, run_deferred_tasks
+
+
+def test_deferred_tasks_run_by_the_thread_of_the_operation():
+
+    ran = []
+
+    def task():
+        ran.append(threading.current_thread().name)
+
+    @is_unit_operation()
+    def dummy_operation(operation_logger):
+
+        assert defer_to_end_of_operation("task", task) is True
+
+        # e.g. hooks run concurrently by hook_callback
+        workers = [threading.Thread(target=run_deferred_tasks, name="worker %d" % i) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert ran == []
+
+        # (tasks deferred from other threads are ran at the end too)
+        worker = threading.Thread(target=defer_to_end_of_operation, args=("task", task))
+        worker.start()
+        worker.join()
+        assert ran == []
+
+    dummy_operation()
+
+    assert ran == [threading.current_thread().name]
+
+    # Outside of an operation, tasks are ran right away
+    assert defer_to_end_of_operation("task", task) is False
+    assert ran == [threading.current_thread().name] * 2
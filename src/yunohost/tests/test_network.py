@@ -0,0 +1,156 @@
+import time
+import threading
+import collections
+
+import dns.exception
+import dns.message
+import dns.resolver
+import dns.rrset
+import pytest
+
+from yunohost.utils.network import dig, dig_many
+
+
+class FakeRdata(object):
+
+    def __init__(self, text):
+        self.text = text
+
+    def to_text(self):
+        return self.text
+
+
+class FakeAnswers(list):
+
+    def __init__(self, texts, ttl):
+        list.__init__(self, [FakeRdata(t) for t in texts])
+        self.expiration = time.time() + ttl
+
+
+@pytest.fixture
+def resolver(mocker, monkeypatch):
+
+    # Start from an empty cache, which isn't persisted
+    monkeypatch.setattr("yunohost.utils.network._dig_cache", {})
+    monkeypatch.setattr("yunohost.utils.network._dig_cache_changed", False)
+    monkeypatch.setattr("yunohost.utils.network._save_dig_cache", lambda: None)
+    return mocker.patch.object(dns.resolver.Resolver, "query", autospec=True)
+
+
+def test_dig_cache_until_expiration(resolver, mocker):
+
+    resolver.return_value = FakeAnswers(["1.2.3.4"], ttl=300)
+
+    assert dig("domain.tld") == ("ok", ["1.2.3.4"])
+    assert dig("domain.tld") == ("ok", ["1.2.3.4"])
+    # (same query, whatever the case or the trailing dot)
+    assert dig("DOMAIN.tld.") == ("ok", ["1.2.3.4"])
+    assert resolver.call_count == 1
+
+    # Other queries aren't answered from the cache
+    assert dig("domain.tld", "AAAA") == ("ok", ["1.2.3.4"])
+    assert dig("domain.tld", resolvers=["9.9.9.9"]) == ("ok", ["1.2.3.4"])
+    assert resolver.call_count == 3
+
+    resolver.return_value = FakeAnswers(["5.6.7.8"], ttl=300)
+    now = time.time()
+    mocker.patch("time.time", return_value=now + 301)
+    assert dig("domain.tld") == ("ok", ["5.6.7.8"])
+    assert resolver.call_count == 4
+
+
+def test_dig_cache_negative_answer_ttl(resolver, mocker):
+
+    # The SOA in the authority section tells how long the domain can be
+    # considered as not existing (its minimum, as it's below its TTL)
+    response = dns.message.Message()
+    response.authority.append(dns.rrset.from_text("tld.", 300, "IN", "SOA",
+                                                  "ns.tld. admin.tld. 1 3600 600 86400 120"))
+    resolver.side_effect = dns.resolver.NXDOMAIN(qnames=["nope.tld."], responses={"nope.tld.": response})
+
+    status, (error, _) = dig("nope.tld")
+    assert (status, error) == ("nok", "NXDOMAIN")
+    assert dig("nope.tld")[1][0] == "NXDOMAIN"
+    assert resolver.call_count == 1
+
+    now = time.time()
+    mocker.patch("time.time", return_value=now + 100)
+    dig("nope.tld")
+    assert resolver.call_count == 1
+
+    mocker.patch("time.time", return_value=now + 121)
+    dig("nope.tld")
+    assert resolver.call_count == 2
+
+
+def test_dig_cache_timeouts_not_cached(resolver):
+
+    resolver.side_effect = dns.exception.Timeout()
+
+    assert dig("domain.tld")[1][0] == "Timeout"
+    assert dig("domain.tld")[1][0] == "Timeout"
+    assert resolver.call_count == 2
+
+
+def test_dig_without_cache(resolver):
+
+    resolver.return_value = FakeAnswers(["1.2.3.4"], ttl=300)
+    dig("domain.tld")
+
+    # The request is done anyway, and its answer replaces the cached one
+    resolver.return_value = FakeAnswers(["5.6.7.8"], ttl=300)
+    assert dig("domain.tld", use_cache=False) == ("ok", ["5.6.7.8"])
+    assert resolver.call_count == 2
+
+    assert dig("domain.tld") == ("ok", ["5.6.7.8"])
+    assert resolver.call_count == 2
+
+
+def test_dig_many_keeps_the_order_of_the_queries(mocker):
+
+    def fake_dig(qname, rdtype, **kwargs):
+        # (the first queries are answered last)
+        time.sleep(0.05 * (10 - int(qname.split(".")[0])))
+        return "ok", ["%s %s %s" % (qname, rdtype, kwargs)]
+
+    mocker.patch("yunohost.utils.network.dig", side_effect=fake_dig)
+
+    queries = [("%d.domain.tld" % i, "A" if i % 2 else "AAAA") for i in range(10)]
+    results = dig_many(queries, resolvers="force_external")
+
+    assert results == [("ok", ["%s %s %s" % (q, t, {"resolvers": "force_external"})]) for q, t in queries]
+    assert dig_many([]) == []
+
+
+def test_dig_many_max_parallel_per_group(mocker):
+
+    lock = threading.Lock()
+    running = collections.Counter()
+    max_running = collections.Counter()
+
+    def fake_dig(qname, rdtype, **kwargs):
+        group = qname.split(".", 1)[1]
+        with lock:
+            running[group] += 1
+            running["all"] += 1
+            max_running[group] = max(max_running[group], running[group])
+            max_running["all"] = max(max_running["all"], running["all"])
+        time.sleep(0.2)
+        with lock:
+            running[group] -= 1
+            running["all"] -= 1
+        return "ok", [qname]
+
+    mocker.patch("yunohost.utils.network.dig", side_effect=fake_dig)
+
+    queries = [("%d.%s" % (i, bl), "A", bl) for i in range(6) for bl in ["bl1.tld", "bl2.tld"]]
+    # (queries without a group aren't limited)
+    queries += [("%d.nogroup.tld" % i, "A") for i in range(3)]
+    results = dig_many(queries, max_parallel_per_group=2)
+
+    assert results == [("ok", [q[0]]) for q in queries]
+    assert max_running["bl1.tld"] == 2
+    assert max_running["bl2.tld"] == 2
+    assert max_running["nogroup.tld"] == 3
+    # The groups are resolved concurrently
+    assert max_running["all"] > 2
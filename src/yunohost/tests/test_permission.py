@@ -1,15 +1,17 @@
 import requests
 import pytest
 import os
+import json
 
 from conftest import message, raiseYunohostError, get_test_apps_dir
 
-from yunohost.app import app_install, app_remove, app_change_url, app_list, app_map, _installed_apps
+from yunohost.app import app_install, app_remove, app_change_url, app_list, app_map, app_ssowatconf, _installed_apps
 from yunohost.user import user_list, user_create, user_delete, \
                           user_group_list, user_group_delete
 from yunohost.permission import user_permission_update, user_permission_list, user_permission_reset, \
                                 permission_create, permission_delete, permission_url
 from yunohost.domain import _get_maindomain
+from yunohost.settings import settings_set, settings_reset
 
 # Get main domain
 maindomain = ""
@@ -446,6 +448,65 @@ def test_permission_app_install():
     assert maindomain + "/urlpermissionapp" in app_map(user="bob").keys()
 
 
+def test_permission_app_ssowat_users_map():
+    app_install(os.path.join(get_test_apps_dir(), "permissions_app_ynh"),
+                args="domain=%s&path=%s&is_public=0&admin=%s" % (maindomain, "/urlpermissionapp", "alice"), force=True)
+
+    user_permission_update("permissions_app.main", remove="all_users", add="bob")
+    user_permission_update("permissions_app.admin", add="bob")
+
+    # The users map in the ssowat conf is built in a single pass,
+    # check it's consistent with app_map for each user
+    ssowat_conf = json.load(open("/etc/ssowat/conf.json"))
+    for user in user_list()["users"].keys():
+        assert ssowat_conf["users"][user] == app_map(user=user)
+
+    assert maindomain + "/urlpermissionapp" not in ssowat_conf["users"]["alice"]
+    assert maindomain + "/urlpermissionapp/admin" not in ssowat_conf["users"]["alice"]
+    assert maindomain + "/urlpermissionapp" in ssowat_conf["users"]["bob"]
+    assert maindomain + "/urlpermissionapp/admin" in ssowat_conf["users"]["bob"]
+
+
+def test_permission_app_ssowat_compact_format():
+    app_install(os.path.join(get_test_apps_dir(), "permissions_app_ynh"),
+                args="domain=%s&path=%s&is_public=0&admin=%s" % (maindomain, "/urlpermissionapp", "alice"), force=True)
+
+    try:
+        settings_set("ssowat.conf.format", "compact")
+        ssowat_conf = json.load(open("/etc/ssowat/conf.json"))
+    finally:
+        settings_reset("ssowat.conf.format")
+        app_ssowatconf()
+
+    assert ssowat_conf["conf_format"] == "compact"
+
+    main_perm = ssowat_conf["permissions"]["permissions_app.main"]
+    assert main_perm["url"] == maindomain + "/urlpermissionapp"
+    assert main_perm["tile_url"] == maindomain + "/urlpermissionapp"
+    assert set(main_perm["users"]) == set(["alice", "bob"])
+
+    admin_perm = ssowat_conf["permissions"]["permissions_app.admin"]
+    assert admin_perm["url"] == maindomain + "/urlpermissionapp/admin"
+    assert admin_perm["users"] == ["alice"]
+
+    assert "permissions_app.admin" in ssowat_conf["users"]["alice"]
+    assert "permissions_app.admin" not in ssowat_conf["users"]["bob"]
+    assert "permissions_app.main" in ssowat_conf["users"]["bob"]
+
+
+def test_permission_ssowat_conf_not_rewritten_if_unchanged():
+    app_ssowatconf()
+    inode_before = os.stat("/etc/ssowat/conf.json").st_ino
+
+    app_ssowatconf()
+    assert os.stat("/etc/ssowat/conf.json").st_ino == inode_before
+
+    # The conf is written in a temporary file which is renamed, so any
+    # actual change of the conf ends up in a new inode
+    user_permission_update("wiki.main", remove="all_users", add="bob")
+    assert os.stat("/etc/ssowat/conf.json").st_ino != inode_before
+
+
 def test_permission_app_remove():
     app_install(os.path.join(get_test_apps_dir(), "permissions_app_ynh"),
                 args="domain=%s&path=%s&is_public=0&admin=%s" % (maindomain, "/urlpermissionapp", "alice"), force=True)
@@ -1,8 +1,12 @@
 import os
+import gzip
+import time
+import threading
 
 from conftest import raiseYunohostError
 
-from yunohost.service import _get_services, _save_services, service_status, service_add, service_remove, service_log
+from yunohost.service import _get_services, _save_services, service_status, service_add, service_remove, service_log, \
+    _tail, _get_journalctl_logs, _run_service_test_commands, _give_lock, _remove_lock
 
 
 def setup_function(function):
@@ -109,3 +113,177 @@ def test_service_update_to_remove_properties():
     assert _get_services()["dummyservice"].get("test_status") == "false"
     service_add("dummyservice", description="dummy", test_status="")
     assert not _get_services()["dummyservice"].get("test_status")
+
+
+def test_service_conf_modified_by_someone_else():
+
+    service_add("dummyservice", description="dummy")
+    assert "dummyservice" in _get_services()
+
+    # e.g. the conf regen of yunohost rewriting services.yml
+    conf = open("/etc/yunohost/services.yml").read()
+    conf = conf.replace("dummyservice:", "dummyservice2:")
+    with open("/etc/yunohost/services.yml", "w") as f:
+        f.write(conf)
+
+    services = _get_services()
+    assert "dummyservice" not in services
+    assert "dummyservice2" in services
+
+    del services["dummyservice2"]
+    _save_services(services)
+
+
+def test_tail_with_and_without_trailing_newline(tmpdir):
+
+    log = tmpdir.join("test.log")
+
+    log.write("line1\nline2\nline3\n")
+    assert _tail(str(log), 2) == ["line2", "line3"]
+    assert _tail(str(log), 10) == ["line1", "line2", "line3"]
+
+    log.write("line1\nline2\nline3")
+    assert _tail(str(log), 2) == ["line2", "line3"]
+    assert _tail(str(log), 10) == ["line1", "line2", "line3"]
+
+    log.write("line1\n\n")
+    assert _tail(str(log), 10) == ["line1", ""]
+
+    log.write("")
+    assert _tail(str(log), 10) == []
+
+
+def test_tail_lines_across_blocks(tmpdir, monkeypatch):
+
+    # Lines shorter and longer than the blocks
+    monkeypatch.setattr("yunohost.service.TAIL_BLOCK_SIZE", 8)
+    lines = ["line %d %s" % (i, "x" * i) for i in range(20)]
+
+    log = tmpdir.join("test.log")
+    log.write("\n".join(lines) + "\n")
+
+    for n in [1, 2, 7, 20, 30]:
+        assert _tail(str(log), n) == lines[-n:]
+    assert _tail(str(log), 5, filters=["x{10}"]) == lines[5:10]
+
+
+def test_tail_rotated_logs_with_filters(tmpdir):
+
+    tmpdir.join("test.log").write("c1\nskip c\nc2\n")
+    tmpdir.join("test.log.1").write("b1\nskip b\nb2\n")
+    with gzip.open(str(tmpdir.join("test.log.2.gz")), "wb") as f:
+        f.write("a1\nskip a\na2\n")
+
+    log = str(tmpdir.join("test.log"))
+    assert _tail(log, 2, filters=["^skip"]) == ["c1", "c2"]
+    assert _tail(log, 3, filters=["^skip"]) == ["b2", "c1", "c2"]
+    assert _tail(log, 5, filters=["^skip"]) == ["a2", "b1", "b2", "c1", "c2"]
+    assert _tail(log, 10, filters=["^skip"]) == ["a1", "a2", "b1", "b2", "c1", "c2"]
+    assert _tail(log, 10) == ["a1", "skip a", "a2", "b1", "skip b", "b2", "c1", "skip c", "c2"]
+
+
+def test_tail_with_position(tmpdir):
+
+    log = tmpdir.join("test.log")
+    log.write("line1\nline2\n")
+    tmpdir.join("test.log.1").write("line0\n")
+
+    lines, position = _tail(str(log), 3, with_position=True)
+    assert lines == ["line0", "line1", "line2"]
+    # (the end of test.log, not of test.log.1)
+    assert position == (os.stat(str(log)).st_ino, len("line1\nline2\n"))
+
+    assert _tail(str(tmpdir.join("missing.log")), 3, with_position=True) == ([], None)
+
+
+def test_get_journalctl_logs_with_cursor(mocker):
+
+    mocker.patch("yunohost.service._get_services", return_value={})
+    check_output = mocker.patch("subprocess.check_output",
+                                return_value="-- Logs begin at ... --\n"
+                                             "entry 1\n"
+                                             "entry 2\n"
+                                             "-- cursor: s=abc;i=42\n")
+
+    assert _get_journalctl_logs("dummyservice", 2, with_cursor=True) == \
+        ("-- Logs begin at ... --\nentry 1\nentry 2\n", "s=abc;i=42")
+    assert "--show-cursor" in check_output.call_args[0][0]
+
+    # No entry, hence no cursor
+    check_output.return_value = "-- No entries --\n"
+    assert _get_journalctl_logs("dummyservice", 2, with_cursor=True) == ("-- No entries --\n", None)
+
+    check_output.side_effect = OSError("no journalctl")
+    logs, cursor = _get_journalctl_logs("dummyservice", 2, with_cursor=True)
+    assert logs.startswith("error while get services logs from journalctl")
+    assert cursor is None
+
+
+def test_run_service_test_commands():
+
+    start = time.time()
+    results = _run_service_test_commands({"ok": "echo 'all good'",
+                                          "failed": "echo 'oops' >&2; exit 3",
+                                          # (its child holds the output too)
+                                          "stuck": "echo 'starting'; sleep 60 & wait"},
+                                         timeout=2)
+
+    assert results["ok"] == (0, "all good\n")
+    assert results["failed"] == (3, "oops\n")
+    returncode, output = results["stuck"]
+    assert returncode is None
+    assert output.startswith("starting\n")
+    assert "timed out" in output
+    # The whole process group got killed, not only the command
+    assert time.time() - start < 30
+    assert os.system("pgrep -f '^sleep 60$' >/dev/null") != 0
+
+
+def mock_lock(tmpdir, mocker, son_PID):
+
+    lock = tmpdir.join("moulinette_yunohost.lock")
+    mocker.patch("yunohost.service.MOULINETTE_LOCK", str(lock))
+    mocker.patch("yunohost.service.MOULINETTE_LOCK_GUARD", str(lock) + ".guard")
+
+    # systemd tells the PID of the process of the service
+    bus, manager = mocker.Mock(), mocker.Mock()
+    bus.get_object.return_value.Get.return_value = son_PID
+    mocker.patch("yunohost.service._get_systemd", return_value=(bus, manager))
+
+    return lock
+
+
+def test_remove_lock_concurrently_with_give_lock(tmpdir, mocker):
+
+    lock = mock_lock(tmpdir, mocker, son_PID=456)
+    lock.write("1\n123")
+
+    # Make both updates read the lock before either one writes it, unless
+    # they are serialized
+    import yunohost.service
+    write_to_file_atomically = yunohost.service.write_to_file_atomically
+
+    def slow_write(*args, **kwargs):
+        time.sleep(0.5)
+        write_to_file_atomically(*args, **kwargs)
+
+    mocker.patch("yunohost.service.write_to_file_atomically", side_effect=slow_write)
+
+    threads = [threading.Thread(target=_give_lock, args=("start", "dummyservice", mocker.Mock(**{"poll.return_value": None}))),
+               threading.Thread(target=_remove_lock, args=(123,))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert lock.read().split("\n") == ["1", "456"]
+
+
+def test_released_lock_is_not_recreated(tmpdir, mocker):
+
+    lock = mock_lock(tmpdir, mocker, son_PID=456)
+
+    assert _give_lock("start", "dummyservice", mocker.Mock(**{"poll.return_value": None})) == 456
+    _remove_lock(456)
+
+    assert not lock.exists()
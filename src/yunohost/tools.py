@@ -37,7 +37,10 @@ from moulinette.utils.log import getActionLogger
 from moulinette.utils.process import check_output, call_async_output
 from moulinette.utils.filesystem import read_json, write_to_json, read_yaml, write_to_yaml
 
-from yunohost.app import _update_apps_catalog, app_info, app_upgrade, app_ssowatconf, app_list, _initialize_apps_catalog_system
+from yunohost.app import (
+    _update_apps_catalog, app_upgrade, app_ssowatconf, app_list, _initialize_apps_catalog_system,
+    _load_apps_catalog, _get_app_settings, _get_manifest_of_app, _parse_app_instance_name, _app_upgradable
+)
 from yunohost.domain import domain_add, domain_list
 from yunohost.dyndns import _dyndns_available, _dyndns_provides
 from yunohost.firewall import firewall_upnp
@@ -464,20 +467,27 @@ def tools_update(apps=False, system=False):
 
 def _list_upgradable_apps():
 
+    # We only need the 'versions' projection of the apps catalog to check the
+    # upgradability of apps, not the full manifests of every app
+    catalog_versions = _load_apps_catalog(projection="versions")["apps"]
+
     app_list_installed = os.listdir(APPS_SETTING_PATH)
     for app_id in app_list_installed:
 
-        app_dict = app_info(app_id, full=True)
+        settings = _get_app_settings(app_id)
+        absolute_app_name, _ = _parse_app_instance_name(app_id)
+        from_catalog = catalog_versions.get(absolute_app_name, {})
 
-        if app_dict["upgradable"] == "yes":
+        if _app_upgradable({"from_catalog": from_catalog, "settings": settings}) == "yes":
 
             # FIXME : would make more sense for these infos to be computed
             # directly in app_info and used to check the upgradability of
             # the app...
-            current_version = app_dict.get("manifest", {}).get("version", "?")
-            current_commit = app_dict.get("settings", {}).get("current_revision", "?")[:7]
-            new_version = app_dict.get("from_catalog", {}).get("manifest", {}).get("version", "?")
-            new_commit = app_dict.get("from_catalog", {}).get("git", {}).get("revision", "?")[:7]
+            manifest = _get_manifest_of_app(os.path.join(APPS_SETTING_PATH, app_id))
+            current_version = manifest.get("version", "?")
+            current_commit = settings.get("current_revision", "?")[:7]
+            new_version = from_catalog.get("manifest", {}).get("version", "?")
+            new_commit = from_catalog.get("git", {}).get("revision", "?")[:7]
 
             if current_version == new_version:
                 current_version += " (" + current_commit + ")"
@@ -485,7 +495,7 @@ def _list_upgradable_apps():
 
             yield {
                 'id': app_id,
-                'label': app_dict['settings']['label'],
+                'label': settings['label'],
                 'current_version': current_version,
                 'new_version': new_version
             }
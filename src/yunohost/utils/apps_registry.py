@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2020 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+
+""" apps_registry.py
+
+    Keep an index of the parsed settings / manifests of installed apps, such
+    that we don't re-parse every settings.yml and manifest.{json,toml} with
+    pure-python parsers each time we want to list apps, build the app map, ...
+
+    Each entry is validated using the (mtime, size, inode) of the
+    corresponding file, and the index is persisted in /var/cache/yunohost
+    such that successive yunohost commands can reuse it.
+"""
+
+import os
+import copy
+import time
+import atexit
+import cPickle as pickle
+
+from moulinette.utils.log import getActionLogger
+
+from yunohost.utils.filesystem import write_to_file_atomically
+
+logger = getActionLogger('yunohost.apps_registry')
+
+APPS_REGISTRY_CACHE = '/var/cache/yunohost/apps_registry.pickle'
+
+# To be bumped each time the way settings / manifests are parsed changes,
+# such that the previously persisted index gets discarded
+APPS_REGISTRY_VERSION = 1
+
+# Files modified less than this number of seconds ago are not indexed (yet)
+RACY_DELAY = 2
+
+# In-process copy of the index, as { file_path: (stamp, parsed_content) }
+_registry = None
+_registry_changed = False
+
+
+def get_parsed_file(path, parser):
+    """
+    Return parser(path), reusing the result of a previous call if the file
+    didn't change since then.
+
+    Keyword arguments:
+        path -- Path of the settings / manifest file
+        parser -- Function returning the parsed content of the file
+
+    Returns:
+        A copy of the parsed content (such that callers are free to alter it)
+
+    """
+    global _registry_changed
+
+    try:
+        stamp = _file_stamp(path)
+    except OSError:
+        # Let the parser deal with missing / unreadable files as usual
+        return parser(path)
+
+    registry = _get_registry()
+
+    if path in registry and registry[path][0] == stamp:
+        return copy.deepcopy(registry[path][1])
+
+    content = parser(path)
+
+    # Don't index files modified very recently : on filesystems with a coarse
+    # timestamp granularity, the file could be modified again within the same
+    # tick without changing its size, and we wouldn't notice (this is the same
+    # "racy" situation as the one git handles for its index)
+    if time.time() - stamp[0] > RACY_DELAY:
+        registry[path] = (stamp, copy.deepcopy(content))
+        _registry_changed = True
+
+    return content
+
+
+def _file_stamp(path):
+
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+def _get_registry():
+
+    global _registry
+
+    if _registry is None:
+        _registry = {}
+        if os.path.exists(APPS_REGISTRY_CACHE):
+            try:
+                with open(APPS_REGISTRY_CACHE, 'rb') as f:
+                    # Only trust a cache written by ourselves (N.B. : the
+                    # content of /var/cache/yunohost gets chown'ed to admin
+                    # during app installs / upgrades)
+                    if os.fstat(f.fileno()).st_uid != os.getuid():
+                        raise Exception("unexpected owner for %s" % APPS_REGISTRY_CACHE)
+                    cache = pickle.load(f)
+                if cache.get("version") == APPS_REGISTRY_VERSION:
+                    _registry = cache["files"]
+            except Exception as e:
+                logger.debug("Ignoring the apps registry cache which could not be loaded : %s" % e)
+
+    return _registry
+
+
+def _save_registry():
+
+    if not _registry_changed:
+        return
+
+    # Forget about files which don't exist anymore (e.g. removed apps)
+    files = {path: entry for path, entry in _registry.items() if os.path.exists(path)}
+
+    try:
+        write_to_file_atomically(APPS_REGISTRY_CACHE,
+                                 pickle.dumps({"version": APPS_REGISTRY_VERSION, "files": files},
+                                              pickle.HIGHEST_PROTOCOL),
+                                 mode=0o600)
+    except Exception as e:
+        logger.debug("Could not save the apps registry cache : %s" % e)
+
+
+# Persist the index when Python exits, such that the next yunohost commands
+# don't have to re-parse everything
+atexit.register(_save_registry)
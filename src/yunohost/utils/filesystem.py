@@ -19,6 +19,7 @@
 
 """
 import os
+import tempfile
 
 
 def free_space_in_directory(dirpath):
@@ -29,3 +30,23 @@ def free_space_in_directory(dirpath):
 def space_used_by_directory(dirpath):
     stat = os.statvfs(dirpath)
     return stat.f_frsize * stat.f_blocks
+
+
+def write_to_file_atomically(file_path, data, mode=0o644):
+    """
+    Write data in file_path through a temporary file (in the same directory)
+    which is then renamed, such that readers never see a half-written file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path),
+                                    prefix="." + os.path.basename(file_path) + ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2020 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+
+""" follow.py
+
+    Follow log files (and the journal of a systemd unit) as they grow, like
+    'tail -f' does, only reading what gets written.
+
+    Log files are watched with inotify, through their directory such that
+    rotations are noticed, and the journal through 'journalctl --follow'
+    starting from the cursor of the last entry already displayed.
+"""
+
+import io
+import os
+import sys
+import time
+import errno
+import fcntl
+import struct
+import ctypes
+import ctypes.util
+import logging
+import subprocess
+
+from moulinette import msettings
+from moulinette.utils.log import getActionLogger
+
+logger = getActionLogger('yunohost.follow')
+
+# Number of seconds during which logs are followed for the API, after which
+# the webadmin has to ask again (such that requests don't last forever)
+FOLLOW_API_DURATION = 300
+
+# c.f. /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def follow_logs(files, journal=None, duration=None, until=None):
+    """
+    Generator of the lines written in log files (and in the journal of a
+    systemd unit) from now on, or from where their last lines were read
+
+    The files are opened and watched right away, such that nothing written
+    while the caller displays their last lines (before iterating) gets lost
+
+    Keyword arguments:
+        files -- Paths of the log files to follow from their current end, or
+                 { path: position } to follow them from the (inode, offset)
+                 where their last lines were read (c.f.
+                 yunohost.service._tail), such that nothing written since
+                 then gets lost or displayed twice
+        journal -- (unit, cursor) to follow the journal of a unit from the
+                   entry after cursor (or from now on if cursor is None)
+        duration -- Number of seconds after which to stop following (by
+                    default FOLLOW_API_DURATION for the API, never for the CLI)
+        until -- Function telling whether to stop following, called when
+                 starting to iterate then each time something happens in the
+                 directories of the files
+
+    Yields:
+        (source, line), source being the path of the file or "journalctl"
+    """
+
+    followed = _follow_logs(files, journal, duration, until)
+    # Run it until everything is set up
+    next(followed)
+    return followed
+
+
+def _follow_logs(files, journal, duration, until):
+
+    # The API serves its requests with gevent, which mustn't be blocked
+    if msettings.get('interface') == 'api':
+        from gevent.select import select
+        if duration is None:
+            duration = FOLLOW_API_DURATION
+    else:
+        from select import select
+
+    if not isinstance(files, dict):
+        files = dict.fromkeys(files)
+    followed = {os.path.abspath(path): _FollowedFile(os.path.abspath(path), position)
+                for path, position in files.items()}
+
+    inotify_fd = _inotify_init()
+    journalctl = None
+    try:
+        watches = {}
+        for directory in set(os.path.dirname(path) for path in followed):
+            watches[_inotify_add_watch(inotify_fd, directory,
+                                       IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)] = directory
+
+        fds = [inotify_fd]
+        if journal is not None:
+            unit, cursor = journal
+            command = ["journalctl", "--no-hostname", "-x", "--unit", unit, "--follow", "--no-pager"]
+            command += ["--lines=all", "--after-cursor=%s" % cursor] if cursor else ["--lines=0"]
+            journalctl = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+            _set_nonblocking(journalctl.stdout.fileno())
+            fds.append(journalctl.stdout.fileno())
+            journal_partial_line = ""
+
+        end = time.time() + duration if duration is not None else None
+
+        # Ready, c.f. follow_logs()
+        yield None
+
+        while True:
+            if until is not None and until():
+                # Display what was written in the meantime
+                for path, followed_file in followed.items():
+                    for line in followed_file.read_new_lines():
+                        yield path, line
+                return
+
+            timeout = max(end - time.time(), 0) if end is not None else None
+            ready, _, _ = select(fds, [], [], timeout)
+            if not ready:
+                return
+
+            if journalctl is not None and journalctl.stdout.fileno() in ready:
+                data = _read_available(journalctl.stdout.fileno())
+                if data is None:
+                    # journalctl exited
+                    fds.remove(journalctl.stdout.fileno())
+                    data = ""
+                lines = (journal_partial_line + data).split("\n")
+                journal_partial_line = lines.pop()
+                for line in lines:
+                    yield "journalctl", line
+
+            if inotify_fd in ready:
+                for path in _inotify_read_paths(inotify_fd, watches):
+                    if path in followed:
+                        for line in followed[path].read_new_lines():
+                            yield path, line
+    finally:
+        os.close(inotify_fd)
+        for followed_file in followed.values():
+            followed_file.close()
+        if journalctl is not None and journalctl.poll() is None:
+            journalctl.terminate()
+            journalctl.wait()
+
+
+def print_logs(logs):
+    """
+    Display lines of logs as they come, with a header each time the source
+    changes (like 'tail -f' does with several files) : on the standard output
+    for the CLI, and through the messages websocket for the API
+
+    Keyword arguments:
+        logs -- Iterable of (source, line), e.g. as given by follow_logs()
+    """
+
+    if msettings.get('interface') == 'api':
+        from moulinette.interfaces.api import APIQueueHandler
+
+        # Only send the lines to the webadmin, not to the log file of the API
+        handlers = [h for h in logging.getLogger('yunohost').handlers
+                    if isinstance(h, APIQueueHandler)]
+
+        def _print(line):
+            record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, line, (), None)
+            for handler in handlers:
+                handler.handle(record)
+    else:
+        def _print(line):
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    last_source = None
+    try:
+        for source, line in logs:
+            if source != last_source:
+                _print("%s==> %s <==" % ("" if last_source is None else "\n", source))
+                last_source = source
+            _print(line)
+    except KeyboardInterrupt:
+        # (that's how one stops following in the CLI)
+        pass
+
+
+class _FollowedFile(object):
+    """
+    A log file which is followed from its current end (or from a given
+    position), even if it gets rotated (then the rest of the old file is
+    read, and the new one from its beginning) or truncated
+    """
+
+    def __init__(self, path, position=None):
+        self.path = path
+        self.partial_line = ""
+        self._open()
+        if self.f is None:
+            return
+
+        stat = os.fstat(self.f.fileno())
+        if position is None:
+            self.f.seek(0, os.SEEK_END)
+        elif position[0] == stat.st_ino and position[1] <= stat.st_size:
+            self.f.seek(position[1])
+        # else rotated or truncated since the position was taken : the new
+        # file is read from its beginning
+
+    def _open(self):
+        # (not with open(), whose end of file is sticky with recent libcs,
+        # such that what gets appended afterwards wouldn't be read)
+        try:
+            self.f = io.open(self.path, "rb")
+        except IOError:
+            self.f = None
+
+    def _read(self):
+        if self.f is None:
+            return []
+        lines = (self.partial_line + self.f.read()).split("\n")
+        self.partial_line = lines.pop()
+        return lines
+
+    def read_new_lines(self):
+
+        lines = self._read()
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # Removed, maybe soon re-created
+            return lines
+
+        if self.f is None or stat.st_ino != os.fstat(self.f.fileno()).st_ino:
+            # Rotated : the rest of the old file was just read, now continue
+            # with the new one
+            self.close()
+            self._open()
+            lines += self._read()
+        elif stat.st_size < self.f.tell():
+            # Truncated (e.g. logrotate's copytruncate)
+            self.f.seek(0)
+            self.partial_line = ""
+            lines += self._read()
+
+        return lines
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def _inotify_init():
+
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    return fd
+
+
+def _inotify_add_watch(fd, path, mask):
+
+    wd = _libc.inotify_add_watch(fd, path, mask)
+    if wd < 0:
+        raise OSError(ctypes.get_errno(), "%s: %s" % (path, os.strerror(ctypes.get_errno())))
+    return wd
+
+
+def _inotify_read_paths(fd, watches):
+    """
+    Paths of the files concerned by the pending inotify events
+    """
+
+    paths = set()
+    while True:
+        try:
+            data = os.read(fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return paths
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if wd in watches and name:
+                paths.add(os.path.join(watches[wd], name))
+
+
+def _read_available(fd):
+    """
+    Read what is available on a non-blocking fd (None at the end of file)
+    """
+
+    chunks = []
+    while True:
+        try:
+            chunk = os.read(fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return "".join(chunks)
+            raise
+        if not chunk:
+            return "".join(chunks) if chunks else None
+        chunks.append(chunk)
+
+
+def _set_nonblocking(fd):
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
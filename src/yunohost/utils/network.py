@@ -20,14 +20,20 @@
 """
 import os
 import re
+import json
+import atexit
 import logging
 import time
+import threading
 import dns.resolver
+from multiprocessing.pool import ThreadPool
 
 from moulinette.utils.filesystem import read_file, write_to_file
 from moulinette.utils.network import download_text
 from moulinette.utils.process import check_output
 
+from yunohost.utils.filesystem import write_to_file_atomically
+
 logger = logging.getLogger('yunohost.utils.network')
 
 
@@ -106,6 +112,24 @@ def get_gateway():
     return addr.popitem()[1] if len(addr) == 1 else None
 
 
+# Max number of DNS requests done at once by dig_many(), whatever the number
+# of threads calling it
+DIG_MAX_PARALLEL_REQUESTS = 32
+_dig_many_semaphore = threading.BoundedSemaphore(DIG_MAX_PARALLEL_REQUESTS)
+
+# Answers of dig(), as { (qname, rdtype, resolvers, edns_size, full_answers): (expiration, result) }
+# Answers are kept as long as their TTL says, and negative answers (NXDOMAIN,
+# no answer) as long as the SOA of the zone says (RFC 2308)
+_dig_cache = None
+_dig_cache_changed = False
+
+# The (not full_answers) answers are also persisted such that successive
+# yunohost commands reuse them, but only for a short while
+DIG_CACHE = "/var/cache/yunohost/dig_cache.json"
+DIG_CACHE_PERSISTENCE_DURATION = 60
+DIG_CACHE_DEFAULT_NEGATIVE_TTL = 60
+DIG_CACHE_NEGATIVE_ANSWERS = {e.__name__: e for e in [dns.resolver.NXDOMAIN, dns.resolver.NoAnswer]}
+
 # Lazy dev caching to avoid re-reading the file multiple time when calling
 # dig() often during same yunohost operation
 external_resolvers_ = []
@@ -126,9 +150,13 @@ def external_resolvers():
     return external_resolvers_
 
 
-def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_answers=False):
+def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_answers=False,
+        use_cache=True):
     """
     Do a quick DNS request and avoid the "search" trap inside /etc/resolv.conf
+
+    Answers are cached (c.f. _dig_cache) unless use_cache is False, in which
+    case the request is done anyway (and its answer cached for later calls)
     """
 
     # It's very important to do the request with a qname ended by .
@@ -144,6 +172,11 @@ def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_an
     else:
         assert isinstance(resolvers, list)
 
+    cache = _get_dig_cache()
+    key = (qname.lower(), rdtype, tuple(resolvers), edns_size, full_answers)
+    if use_cache and key in cache and cache[key][0] > time.time():
+        return cache[key][1]
+
     resolver = dns.resolver.Resolver(configure=False)
     resolver.use_edns(0, 0, edns_size)
     resolver.nameservers = resolvers
@@ -154,12 +187,142 @@ def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_an
             dns.resolver.NoNameservers,
             dns.resolver.NoAnswer,
             dns.exception.Timeout) as e:
-        return ("nok", (e.__class__.__name__, e))
+        result = ("nok", (e.__class__.__name__, e))
+        # (timeouts and failing servers are not answers, so aren't cached)
+        if e.__class__.__name__ in DIG_CACHE_NEGATIVE_ANSWERS:
+            _add_to_dig_cache(key, time.time() + _negative_answer_ttl(e), result)
+        return result
 
+    expiration = answers.expiration
     if not full_answers:
         answers = [answer.to_text() for answer in answers]
 
-    return ("ok", answers)
+    result = ("ok", answers)
+    _add_to_dig_cache(key, expiration, result)
+    return result
+
+
+def _negative_answer_ttl(e):
+    """
+    How long a negative answer can be cached, i.e. the TTL of the SOA record
+    found in the authority section of the response (capped by its minimum)
+    """
+
+    kwargs = getattr(e, "kwargs", None) or {}
+    responses = list(kwargs.get("responses", {}).values())
+    if kwargs.get("response") is not None:
+        responses.append(kwargs["response"])
+
+    ttls = [min(rrset.ttl, rrset[0].minimum)
+            for response in responses
+            for rrset in response.authority
+            if rrset.rdtype == dns.rdatatype.SOA and len(rrset)]
+
+    return min(ttls) if ttls else DIG_CACHE_DEFAULT_NEGATIVE_TTL
+
+
+def _add_to_dig_cache(key, expiration, result):
+
+    global _dig_cache_changed
+
+    _get_dig_cache()[key] = (expiration, result)
+    if not key[-1]:
+        _dig_cache_changed = True
+
+
+def _get_dig_cache():
+
+    global _dig_cache
+
+    if _dig_cache is None:
+        _dig_cache = {}
+        if os.path.exists(DIG_CACHE):
+            try:
+                with open(DIG_CACHE) as f:
+                    # Only trust a cache written by ourselves
+                    if os.fstat(f.fileno()).st_uid != os.getuid():
+                        raise Exception("unexpected owner for %s" % DIG_CACHE)
+                    entries = json.load(f)
+                now = time.time()
+                for qname, rdtype, resolvers, edns_size, expiration, status, answers in entries:
+                    if expiration <= now:
+                        continue
+                    if status == "nok":
+                        answers = (answers, DIG_CACHE_NEGATIVE_ANSWERS[answers]())
+                    key = (qname, rdtype, tuple(resolvers), edns_size, False)
+                    _dig_cache[key] = (expiration, (status, answers))
+            except Exception as e:
+                logger.debug("Ignoring the dig cache which could not be loaded : %s" % e)
+
+    return _dig_cache
+
+
+def _save_dig_cache():
+
+    if not _dig_cache_changed:
+        return
+
+    now = time.time()
+    entries = []
+    for (qname, rdtype, resolvers, edns_size, full_answers), (expiration, (status, answers)) in _dig_cache.items():
+        if full_answers or expiration <= now:
+            continue
+        if status == "nok":
+            answers = answers[0]
+        expiration = min(expiration, now + DIG_CACHE_PERSISTENCE_DURATION)
+        entries.append((qname, rdtype, list(resolvers), edns_size, expiration, status, answers))
+
+    try:
+        write_to_file_atomically(DIG_CACHE, json.dumps(entries), mode=0o600)
+    except Exception as e:
+        logger.debug("Could not save the dig cache : %s" % e)
+
+
+# Persist the answers when Python exits, for the next yunohost commands
+atexit.register(_save_dig_cache)
+
+
+def dig_many(queries, max_parallel_per_group=None, **kwargs):
+    """
+    Do several DNS requests concurrently (such that a slow resolver or
+    domain doesn't delay all the other requests)
+
+    Keyword arguments:
+        queries -- List of (qname, rdtype) or (qname, rdtype, group) to
+            resolve
+        max_parallel_per_group -- Max number of requests of a same group
+            done at once (e.g. to not hammer a same DNS server)
+        kwargs -- Other arguments for dig()
+
+    Returns:
+        The result of dig() for each query, in the same order
+    """
+
+    if not queries:
+        return []
+
+    groups_semaphores = {}
+    if max_parallel_per_group:
+        for query in queries:
+            if len(query) > 2 and query[2] not in groups_semaphores:
+                groups_semaphores[query[2]] = threading.BoundedSemaphore(max_parallel_per_group)
+
+    def _dig(query):
+        group_semaphore = groups_semaphores.get(query[2]) if len(query) > 2 else None
+        if group_semaphore:
+            group_semaphore.acquire()
+        try:
+            with _dig_many_semaphore:
+                return dig(query[0], query[1], **kwargs)
+        finally:
+            if group_semaphore:
+                group_semaphore.release()
+
+    pool = ThreadPool(min(len(queries), DIG_MAX_PARALLEL_REQUESTS))
+    try:
+        return pool.map(_dig, queries)
+    finally:
+        pool.close()
 
 
 def _extract_inet(string, skip_netmask=False, skip_loopback=True):
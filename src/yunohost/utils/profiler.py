@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2020 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+
+""" profiler.py
+
+    Profile bash scripts (typically app scripts) from their xtrace output.
+
+    The script is run with BASH_ENV=HOOK_PROFILER_INIT, which enables xtrace
+    with a PS4 such that each traced command is prefixed with the time at
+    which it started (EPOCHREALTIME, or nothing before bash 5 in which case
+    the time at which the line is received is used, as xtrace isn't buffered)
+    and the stack of functions it runs in.
+    The time between two traced commands is accounted to the first one, which
+    gives the time spent in each ynh_* helper and on each line of the script.
+
+    Results are saved in two files :
+        - <path>.profile, a summary table of the helpers / script lines
+          taking the most time
+        - <path>.folded, the collapsed stacks (one "frame;frame;... µs"
+          per line), as used by flamegraph tools
+"""
+
+import os
+import time
+from collections import defaultdict
+
+# Sourced by bash before running the profiled script, c.f. the PS4 it sets
+HOOK_PROFILER_INIT = '/usr/share/yunohost/other/hook_profiler.sh'
+
+# Separator of the fields of PS4
+SEPARATOR = '\x1f'
+
+# Number of script lines shown in the summary table
+SUMMARY_MAX_LINES = 30
+
+
+class HookProfiler(object):
+    """
+    Accumulate the timings of a bash script, from the lines of its xtrace
+    output (as given by feed())
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.script_name = os.path.basename(path)
+        self.started_at = time.time()
+        self.last_event = None
+        self.last_frames = []
+
+        self.helpers_time = defaultdict(float)
+        self.helpers_calls = defaultdict(int)
+        self.lines_time = defaultdict(float)
+        self.stacks_time = defaultdict(float)
+
+    def feed(self, line):
+        """
+        Account a line of the output of the script
+
+        Returns:
+            The line as it would have been traced without profiling (such
+            that the log of the script stays readable)
+        """
+
+        depth = len(line) - len(line.lstrip('+'))
+        fields = line[depth:].split(SEPARATOR, 5)
+        if depth == 0 or len(fields) != 6 or fields[0] != '':
+            # Output of the script, or continuation of a multiline command
+            return line
+
+        _, timestamp, funcs, linenos, lineno, command = fields
+        try:
+            timestamp = float(timestamp) if timestamp else time.time()
+            lineno = int(lineno)
+        except ValueError:
+            # Not accountable, but still don't clutter the log with the prefix
+            return '+' * depth + command
+        funcs = funcs.split()
+        linenos = linenos.split()
+
+        # Frames of the command, from the outermost one : the functions
+        # called from the script itself are at the bottom of the stack, just
+        # above "main" (and BASH_LINENO tells where they were called from)
+        if funcs and funcs[-1] == 'main':
+            frames = funcs[-2::-1]
+            script_line = int(linenos[-2]) if len(linenos) == len(funcs) else lineno
+        else:
+            frames = funcs[::-1]
+            script_line = lineno
+
+        self._account_until(timestamp)
+        self.last_event = (timestamp, script_line, frames)
+
+        # Functions entered since the previous command
+        common = 0
+        for previous, current in zip(self.last_frames, frames):
+            if previous != current:
+                break
+            common += 1
+        for frame in frames[common:]:
+            if frame.startswith('ynh_'):
+                self.helpers_calls[frame] += 1
+        self.last_frames = frames
+
+        return '+' * depth + command
+
+    def _account_until(self, timestamp):
+
+        if self.last_event is None:
+            return
+
+        started_at, script_line, frames = self.last_event
+        duration = max(timestamp - started_at, 0)
+
+        for helper in set(f for f in frames if f.startswith('ynh_')):
+            self.helpers_time[helper] += duration
+        self.lines_time[script_line] += duration
+        stack = [self.script_name, '%s:%s' % (self.script_name, script_line)] + frames
+        self.stacks_time[';'.join(stack)] += duration
+
+    def save(self, path):
+        """
+        Append the results to <path>.profile and <path>.folded (as several
+        scripts may be profiled during the same operation)
+        """
+
+        # The last command lasted until the end of the script
+        ended_at = time.time()
+        self._account_until(ended_at)
+        self.last_event = None
+
+        with open(path + '.profile', 'a') as f:
+            f.write(self.summary(ended_at - self.started_at))
+
+        with open(path + '.folded', 'a') as f:
+            for stack, duration in sorted(self.stacks_time.items()):
+                # (flamegraph tools expect integer values)
+                f.write('%s %d\n' % (stack, round(duration * 1000000)))
+
+    def summary(self, total):
+        """
+        Summary table of the time spent in helpers and on script lines
+        """
+
+        try:
+            with open(self.path) as f:
+                script_lines = f.read().split('\n')
+        except IOError:
+            script_lines = []
+
+        def _percent(duration):
+            return 100 * duration / total if total else 0
+
+        summary = ["Profile of %s (total: %.3fs)" % (self.path, total), "",
+                   "Helpers (time spent in each ynh_* helper, including the helpers it calls)",
+                   "  %10s  %6s  %6s  %s" % ("Time (s)", "%", "Calls", "Helper")]
+        for helper, duration in sorted(self.helpers_time.items(), key=lambda h: -h[1]):
+            summary.append("  %10.3f  %6.1f  %6d  %s" % (duration, _percent(duration),
+                                                         self.helpers_calls[helper], helper))
+
+        summary += ["",
+                    "Script lines (top %d)" % SUMMARY_MAX_LINES,
+                    "  %10s  %6s  %s" % ("Time (s)", "%", "Line")]
+        lines = sorted(self.lines_time.items(), key=lambda l: -l[1])[:SUMMARY_MAX_LINES]
+        for lineno, duration in lines:
+            text = script_lines[lineno - 1].strip() if 0 < lineno <= len(script_lines) else ""
+            summary.append("  %10.3f  %6.1f  %5d: %s" % (duration, _percent(duration), lineno, text))
+
+        return '\n'.join(summary) + '\n\n'